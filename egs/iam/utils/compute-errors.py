@@ -1,63 +1,225 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 
 import argparse
+import multiprocessing
+import os
 import sys
+from collections import defaultdict
+from itertools import islice
 
-def levenshtein(u, v):
-    prev = None
-    curr = [0] + range(1, len(v) + 1)
-    # Operations: (SUB, DEL, INS)
-    prev_ops = None
-    curr_ops = [(0, 0, i) for i in range(len(v) + 1)]
-    for x in xrange(1, len(u) + 1):
-        prev, curr = curr, [x] + ([None] * len(v))
-        prev_ops, curr_ops = curr_ops, [(0, x, 0)] + ([None] * len(v))
-        for y in xrange(1, len(v) + 1):
-            delcost = prev[y] + 1
-            addcost = curr[y - 1] + 1
-            subcost = prev[y - 1] + int(u[x - 1] != v[y - 1])
-            curr[y] = min(subcost, delcost, addcost)
-            if curr[y] == subcost:
-                (n_s, n_d, n_i) = prev_ops[y - 1]
-                curr_ops[y] = (n_s + int(u[x - 1] != v[y - 1]), n_d, n_i)
-            elif curr[y] == delcost:
-                (n_s, n_d, n_i) = prev_ops[y]
-                curr_ops[y] = (n_s, n_d + 1, n_i)
-            else:
-                (n_s, n_d, n_i) = curr_ops[y - 1]
-                curr_ops[y] = (n_s, n_d, n_i + 1)
-    return curr[len(v)], curr_ops[len(v)]
+import numpy as np
+
+# Operations, in tie-breaking order
+SUB, DEL, INS = 0, 1, 2
+# Substitutions are counted in the high bits, deletions in the low bits
+_SHIFT = 32
+
+
+def levenshtein_batch(refs, hyps, alignments=False):
+    """Edit operations of a batch of (reference, hypothesis) pairs.
+
+    refs and hyps are lists of integer arrays. The DP matrices of all the
+    pairs are computed together, one reference position at a time: for each
+    row, substitutions and deletions only depend on the previous row, and
+    the chain of insertions is resolved with a cumulative minimum over the
+    columns. Ties are broken preferring substitution, then deletion, then
+    insertion.
+
+    Returns an array of shape (B, 3) with the number of substitutions,
+    deletions and insertions of each pair and, if alignments is True, the
+    operation taken at each cell of the DP matrices, with shape
+    (B, M + 1, N + 1).
+    """
+    batch_size = len(refs)
+    ref_len = np.array([len(r) for r in refs], dtype=np.int64)
+    hyp_len = np.array([len(h) for h in hyps], dtype=np.int64)
+    max_ref, max_hyp = int(ref_len.max()), int(hyp_len.max())
+    # Padding never matches, and never affects the cells that are read
+    ref = np.full((batch_size, max(max_ref, 1)), -1, dtype=np.int64)
+    hyp = np.full((batch_size, max(max_hyp, 1)), -2, dtype=np.int64)
+    for b in range(batch_size):
+        ref[b, :ref_len[b]] = refs[b]
+        hyp[b, :hyp_len[b]] = hyps[b]
+    hyp = hyp[:, :max_hyp]
+
+    size = max_hyp + 1
+    cols = np.arange(size, dtype=np.int64)
+    rows = np.arange(batch_size)
+    # Distance of the best path to each cell, and its number of substitutions
+    # and deletions packed in a single integer (insertions are the rest)
+    dist = np.broadcast_to(cols, (batch_size, size)).copy()
+    subdel = np.zeros((batch_size, size), dtype=np.int64)
+    result_dist = dist[rows, hyp_len]
+    result_subdel = subdel[rows, hyp_len]
+    backpointers = None
+    if alignments:
+        backpointers = np.full((batch_size, max_ref + 1, size), INS, dtype=np.int8)
+
+    for i in range(1, max_ref + 1):
+        cost = hyp != ref[:, i - 1:i]
+        # Best of substitution (or match) and deletion, preferring substitution
+        step_dist = dist + 1
+        step_subdel = subdel + 1
+        sub_dist = dist[:, :-1] + cost
+        take_sub = sub_dist <= step_dist[:, 1:]
+        step_dist[:, 1:] = np.where(take_sub, sub_dist, step_dist[:, 1:])
+        step_subdel[:, 1:] = np.where(
+            take_sub, subdel[:, :-1] + (cost.astype(np.int64) << _SHIFT), step_subdel[:, 1:])
+
+        # dist[j] = min_{k <= j} step_dist[k] + (j - k) insertions. The
+        # minimum and the (last) column attaining it are packed into a
+        # single key, so that one cumulative minimum gives both.
+        key = (step_dist - cols) * size + (size - 1 - cols)
+        key = np.minimum.accumulate(key, axis=1)
+        sources = size - 1 - key % size
+        dist = (key - (size - 1 - sources)) // size + cols
+        subdel = step_subdel[rows[:, None], sources]
+
+        if alignments:
+            step = np.full((batch_size, size), DEL, dtype=np.int8)
+            step[:, 1:][take_sub] = SUB
+            step[sources != cols] = INS
+            backpointers[:, i] = step
+
+        done = ref_len == i
+        result_dist[done] = dist[done, hyp_len[done]]
+        result_subdel[done] = subdel[done, hyp_len[done]]
+
+    n_sub = result_subdel >> _SHIFT
+    n_del = result_subdel & ((1 << _SHIFT) - 1)
+    result = np.stack([n_sub, n_del, result_dist - n_sub - n_del], axis=1)
+    return result, backpointers
+
+
+def traceback(ref, hyp, backpointers, eps):
+    """Aligned (reference, hypothesis) token pairs, from the DP operations."""
+    i, j = len(ref), len(hyp)
+    pairs = []
+    while i > 0 or j > 0:
+        op = backpointers[i, j] if i > 0 else INS
+        if op == SUB:
+            i, j = i - 1, j - 1
+            pairs.append((ref[i], hyp[j]))
+        elif op == DEL:
+            i -= 1
+            pairs.append((ref[i], eps))
+        else:
+            j -= 1
+            pairs.append((eps, hyp[j]))
+    return pairs[::-1]
+
+
+def process_chunk(task):
+    """Errors (and optionally alignments) of a chunk of (id, ref, hyp) entries.
+
+    hyp is None for references without hypothesis. Entries are batched with
+    others of similar length, to reduce the padding.
+    """
+    entries, batch_size, alignments, eps = task
+    # Map each distinct token to a new integer
+    vocab = defaultdict()
+    vocab.default_factory = vocab.__len__
+
+    def encode(tokens):
+        return np.fromiter(map(vocab.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+
+    encoded = [(encode(ref), encode(hyp)) for _, ref, hyp in entries if hyp is not None]
+    positions = [n for n, (_, _, hyp) in enumerate(entries) if hyp is not None]
+
+    counts = [None] * len(entries)
+    aligned = [None] * len(entries)
+    order = sorted(range(len(encoded)), key=lambda n: (len(encoded[n][0]), len(encoded[n][1])))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        ops, backpointers = levenshtein_batch(
+            [encoded[n][0] for n in batch], [encoded[n][1] for n in batch], alignments)
+        for b, n in enumerate(batch):
+            counts[positions[n]] = tuple(int(x) for x in ops[b])
+            if alignments:
+                _, ref, hyp = entries[positions[n]]
+                aligned[positions[n]] = traceback(ref, hyp, backpointers[b], eps)
+
+    output = []
+    for (uid, ref, hyp), ops, pairs in zip(entries, counts, aligned):
+        if hyp is None:
+            output.append((uid, len(ref), (0, len(ref), 0), len(ref), 0, None))
+        else:
+            output.append((uid, sum(ops), ops, len(ref), len(hyp), pairs))
+    return output
+
+
+def iter_chunks(ref, hyp, chunk_size, batch_size, alignments, eps):
+    entries = ((r, ref[r], hyp.get(r)) for r in ref)
+    while True:
+        chunk = list(islice(entries, chunk_size))
+        if not chunk:
+            return
+        yield chunk, batch_size, alignments, eps
+
+
+def load_transcripts(f):
+    transcripts = {}
+    for line in f:
+        line = line.split()
+        if line:
+            transcripts[line[0]] = line[1:]
+    return transcripts
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='''Compute the error operations (total errors, subtitutions,
-        insertions, deletions) between a transcript and its reference.''')
+        deletions, insertions) between a transcript and its reference. For each
+        reference, prints its ID, the number of errors, substitutions,
+        deletions and insertions, and the length of the reference and the
+        hypothesis. Corpus totals are printed to stderr.''')
     parser.add_argument('reference', type=argparse.FileType('r'),
                         help='''Text file containing the ID of each sentence
                         and its reference transcript.''')
-    parser.add_argument('hypothesis', type=argparse.FileType('r'),
+    parser.add_argument('hypothesis', type=argparse.FileType('r'), nargs='?',
                         default=sys.stdin,
                         help='''Text file containing the ID of each sentence
                         and its hypothesis transcript.''')
+    parser.add_argument('--alignments', type=argparse.FileType('w'),
+                        help='''Write the alignment of each sentence to this
+                        file, as "ID ref hyp ; ref hyp ; ..." pairs.''')
+    parser.add_argument('--eps', default='*',
+                        help='''Symbol used for insertions and deletions in
+                        the alignments.''')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of parallel processes.')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Number of sentences processed by each task.')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='Number of sentences aligned together.')
     args = parser.parse_args()
 
-    # Load references
-    ref = {}
-    for line in args.reference:
-        line = line.split()
-        ref[line[0]] = line[1:]
-    # Load hypotheses
-    hyp = {}
-    for line in args.hypothesis:
-        line = line.split()
-        hyp[line[0]] = line[1:]
-    # Compute errors
-    for r in ref:
-        len_r = len(ref[r])
-        if r in hyp:
-            len_h = len(hyp[r])
-            n_err, (n_sub, n_del, n_ins) = levenshtein(ref[r], hyp[r])
-            print '%s %d %d %d %d %d %d' % (r, n_err, n_sub, n_del, n_ins, len_r, len_h)
-        else:
-            print '%s %d %d %d %d %d %d' % (r, len_r, 0, len_r, 0, len_r, 0)
+    ref = load_transcripts(args.reference)
+    hyp = load_transcripts(args.hypothesis)
+
+    tasks = iter_chunks(ref, hyp, args.chunk_size, args.batch_size,
+                        args.alignments is not None, args.eps)
+    if args.jobs > 1 and len(ref) > args.chunk_size:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(process_chunk, tasks)
+    else:
+        pool = None
+        results = map(process_chunk, tasks)
+
+    totals = np.zeros(6, dtype=np.int64)
+    out = sys.stdout
+    for chunk in results:
+        for uid, n_err, (n_sub, n_del, n_ins), len_r, len_h, pairs in chunk:
+            out.write('%s %d %d %d %d %d %d\n' % (uid, n_err, n_sub, n_del, n_ins, len_r, len_h))
+            totals += (n_err, n_sub, n_del, n_ins, len_r, len_h)
+            if args.alignments is not None and pairs is not None:
+                args.alignments.write('%s %s\n' % (uid, ' ; '.join('%s %s' % p for p in pairs)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    n_err, n_sub, n_del, n_ins, len_r, len_h = (int(x) for x in totals)
+    sys.stderr.write('TOTAL %d %d %d %d %d %d\n' % (n_err, n_sub, n_del, n_ins, len_r, len_h))
+    if len_r > 0:
+        sys.stderr.write('%%ERR %.2f %%SUB %.2f %%DEL %.2f %%INS %.2f\n' % tuple(
+            100.0 * x / len_r for x in (n_err, n_sub, n_del, n_ins)))
@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+import torch
+from torch.nn import CTCLoss
+from typing import Callable, Dict, List
+
+from laia.models.crnn import CRNN
+from laia.data.handwriting_dataset import HandwritingDataset
+from laia.data.packed_store import pack_lines
+from laia.utils.image_distorter import ImageDistorter
+from laia.utils.metrics import EditOperationCounts, TextRecognitionMetrics
+from laia.utils.profiling import max_rss_mb, peak_rss_mb, reset_peak_rss
+from .synthetic import WIDTH_DISTRIBUTIONS, make_synthetic_dataset, sample_widths
+
+class StageTimer:
+    def __init__(self):
+        """Latencies and number of lines of the calls of each benchmarked stage."""
+        self.latencies: Dict[str, List[float]] = {}
+        self.lines: Dict[str, int] = {}
+        self.peak_rss: Dict[str, float] = {}
+
+    def time(self, stage: str, fn: Callable, num_lines: int):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = fn()
+        self.latencies.setdefault(stage, []).append(time.perf_counter() - start)
+        self.lines[stage] = self.lines.get(stage, 0) + num_lines
+        self.peak_rss[stage] = max(self.peak_rss.get(stage, 0.0), peak_rss_mb())
+        return result
+
+    def summary(self, warmup: int = 0) -> Dict[str, Dict[str, float]]:
+        """
+        Statistics of each stage, ignoring its first warmup calls.
+
+        lines_per_second is computed from the total time of the stage, and
+        the latencies are per call (per line for getitem, per batch otherwise).
+        peak_rss_mb is the peak RSS of the process while the stage ran (where
+        the peak cannot be reset, e.g. outside Linux, it is a high-water mark
+        that includes the previous stages).
+        """
+        results = {}
+        for stage, latencies in self.latencies.items():
+            lines_per_call = self.lines[stage] / len(latencies)
+            latencies = np.array(latencies[warmup:] if len(latencies) > warmup else latencies)
+            results[stage] = {
+                'calls': len(latencies),
+                'lines_per_second': lines_per_call * len(latencies) / latencies.sum() if latencies.sum() > 0 else 0.0,
+                'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                'p99_ms': float(np.percentile(latencies, 99) * 1000),
+                'peak_rss_mb': self.peak_rss[stage]
+            }
+        return results
+
+def environment() -> Dict[str, str]:
+    """Information needed to compare results across runs."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads()
+    }
+
+def run_benchmark(args, data_dir: str) -> Dict:
+    widths = sample_widths(
+        args.num_lines, args.width_distribution, args.mean_width,
+        args.min_width, args.max_width, seed=args.seed
+    )
+    paths = make_synthetic_dataset(
+        data_dir, widths, img_height=args.img_height,
+        source_height=args.source_height, seed=args.seed
+    )
+    with open(paths['char_map'], 'r', encoding='utf-8') as f:
+        char_map = json.load(f)
+
+    timer = StageTimer()
+    dataset = HandwritingDataset(paths['images'], paths['gt'], char_map, img_height=args.img_height)
+    batches = [list(range(i, min(i + args.batch_size, len(dataset))))
+               for i in range(0, len(dataset), args.batch_size)]
+
+    # Data loading, one line at a time
+    samples = [timer.time('getitem', lambda i=i: dataset[i], 1) for i in range(len(dataset))]
+    if not args.no_packed:
+        prefix = os.path.join(data_dir, 'packed')
+        pack_lines(paths['images'], list(dataset.manifest.images), prefix, args.img_height)
+        packed = HandwritingDataset(paths['images'], paths['gt'], char_map,
+                                    img_height=args.img_height, packed_store=prefix)
+        for i in range(len(packed)):
+            timer.time('getitem_packed', lambda i=i: packed[i], 1)
+
+    collated = [
+        timer.time('collate', lambda b=b: HandwritingDataset.collate_fn([samples[i] for i in b]), len(b))
+        for b in batches
+    ]
+
+    torch.manual_seed(args.seed)
+    model = CRNN(
+        num_classes=len(char_map),
+        cnn_output_size=args.cnn_output_size,
+        lstm_hidden_size=args.lstm_hidden_size,
+        lstm_layers=args.lstm_layers,
+        dropout=args.dropout
+    )
+    model.train()
+    distorter = ImageDistorter()
+    ctc_loss = CTCLoss(zero_infinity=True)
+    metrics = TextRecognitionMetrics(char_map)
+    char_errors, word_errors = EditOperationCounts(), EditOperationCounts()
+
+    for _ in range(args.epochs):
+        for images, texts, batch_widths, text_lengths in collated:
+            num_lines = images.size(0)
+            if not args.no_distorter:
+                with torch.no_grad():
+                    images = timer.time('distorter', lambda: distorter(images, batch_widths), num_lines)
+
+            model.zero_grad(set_to_none=True)
+            log_probs = timer.time('forward', lambda: torch.nn.functional.log_softmax(
+                model(images, batch_widths), dim=2).transpose(0, 1), num_lines)  # (T, B, C)
+            input_lengths = model.get_output_lengths(batch_widths)
+            loss = timer.time('ctc_loss', lambda: ctc_loss(log_probs, texts, input_lengths, text_lengths), num_lines)
+            timer.time('backward', loss.backward, num_lines)
+
+            log_probs = log_probs.detach()
+            def decode():
+                labels, lengths = metrics.greedy_decode(log_probs, input_lengths)
+                return labels, lengths, metrics.labels_to_strings(labels, lengths)
+            labels, lengths, predictions = timer.time('decode', decode, num_lines)
+
+            def update_metrics():
+                operations = metrics.edit_operations(labels, lengths, texts, text_lengths, predictions=predictions)
+                char_errors.update(*operations['char'])
+                word_errors.update(*operations['word'])
+            timer.time('metrics', update_metrics, num_lines)
+
+    return {
+        'stages': timer.summary(warmup=args.warmup),
+        'peak_rss_mb': max_rss_mb(),
+        'dataset': {
+            'num_lines': int(len(widths)),
+            'mean_width': float(widths.mean()),
+            'p99_width': float(np.percentile(widths, 99)),
+            'padding_overhead': float(sum(
+                len(b) * max(widths[i] for i in b) for b in batches) / widths.sum())
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the training and evaluation pipeline on synthetic lines")
+
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--no_packed", action="store_true", help="Do not benchmark loading from a packed store")
+    parser.add_argument("--no_distorter", action="store_true", help="Do not benchmark the image distorter")
+    parser.add_argument("--num_lines", type=int, default=256, help="Number of synthetic lines")
+    parser.add_argument("--width_distribution", type=str, default="lognormal", choices=WIDTH_DISTRIBUTIONS,
+                        help="Distribution of the line widths")
+    parser.add_argument("--mean_width", type=int, default=800, help="Mean line width, at --img_height")
+    parser.add_argument("--min_width", type=int, default=64, help="Minimum line width, at --img_height")
+    parser.add_argument("--max_width", type=int, default=2400, help="Maximum line width, at --img_height")
+    parser.add_argument("--img_height", type=int, default=64, help="Input image height")
+    parser.add_argument("--source_height", type=int, default=128, help="Height of the stored synthetic images")
+    parser.add_argument("--batch_size", type=int, default=16, help="Batch size")
+    parser.add_argument("--epochs", type=int, default=2, help="Number of passes over the batches for the model stages")
+    parser.add_argument("--warmup", type=int, default=2, help="Number of initial calls of each stage to ignore")
+    parser.add_argument("--threads", type=int, default=None, help="Number of intra-op threads (default: PyTorch's)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="Directory for the synthetic data (default: a temporary directory, removed afterwards)")
+
+    parser = CRNN.add_model_specific_args(parser)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='laia-benchmark-')
+    try:
+        results = run_benchmark(args, data_dir)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    results['environment'] = environment()
+    results['config'] = vars(args)
+
+    print(f"{'stage':<16} {'lines/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'RSS MB':>10}")
+    for stage, stats in results['stages'].items():
+        print(f"{stage:<16} {stats['lines_per_second']:10.1f} {stats['p50_ms']:10.2f} "
+              f"{stats['p99_ms']:10.2f} {stats['peak_rss_mb']:10.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
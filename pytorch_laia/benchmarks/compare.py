@@ -0,0 +1,68 @@
+import argparse
+import json
+import sys
+
+METRICS = ('lines_per_second', 'p50_ms', 'p99_ms', 'peak_rss_mb')
+# Whether higher values are better
+HIGHER_IS_BETTER = {'lines_per_second': True, 'p50_ms': False, 'p99_ms': False, 'peak_rss_mb': False}
+
+def compare(baseline: dict, candidate: dict, threshold: float):
+    """
+    Relative change of each metric of each stage present in both results.
+
+    Returns:
+        List of (stage, metric, baseline value, candidate value, relative
+        change, whether it is a regression beyond threshold)
+    """
+    rows = []
+    for stage, stats in candidate['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        for metric in METRICS:
+            old, new = baseline['stages'][stage][metric], stats[metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if HIGHER_IS_BETTER[metric] else change
+            rows.append((stage, metric, old, new, change, worse > threshold))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+
+    parser.add_argument("baseline", type=str, help="Results of the baseline (see benchmarks/benchmark.py)")
+    parser.add_argument("candidate", type=str, help="Results of the candidate")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative change considered a regression (e.g. 0.1 for 10%%)")
+    parser.add_argument("--metrics", type=str, nargs='+', default=list(METRICS), choices=METRICS,
+                        help="Metrics to compare")
+    parser.add_argument("--fail_on_regression", action="store_true",
+                        help="Exit with an error if any metric regressed beyond the threshold")
+    args = parser.parse_args()
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, 'r', encoding='utf-8') as f:
+        candidate = json.load(f)
+
+    # Options that do not affect the measurements
+    ignored = ('output', 'data_dir')
+    configs = [{k: v for k, v in r.get('config', {}).items() if k not in ignored} for r in (baseline, candidate)]
+    if configs[0] != configs[1]:
+        print("Warning: the benchmark configurations differ", file=sys.stderr)
+    for key in ('cpu_count', 'torch_threads', 'torch'):
+        if baseline['environment'].get(key) != candidate['environment'].get(key):
+            print(f"Warning: {key} differs ({baseline['environment'].get(key)} vs "
+                  f"{candidate['environment'].get(key)})", file=sys.stderr)
+
+    rows = [row for row in compare(baseline, candidate, args.threshold) if row[1] in args.metrics]
+    print(f"{'stage':<16} {'metric':<18} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for stage, metric, old, new, change, regression in rows:
+        print(f"{stage:<16} {metric:<18} {old:12.2f} {new:12.2f} {change:+8.1%}{'  REGRESSION' if regression else ''}")
+
+    regressions = [row for row in rows if row[5]]
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
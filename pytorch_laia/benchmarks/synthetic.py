@@ -0,0 +1,104 @@
+import json
+import numpy as np
+from pathlib import Path
+from PIL import Image
+from typing import Dict, List, Union
+
+WIDTH_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+def sample_widths(
+    num_lines: int,
+    distribution: str = 'lognormal',
+    mean_width: int = 800,
+    min_width: int = 64,
+    max_width: int = 2400,
+    seed: int = 0
+) -> np.ndarray:
+    """
+    Sample line widths (at the target height).
+
+    Args:
+        num_lines: Number of lines
+        distribution: 'fixed' (all lines are mean_width wide), 'uniform'
+            (between min_width and max_width) or 'lognormal' (around
+            mean_width, with a long tail of wide lines, as in real corpora)
+        mean_width: Mean width, for 'fixed' and 'lognormal'
+        min_width: Minimum width
+        max_width: Maximum width
+        seed: Random seed
+    """
+    rng = np.random.default_rng(seed)
+    if distribution == 'fixed':
+        widths = np.full(num_lines, mean_width)
+    elif distribution == 'uniform':
+        widths = rng.uniform(min_width, max_width, num_lines)
+    elif distribution == 'lognormal':
+        sigma = 0.5
+        widths = rng.lognormal(np.log(mean_width) - sigma ** 2 / 2, sigma, num_lines)
+    else:
+        raise ValueError(f"Unknown width distribution: {distribution}")
+    return np.clip(np.round(widths), min_width, max_width).astype(np.int64)
+
+def make_synthetic_dataset(
+    output_dir: Union[str, Path],
+    widths: np.ndarray,
+    img_height: int = 64,
+    source_height: int = 128,
+    chars_per_height: float = 1.5,
+    seed: int = 0
+) -> Dict[str, Path]:
+    """
+    Write synthetic line images, with ground truth and character map files
+    in the format used by HandwritingDataset.
+
+    Images are white with random dark strokes, stored as PNG at source_height
+    (so that loading includes resizing, as with real scans). Transcripts are
+    random lowercase text whose length is proportional to the line width, so
+    that CTC alignments are always possible.
+
+    Args:
+        output_dir: Output directory
+        widths: Width of each line at img_height
+        img_height: Height the lines are meant to be resized to
+        source_height: Height of the stored images
+        chars_per_height: Characters per img_height pixels of width
+        seed: Random seed
+
+    Returns:
+        Paths of the 'images' directory, 'gt' file and 'char_map' file
+    """
+    rng = np.random.default_rng(seed)
+    output_dir = Path(output_dir)
+    images_dir = output_dir / 'images'
+    images_dir.mkdir(parents=True, exist_ok=True)
+
+    alphabet = list('abcdefghijklmnopqrstuvwxyz')
+    char_map = {'<blank>': 0, ' ': 1}
+    char_map.update({c: i + 2 for i, c in enumerate(alphabet)})
+
+    samples: List[Dict[str, str]] = []
+    scale = source_height / img_height
+    for n, width in enumerate(widths):
+        source_width = max(1, int(round(width * scale)))
+        img = np.full((source_height, source_width), 255, dtype=np.uint8)
+        # Short random strokes in the middle band of the line
+        num_strokes = max(1, source_width // 8)
+        xs = rng.integers(0, source_width, num_strokes)
+        ys = rng.integers(source_height // 4, 3 * source_height // 4, num_strokes)
+        for x, y in zip(xs, ys):
+            img[y:y + source_height // 8, x:x + 3] = rng.integers(0, 96)
+        name = f'line{n:07d}.png'
+        Image.fromarray(img).save(images_dir / name)
+
+        # At most one character per 4 output frames (the CRNN reduces the width by 4)
+        length = max(1, min(int(chars_per_height * width / img_height), width // 16))
+        text = ''.join(rng.choice(alphabet + [' '], length))
+        samples.append({'image': name, 'text': text})
+
+    gt_file = output_dir / 'gt.json'
+    with open(gt_file, 'w', encoding='utf-8') as f:
+        json.dump(samples, f)
+    char_map_file = output_dir / 'char_map.json'
+    with open(char_map_file, 'w', encoding='utf-8') as f:
+        json.dump(char_map, f)
+    return {'images': images_dir, 'gt': gt_file, 'char_map': char_map_file}
@@ -1,4 +1,5 @@
 import argparse
+import time
 import torch
 import json
 from pathlib import Path
@@ -6,8 +7,12 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from laia.models.crnn import CRNN
+from laia.inference.export import evaluate_model, load_model
+from laia.inference.precision import PRECISIONS, inference_context, prepare_model
+from laia.data.collate import PaddedBatchCollator, normalize_images
 from laia.data.handwriting_dataset import HandwritingDataset
-from laia.utils.metrics import TextRecognitionMetrics
+from laia.utils.metrics import EditOperationCounts, TextRecognitionMetrics
+from laia.decoding import CTCBeamSearchDecoder, NGramLM
 
 def main():
     parser = argparse.ArgumentParser(description="Evaluate handwritten text recognition model")
@@ -19,14 +24,26 @@ def main():
     parser.add_argument("--checkpoint", type=str, required=True, help="Model checkpoint to evaluate")
     parser.add_argument("--img_height", type=int, default=64, help="Input image height")
     parser.add_argument("--max_width", type=int, default=None, help="Max input image width")
+    parser.add_argument("--fast_decode", action="store_true",
+                        help="Downscale images while decoding (JPEG DCT scaling, JPEG 2000 resolution levels)")
+    parser.add_argument("--packed_store", type=str, default=None, help="Packed store prefix for gt_file (see pack_data.py)")
     parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
     parser.add_argument("--num_workers", type=int, default=4, help="Number of data loading workers")
     parser.add_argument("--gpu", action="store_true", help="Use GPU for inference")
     parser.add_argument("--cer_trim", type=int, default=None, help="Character index to trim for CER calculation")
     parser.add_argument("--output_file", type=str, help="Save predictions to file")
+    parser.add_argument("--decoder", type=str, default="greedy", choices=["greedy", "beam"],
+                        help="Decoding method")
+    parser.add_argument("--precision", type=str, default="fp32", choices=list(PRECISIONS),
+                        help="Autocast precision (fp16 runs as bf16 on the CPU)")
+    parser.add_argument("--channels_last", action="store_true", help="Use the channels-last memory format for convolutions")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile")
+    parser.add_argument("--compare_fp32", action="store_true",
+                        help="Also evaluate in plain fp32 and report the CER drift and speedup (greedy decoding)")
     
     # Add model specific args
     parser = CRNN.add_model_specific_args(parser)
+    parser = CTCBeamSearchDecoder.add_model_specific_args(parser)
     args = parser.parse_args()
     
     # Load character map
@@ -39,7 +56,10 @@ def main():
         args.gt_file,
         char_map,
         img_height=args.img_height,
-        max_width=args.max_width
+        max_width=args.max_width,
+        packed_store=args.packed_store,
+        fast_decode=args.fast_decode,
+        normalize=False  # uint8 batches, normalized on the device
     )
     
     loader = DataLoader(
@@ -47,81 +67,124 @@ def main():
         batch_size=args.batch_size,
         shuffle=False,
         num_workers=args.num_workers,
-        collate_fn=HandwritingDataset.collate_fn,
+        collate_fn=PaddedBatchCollator(pin_memory=True),
         pin_memory=True
     )
     
-    # Create model and load checkpoint
-    model = CRNN(
+    # Load model (CRNN checkpoint or exported TorchScript model)
+    model = load_model(
+        args.checkpoint,
         num_classes=len(char_map),
         cnn_output_size=args.cnn_output_size,
         lstm_hidden_size=args.lstm_hidden_size,
-        lstm_layers=args.lstm_layers,
-        dropout=0.0  # No dropout during evaluation
+        lstm_layers=args.lstm_layers
     )
     
-    checkpoint = torch.load(args.checkpoint, map_location='cpu')
-    if 'state_dict' in checkpoint:
-        state_dict = checkpoint['state_dict']
-        # Remove 'model.' prefix if it exists (from Lightning checkpoint)
-        state_dict = {k.replace('model.', ''): v for k, v in state_dict.items()}
-    else:
-        state_dict = checkpoint
-    model.load_state_dict(state_dict)
+    if isinstance(model, torch.jit.ScriptModule) and args.precision != "fp32":
+        parser.error("Exported models run at the precision they were exported with, use --precision fp32")
     
     device = torch.device('cuda' if args.gpu and torch.cuda.is_available() else 'cpu')
     model = model.to(device)
-    model.eval()
     
     # Setup metrics
     metrics = TextRecognitionMetrics(char_map, cer_trim=args.cer_trim)
     
-    # Evaluate
-    all_predictions = []
-    all_targets = []
-    
-    with torch.no_grad():
-        for batch in tqdm(loader, desc="Evaluating"):
-            images, texts, input_lengths, text_lengths = batch
-            images = images.to(device)
-            
-            # Forward pass
-            outputs = model(images)
-            outputs = torch.nn.functional.log_softmax(outputs, dim=2)
-            outputs = outputs.transpose(0, 1)  # (T, B, C)
-            
-            # Get target texts
-            target_texts = []
-            for text, length in zip(texts, text_lengths):
-                target_texts.append(''.join([metrics.idx_to_char[i.item()] for i in text[:length]]))
-            
-            # Decode predictions
-            predictions = metrics.decode_predictions(outputs)
-            
-            all_predictions.extend(predictions)
-            all_targets.extend(target_texts)
-    
-    # Compute metrics
-    results = metrics(outputs, all_targets)  # Just for the last batch metrics
-    total_cer = metrics.compute_cer(all_predictions, all_targets)
-    total_wer = metrics.compute_wer(all_predictions, all_targets)
+    # Baseline, before converting the model
+    if args.compare_fp32:
+        fp32 = evaluate_model(model, tqdm(loader, desc="Evaluating fp32"), metrics, device)
+    
+    model = prepare_model(model, device, channels_last=args.channels_last, compile=args.compile)
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    
+    # Setup decoder
+    if args.decoder == "beam":
+        decoder = CTCBeamSearchDecoder(
+            char_map,
+            beam_width=args.beam_width,
+            top_k=args.beam_top_k,
+            prune_threshold=args.beam_prune_threshold,
+            lm=NGramLM.from_arpa(args.lm) if args.lm else None,
+            lm_unit=args.lm_unit,
+            lm_weight=args.lm_weight,
+            insertion_bonus=args.insertion_bonus,
+            space_token=args.lm_space_token,
+            num_workers=args.decoder_workers
+        )
+    else:
+        decoder = metrics
+    
+    # Evaluate, accumulating edit operations (and writing predictions) as we go
+    char_errors = EditOperationCounts()
+    word_errors = EditOperationCounts()
+    output = open(args.output_file, 'w', encoding='utf-8') if args.output_file else None
+    if output:
+        output.write('[')
+    num_lines = 0
+    elapsed = 0.0
+    
+    try:
+        with inference_context(device, args.precision):
+            for batch in tqdm(loader, desc="Evaluating"):
+                images, texts, widths, text_lengths = batch
+                start = time.perf_counter()
+                images = normalize_images(images.to(device)).contiguous(memory_format=memory_format)
+                widths = widths.to(device)
+                
+                # Forward pass
+                outputs = model(images, widths)
+                input_lengths = model.get_output_lengths(widths)
+                outputs = torch.nn.functional.log_softmax(outputs.float(), dim=2)
+                outputs = outputs.transpose(0, 1)  # (T, B, C)
+                
+                # Decode predictions
+                if args.decoder == "beam":
+                    predictions = decoder.decode_predictions(outputs, input_lengths)
+                    labels, lengths = metrics.encode_strings(predictions, device=device)
+                else:
+                    labels, lengths = metrics.greedy_decode(outputs, input_lengths)
+                    predictions = metrics.labels_to_strings(labels, lengths)
+                elapsed += time.perf_counter() - start
+                target_texts = metrics.labels_to_strings(texts, text_lengths)
+                
+                operations = metrics.edit_operations(
+                    labels, lengths, texts, text_lengths,
+                    predictions=predictions, target_texts=target_texts
+                )
+                char_errors.update(*operations['char'])
+                word_errors.update(*operations['word'])
+                
+                if output:
+                    for pred, target in zip(predictions, target_texts):
+                        item = json.dumps({'prediction': pred, 'target': target}, ensure_ascii=False)
+                        output.write(f"{',' if num_lines else ''}\n  {item}")
+                        num_lines += 1
+    finally:
+        # Stop the decoding workers even if the evaluation fails
+        if args.decoder == "beam":
+            decoder.close()
+    
+    # Compute corpus metrics
+    cer = char_errors.compute()
+    wer = word_errors.compute()
     
     print(f"\nResults:")
-    print(f"Character Error Rate: {total_cer:.4f}")
-    print(f"Word Error Rate: {total_wer:.4f}")
-    
-    # Save predictions if requested
-    if args.output_file:
-        output_data = []
-        for pred, target in zip(all_predictions, all_targets):
-            output_data.append({
-                'prediction': pred,
-                'target': target
-            })
-        
-        with open(args.output_file, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
-            print(f"\nPredictions saved to {args.output_file}")
+    print(f"Character Error Rate: {cer['rate']:.4f} "
+          f"(sub {cer['sub']:.4f}, del {cer['del']:.4f}, ins {cer['ins']:.4f})")
+    print(f"Word Error Rate: {wer['rate']:.4f} "
+          f"(sub {wer['sub']:.4f}, del {wer['del']:.4f}, ins {wer['ins']:.4f})")
+    
+    if args.compare_fp32:
+        lines_per_second = len(dataset) / elapsed if elapsed > 0 else 0.0
+        print(f"\n{'':>10} {'CER':>8} {'WER':>8} {'lines/s':>10}")
+        print(f"{'fp32':>10} {fp32['cer']:8.4f} {fp32['wer']:8.4f} {fp32['lines_per_second']:10.1f}")
+        print(f"{args.precision:>10} {cer['rate']:8.4f} {wer['rate']:8.4f} {lines_per_second:10.1f}")
+        print(f"CER drift: {cer['rate'] - fp32['cer']:+.4f}, "
+              f"speedup: {lines_per_second / max(fp32['lines_per_second'], 1e-9):.2f}x")
+    
+    if output:
+        output.write('\n]\n')
+        output.close()
+        print(f"\nPredictions saved to {args.output_file}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import copy
+import json
+import sys
+from itertools import islice
+from torch.utils.data import DataLoader
+
+from laia.models.crnn import CRNN
+from laia.data.handwriting_dataset import HandwritingDataset
+from laia.inference.export import (
+    evaluate_model,
+    fold_batch_norm,
+    load_model,
+    quantize_cnn_static,
+    quantize_dynamic,
+    to_torchscript,
+)
+from laia.utils.metrics import TextRecognitionMetrics
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an optimized TorchScript model for CPU inference")
+
+    parser.add_argument("--checkpoint", type=str, required=True, help="Model checkpoint to export")
+    parser.add_argument("--char_map", type=str, required=True, help="Character map JSON file")
+    parser.add_argument("--output", type=str, required=True, help="Output TorchScript file")
+    parser.add_argument("--no_fold_bn", action="store_true", help="Do not fold BatchNorm layers into convolutions")
+    parser.add_argument("--quantize", type=str, default="dynamic", choices=["none", "dynamic", "static"],
+                        help="'dynamic' quantizes the LSTM and classifier to int8, "
+                             "'static' also quantizes the convolutions (requires --calibration_gt)")
+    parser.add_argument("--data_dir", type=str, default=None, help="Directory containing images")
+    parser.add_argument("--calibration_gt", type=str, default=None, help="Ground truth file used for static calibration")
+    parser.add_argument("--num_calibration_batches", type=int, default=32, help="Number of calibration batches")
+    parser.add_argument("--eval_gt", type=str, default=None,
+                        help="If given, report the CER of the exported model versus the fp32 model on this set")
+    parser.add_argument("--max_cer_delta", type=float, default=None,
+                        help="Exit with an error (and do not write the model) if the CER increases more than this")
+    parser.add_argument("--img_height", type=int, default=64, help="Input image height")
+    parser.add_argument("--max_width", type=int, default=None, help="Max input image width")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of data loading workers")
+
+    parser = CRNN.add_model_specific_args(parser)
+    args = parser.parse_args()
+
+    if args.quantize == "static" and not args.calibration_gt:
+        parser.error("--quantize static requires --calibration_gt")
+    if (args.calibration_gt or args.eval_gt) and not args.data_dir:
+        parser.error("--data_dir is required with --calibration_gt or --eval_gt")
+
+    with open(args.char_map, 'r', encoding='utf-8') as f:
+        char_map = json.load(f)
+
+    def make_loader(gt_file):
+        dataset = HandwritingDataset(
+            args.data_dir,
+            gt_file,
+            char_map,
+            img_height=args.img_height,
+            max_width=args.max_width
+        )
+        return DataLoader(
+            dataset,
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_workers=args.num_workers,
+            collate_fn=HandwritingDataset.collate_fn
+        )
+
+    model = load_model(
+        args.checkpoint,
+        num_classes=len(char_map),
+        cnn_output_size=args.cnn_output_size,
+        lstm_hidden_size=args.lstm_hidden_size,
+        lstm_layers=args.lstm_layers
+    )
+    if not isinstance(model, CRNN):
+        parser.error(f"{args.checkpoint} is already an exported model")
+    reference = copy.deepcopy(model)
+
+    if args.quantize == "static":
+        calibration = (batch[0] for batch in islice(make_loader(args.calibration_gt), args.num_calibration_batches))
+        model = quantize_cnn_static(model, calibration)
+    elif not args.no_fold_bn:
+        model = fold_batch_norm(model)
+    if args.quantize in ("dynamic", "static"):
+        model = quantize_dynamic(model)
+
+    scripted = to_torchscript(model)
+
+    if args.eval_gt:
+        metrics = TextRecognitionMetrics(char_map)
+        loader = make_loader(args.eval_gt)
+        fp32 = evaluate_model(reference, loader, metrics)
+        exported = evaluate_model(scripted, loader, metrics)
+        cer_delta = exported['cer'] - fp32['cer']
+
+        print(f"{'':>10} {'CER':>8} {'WER':>8} {'lines/s':>10}")
+        print(f"{'fp32':>10} {fp32['cer']:8.4f} {fp32['wer']:8.4f} {fp32['lines_per_second']:10.1f}")
+        print(f"{'exported':>10} {exported['cer']:8.4f} {exported['wer']:8.4f} {exported['lines_per_second']:10.1f}")
+        print(f"CER delta: {cer_delta:+.4f}, "
+              f"speedup: {exported['lines_per_second'] / max(fp32['lines_per_second'], 1e-9):.2f}x")
+
+        if args.max_cer_delta is not None and cer_delta > args.max_cer_delta:
+            print(f"Rejected: CER delta {cer_delta:+.4f} exceeds {args.max_cer_delta}", file=sys.stderr)
+            sys.exit(1)
+
+    scripted.save(args.output)
+    print(f"Exported model saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
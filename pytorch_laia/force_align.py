@@ -0,0 +1,171 @@
+import argparse
+import sys
+import torch
+import json
+from pathlib import Path
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from laia.models.crnn import CRNN
+from laia.inference.export import load_model
+from laia.data.collate import normalize_images
+from laia.data.handwriting_dataset import HandwritingDataset
+from laia.decoding import force_align
+
+class _IndexedDataset(Dataset):
+    """Wraps a HandwritingDataset so that each sample also returns its index."""
+    def __init__(self, dataset: HandwritingDataset):
+        self.dataset = dataset
+        
+    def __len__(self) -> int:
+        return len(self.dataset)
+        
+    def __getitem__(self, idx: int):
+        return (*self.dataset[idx], idx)
+    
+    @staticmethod
+    def collate_fn(batch):
+        # Same (stable) ordering as HandwritingDataset.collate_fn
+        batch = sorted(batch, key=lambda x: x[2], reverse=True)
+        indices = [x[3] for x in batch]
+        return HandwritingDataset.collate_fn([x[:3] for x in batch]), indices
+
+def open_output(path: str):
+    return sys.stdout if path == '-' else open(path, 'w', encoding='utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description="Force-align transcripts to handwritten text images")
+    
+    parser.add_argument("--data_dir", type=str, required=True, help="Directory containing images")
+    parser.add_argument("--gt_file", type=str, required=True, help="Ground truth file with the transcripts to align")
+    parser.add_argument("--char_map", type=str, required=True, help="Character map JSON file")
+    parser.add_argument("--checkpoint", type=str, required=True, help="Model checkpoint")
+    parser.add_argument("--output_align", type=str, default="-",
+                        help="Output file with the frame-level alignments ('-' for stdout)")
+    parser.add_argument("--output_spans", type=str, default=None,
+                        help="Output JSONL file with the frame span and confidence of each character")
+    parser.add_argument("--output_prior", type=str, default=None, help="Output file with the label priors")
+    parser.add_argument("--smoothing_additive", type=float, default=0.0,
+                        help="If > 0, adds this amount to all labels for prior computation")
+    parser.add_argument("--skip_alignments", action="store_true", help="Do not output the frame-level alignments")
+    parser.add_argument("--zero_based", action="store_true",
+                        help="Write 0-based label ids (blank = 0) in the alignments and priors, instead of the "
+                        "1-based ids of laia-force-align (blank = 1)")
+    parser.add_argument("--img_height", type=int, default=64, help="Input image height")
+    parser.add_argument("--max_width", type=int, default=None, help="Max input image width")
+    parser.add_argument("--packed_store", type=str, default=None, help="Packed store prefix for gt_file (see pack_data.py)")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of data loading workers")
+    parser.add_argument("--gpu", action="store_true", help="Use GPU for inference")
+    
+    parser = CRNN.add_model_specific_args(parser)
+    args = parser.parse_args()
+    
+    with open(args.char_map, 'r', encoding='utf-8') as f:
+        char_map = json.load(f)
+    
+    dataset = HandwritingDataset(
+        args.data_dir,
+        args.gt_file,
+        char_map,
+        img_height=args.img_height,
+        max_width=args.max_width,
+        packed_store=args.packed_store
+    )
+    
+    loader = DataLoader(
+        _IndexedDataset(dataset),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        collate_fn=_IndexedDataset.collate_fn,
+        pin_memory=True
+    )
+    
+    model = load_model(
+        args.checkpoint,
+        num_classes=len(char_map),
+        cnn_output_size=args.cnn_output_size,
+        lstm_hidden_size=args.lstm_hidden_size,
+        lstm_layers=args.lstm_layers
+    )
+    
+    device = torch.device('cuda' if args.gpu and torch.cuda.is_available() else 'cpu')
+    model = model.to(device)
+    
+    output_align = None if args.skip_alignments else open_output(args.output_align)
+    output_spans = open_output(args.output_spans) if args.output_spans else None
+    prior_count = None
+    # laia-force-align writes Torch (1-based) label ids
+    label_offset = 0 if args.zero_based else 1
+    
+    with torch.no_grad():
+        for (images, texts, widths, text_lengths), indices in tqdm(loader, desc="Aligning", file=sys.stderr):
+            widths = widths.to(device)
+            outputs = model(normalize_images(images.to(device)), widths)
+            input_lengths = model.get_output_lengths(widths)
+            outputs = torch.nn.functional.log_softmax(outputs, dim=2).transpose(0, 1)  # (T, B, C)
+            
+            if args.output_prior is not None:
+                frames = torch.arange(outputs.size(0), device=device).unsqueeze(1) < input_lengths.to(device)
+                counts = (outputs.exp() * frames.unsqueeze(2)).sum(dim=(0, 1))
+                prior_count = counts if prior_count is None else prior_count + counts
+            
+            if output_align is None and output_spans is None:
+                continue
+            
+            alignment = force_align(outputs, texts, input_lengths, text_lengths)
+            # Single transfer to host
+            alignment = type(alignment)(*(x.cpu() for x in alignment))
+            
+            for b, idx in enumerate(indices):
+                sample_id = Path(dataset.manifest.images[idx]).stem
+                num_frames, num_labels = int(input_lengths[b]), int(text_lengths[b])
+                if alignment.score[b] == float('-inf'):
+                    print(f"Warning: sample {sample_id} cannot be aligned "
+                          f"({num_labels} labels in {num_frames} frames)", file=sys.stderr)
+                
+                if output_align is not None:
+                    labels = alignment.frame_labels[b, :num_frames].tolist()
+                    output_align.write(' '.join([sample_id] + [str(l + label_offset) for l in labels]) + '\n')
+                
+                if output_spans is not None:
+                    text = dataset.manifest.texts[idx]
+                    spans = [
+                        {
+                            'char': text[k],
+                            'start': int(alignment.label_start[b, k]),
+                            'end': int(alignment.label_end[b, k]),
+                            'confidence': round(float(alignment.label_confidence[b, k]), 6)
+                        }
+                        for k in range(num_labels)
+                    ]
+                    output_spans.write(json.dumps({
+                        'id': sample_id,
+                        'image': dataset.manifest.images[idx],
+                        'num_frames': num_frames,
+                        'score': float(alignment.score[b]),
+                        'spans': spans
+                    }, ensure_ascii=False) + '\n')
+    
+    for f in (output_align, output_spans):
+        if f is not None and f is not sys.stdout:
+            f.close()
+    
+    # Output priors and total counts
+    if prior_count is not None:
+        prior_count = prior_count.cpu()
+        prior_total = prior_count.sum().item()
+        num_labels = prior_count.size(0)
+        output_prior = open_output(args.output_prior)
+        for n, count in enumerate(prior_count.tolist()):
+            if args.smoothing_additive > 0:
+                prior = (args.smoothing_additive + count) / (num_labels * args.smoothing_additive + prior_total)
+            else:
+                prior = count / prior_total
+            output_prior.write(f"{n + label_offset}\t{count:.6f}\t{prior_total:.0f}\t{prior:.10e}\n")
+        if output_prior is not sys.stdout:
+            output_prior.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
 import torch
 from torch.utils.data import Dataset
-from PIL import Image
-import os
+import numpy as np
 from typing import List, Tuple, Dict, Optional
-import json
 from pathlib import Path
 
+from .collate import pad_batch
+from .image_cache import ImageCache, cache_key
+from .image_io import load_line_image, line_image_width
+from .manifest import SampleManifest
+from .packed_store import PackedLineStore
+
 class HandwritingDataset(Dataset):
     def __init__(
         self,
@@ -14,31 +18,106 @@ class HandwritingDataset(Dataset):
         char_map: Dict[str, int],
         transform=None,
         img_height: int = 64,
-        max_width: Optional[int] = None
+        max_width: Optional[int] = None,
+        packed_store: Optional[str] = None,
+        cache: Optional[ImageCache] = None,
+        normalize: bool = True,
+        fast_decode: bool = False
     ):
         """
         Dataset for handwritten text recognition.
         
         Args:
             data_dir: Directory containing the images
-            gt_file: Path to ground truth file (JSON format with "image" and "text" fields)
+            gt_file: Path to ground truth file (JSON or JSON Lines with "image"
+                and "text" fields, see read_samples), or to a binary index of
+                one (see SampleManifest.save)
             char_map: Dictionary mapping characters to indices
             transform: Optional transform to be applied to images
             img_height: Height to resize images to (maintaining aspect ratio)
             max_width: Maximum width of images after resizing (None for no limit)
+            packed_store: Optional prefix of a packed line store (see pack_data.py)
+                built from the same gt_file; images are then read from it
+                instead of being decoded from data_dir
+            cache: Optional cache of decoded and resized images (ignored
+                when packed_store is given)
+            normalize: Return float images in [0, 1]. If False, images are
+                returned as uint8 (4x smaller to collate and transfer), and
+                must be normalized on the device with normalize_images
+            fast_decode: Downscale while decoding when the format allows it
+                (see load_line_image; ignored when packed_store is given)
         """
         self.data_dir = Path(data_dir)
         self.transform = transform
         self.img_height = img_height
         self.max_width = max_width
         self.char_map = char_map
+        self.cache = cache
+        self.normalize = normalize
+        self.fast_decode = fast_decode
         
-        # Load ground truth
-        with open(gt_file, 'r', encoding='utf-8') as f:
-            self.samples = json.load(f)
+        # Load ground truth into compact arrays (shared by forked workers
+        # without copy-on-write), with the transcripts already encoded
+        self.manifest = SampleManifest.read(gt_file, char_map)
+            
+        self.packed = None
+        if packed_store is not None:
+            self.packed = PackedLineStore(packed_store)
+            if len(self.packed) != len(self.manifest):
+                raise ValueError(
+                    f"Packed store {packed_store} has {len(self.packed)} lines, "
+                    f"but {gt_file} has {len(self.manifest)} samples"
+                )
+            if any(name != image for name, image in zip(self.packed.images, self.manifest.images)):
+                raise ValueError(f"Packed store {packed_store} was not built from {gt_file}")
+            if self.packed.img_height != img_height:
+                raise ValueError(
+                    f"Packed store {packed_store} was built with img_height="
+                    f"{self.packed.img_height}, expected {img_height}"
+                )
+            if self.packed.max_width != (max_width or None):
+                raise ValueError(
+                    f"Packed store {packed_store} was built with max_width="
+                    f"{self.packed.max_width}, expected {max_width}"
+                )
             
     def __len__(self) -> int:
-        return len(self.samples)
+        return len(self.manifest)
+        
+    def get_widths(self) -> np.ndarray:
+        """
+        Width of each sample after resizing, without decoding the images.
+        
+        Uses the image sizes of the ground truth file if they are recorded
+        (see prepare_data.py), and otherwise reads the image headers.
+        """
+        if self.packed is not None:
+            return self.packed.widths.astype(np.int64)
+        manifest = self.manifest
+        known = manifest.has_sizes
+        widths = np.empty(len(manifest), dtype=np.int64)
+        # Same computation as resized_width, vectorized
+        widths[known] = manifest.widths[known] * (self.img_height / manifest.heights[known])
+        if self.max_width:
+            widths[known] = np.minimum(widths[known], self.max_width)
+        for i in np.flatnonzero(~known):
+            widths[i] = line_image_width(self.data_dir / manifest.images[i], self.img_height, self.max_width)
+        return widths
+        
+    def get_text_lengths(self) -> np.ndarray:
+        """Length of the transcript of each sample."""
+        return self.manifest.target_lengths.astype(np.int64)
+        
+    def load_image(self, img_path: Path) -> np.ndarray:
+        """Load a resized uint8 image, going through the cache if there is one."""
+        if self.cache is None:
+            return load_line_image(img_path, self.img_height, self.max_width, self.fast_decode)
+        key = cache_key(img_path, self.img_height, self.max_width, self.fast_decode)
+        img = self.cache.get(key)
+        if img is None:
+            img = load_line_image(img_path, self.img_height, self.max_width, self.fast_decode)
+            self.cache.put(key, img)
+        return img
         
     def encode_text(self, text: str) -> torch.Tensor:
         """Convert text string to tensor of character indices."""
@@ -47,61 +126,42 @@ class HandwritingDataset(Dataset):
     def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor, int]:
         """
         Returns:
-            image: Tensor of shape (C, H, W)
+            image: Tensor of shape (C, H, W), float or uint8 (see normalize)
             text: Tensor of encoded characters
             width: Original width of image (used for CTC input length)
         """
-        sample = self.samples[idx]
-        img_path = self.data_dir / sample["image"]
+        if self.packed is not None:
+            # Pre-resized view into the packed store (no decoding)
+            img = self.packed[idx]
+        else:
+            img = self.load_image(self.data_dir / self.manifest.images[idx])
+        new_width = img.shape[1]
         
-        # Load and convert to grayscale
-        img = Image.open(img_path).convert('L')
-        width = img.width
-        
-        # Resize maintaining aspect ratio
-        ratio = self.img_height / img.height
-        new_width = int(width * ratio)
-        if self.max_width:
-            new_width = min(new_width, self.max_width)
-        img = img.resize((new_width, self.img_height), Image.Resampling.BILINEAR)
-        
-        # Convert to tensor
-        img = torch.FloatTensor(list(img.getdata())).view(1, self.img_height, new_width)
-        img = img / 255.0  # Normalize to [0, 1]
+        # Convert to tensor (copying, since packed and cached images are shared)
+        if self.normalize:
+            img = torch.from_numpy(img.astype(np.float32)).view(1, self.img_height, new_width)
+            img = img / 255.0  # Normalize to [0, 1]
+        else:
+            img = torch.from_numpy(np.array(img, dtype=np.uint8)).view(1, self.img_height, new_width)
         
         if self.transform:
             img = self.transform(img)
             
-        # Encode text
-        text = self.encode_text(sample["text"])
+        # Pre-encoded text
+        text = torch.from_numpy(self.manifest.target(idx).astype(np.int64))
         
         return img, text, new_width
         
     @staticmethod
     def collate_fn(batch: List[Tuple[torch.Tensor, torch.Tensor, int]]):
-        """Custom collate function for DataLoader that handles variable width images."""
+        """
+        Custom collate function for DataLoader that handles variable width images
+        (see PaddedBatchCollator for a version that reuses its buffers).
+        """
         # Sort by width for more efficient batching
-        batch.sort(key=lambda x: x[2], reverse=True)
+        batch = sorted(batch, key=lambda x: x[2], reverse=True)
         images, texts, widths = zip(*batch)
         
-        # Pad images to max width in batch
-        max_width = max(widths)
-        batch_size = len(images)
-        height = images[0].size(1)
-        padded_images = torch.zeros(batch_size, 1, height, max_width)
-        
-        for i, img in enumerate(images):
-            padded_images[i, :, :, :img.size(2)] = img
-            
-        # Prepare for CTC loss
-        text_lengths = torch.tensor([len(t) for t in texts])
-        max_text_length = text_lengths.max()
-        padded_texts = torch.zeros(batch_size, max_text_length, dtype=torch.long)
-        
-        for i, text in enumerate(texts):
-            padded_texts[i, :len(text)] = text
-            
-        # Calculate input lengths for CTC (assuming model reduces width by factor of 4)
-        input_lengths = torch.tensor([w // 4 for w in widths])
-        
-        return padded_images, padded_texts, input_lengths, text_lengths 
\ No newline at end of file
+        # Padded images and texts (see CRNN.get_output_lengths for the CTC
+        # input lengths from the unpadded image widths)
+        return pad_batch(images, texts, widths)
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from typing import Hashable, Optional, Tuple, Union
+
+def cache_key(
+    img_path: Union[str, Path],
+    img_height: int,
+    max_width: Optional[int] = None,
+    fast_decode: bool = False
+) -> Tuple:
+    """Key of a resized image: its path, modification time, target size and decoding mode."""
+    key = (str(img_path), os.stat(img_path).st_mtime_ns, img_height, max_width or 0)
+    # Images decoded with fast_decode are slightly different
+    return key + ('fast',) if fast_decode else key
+
+class ImageCache:
+    def __init__(self, max_bytes: int):
+        """
+        In-process cache of decoded and resized uint8 line images.
+
+        Entries are evicted in least recently used order once the total size
+        of the cached images exceeds max_bytes. Each process (e.g. each
+        DataLoader worker) has its own cache; use SharedImageCache to share
+        entries across processes.
+
+        Args:
+            max_bytes: Maximum total size of the cached images
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[Hashable, np.ndarray]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        img = self._entries.get(key)
+        if img is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return img
+
+    def put(self, key: Hashable, img: np.ndarray):
+        if img.nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.num_bytes -= old.nbytes
+        self._entries[key] = img
+        self.num_bytes += img.nbytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+
+class SharedImageCache(ImageCache):
+    def __init__(self, max_bytes: int, cache_dir: Optional[str] = None):
+        """
+        Cache of resized uint8 line images shared by several processes.
+
+        Each image is stored as a raw file in cache_dir (by default under
+        /dev/shm, i.e. in RAM), named after a hash of its key, and written
+        atomically so that concurrent readers never see partial entries.
+        Reading an entry touches its modification time; when a process has
+        written enough new data, it rescans the directory and removes the
+        least recently used files until the total size is below max_bytes.
+
+        Args:
+            max_bytes: Maximum total size of the cached images
+            cache_dir: Directory used to store the entries
+        """
+        super().__init__(max_bytes)
+        if cache_dir is None:
+            base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            cache_dir = os.path.join(base, 'laia-image-cache')
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Rescan after writing this many bytes (or when the budget may be exceeded)
+        self._scan_every = max(1, max_bytes // 20)
+        self._written = 0
+
+    def __len__(self) -> int:
+        return sum(1 for e in os.scandir(self.cache_dir) if e.name.endswith('.img'))
+
+    def _entry_path(self, key: Hashable) -> Path:
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return self.cache_dir / f'{digest}.img'
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        path = self._entry_path(key)
+        try:
+            data = np.fromfile(path, dtype=np.uint8)
+            os.utime(path)
+        except OSError:
+            # Missing, or evicted by another process in the meantime
+            self.misses += 1
+            return None
+        height, width = data[:8].view(np.int32)
+        self.hits += 1
+        return data[8:].reshape(height, width)
+
+    def put(self, key: Hashable, img: np.ndarray):
+        if img.nbytes > self.max_bytes:
+            return
+        path = self._entry_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(np.asarray(img.shape, dtype=np.int32).tobytes())
+            f.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+        os.replace(tmp_path, path)
+
+        self._written += img.nbytes + 8
+        if self._written >= self._scan_every:
+            self._written = 0
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its budget."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.img'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        self.num_bytes = sum(size for _, size, _ in entries)
+        if self.num_bytes <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            # Leave some room, so that the next scan is not immediately needed
+            if self.num_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self.num_bytes -= size
@@ -0,0 +1,73 @@
+import math
+from PIL import Image
+import numpy as np
+from typing import Optional
+
+def load_line_image(
+    img_path,
+    img_height: int,
+    max_width: Optional[int] = None,
+    fast_decode: bool = False
+) -> np.ndarray:
+    """
+    Load a line image as grayscale and resize it to a fixed height.
+    
+    Args:
+        img_path: Path to the image file
+        img_height: Height to resize the image to (maintaining aspect ratio)
+        max_width: Maximum width of the image after resizing (None for no limit)
+        fast_decode: Downscale while decoding, when the format allows it:
+            JPEG images are decoded at a reduced DCT scale (1/2, 1/4 or 1/8)
+            and JPEG 2000 images at a reduced resolution level, at most 2x
+            larger than the target size. Other formats are decoded at full
+            resolution, then reduced with a fast box filter before the final
+            resampling. The result is slightly different from the default
+            (full resolution) path, but has the same size.
+        
+    Returns:
+        uint8 array of shape (img_height, new_width)
+    """
+    img = Image.open(img_path)
+    
+    # The output size only depends on the original size
+    ratio = img_height / img.height
+    new_width = int(img.width * ratio)
+    if max_width:
+        new_width = min(new_width, max_width)
+    
+    if fast_decode:
+        if img.format == 'JPEG':
+            # Smallest DCT scale whose result is at least the requested size
+            # (also decodes only the luma channel of color images)
+            img.draft('L', (max(1, math.ceil(img.width * ratio)), img_height))
+        elif img.format == 'JPEG2000' and ratio < 1:
+            img.reduce = int(math.log2(1 / ratio))
+            try:
+                img.load()
+            except OSError:
+                # The codestream has fewer resolution levels than requested
+                img = Image.open(img_path)
+    img = img.convert('L')
+    
+    # Resize maintaining aspect ratio
+    img = img.resize(
+        (new_width, img_height), Image.Resampling.BILINEAR,
+        reducing_gap=2.0 if fast_decode else None
+    )
+    
+    return np.asarray(img, dtype=np.uint8)
+
+def line_image_width(img_path, img_height: int, max_width: Optional[int] = None) -> int:
+    """
+    Width of a line image after load_line_image, reading only the image header.
+    """
+    with Image.open(img_path) as img:
+        width, height = img.size
+    return resized_width(width, height, img_height, max_width)
+
+def resized_width(width: int, height: int, img_height: int, max_width: Optional[int] = None) -> int:
+    """Width of a width x height image after load_line_image."""
+    new_width = int(width * (img_height / height))
+    if max_width:
+        new_width = min(new_width, max_width)
+    return new_width
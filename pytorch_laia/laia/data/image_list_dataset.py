@@ -0,0 +1,140 @@
+import torch
+from torch.utils.data import Dataset
+import numpy as np
+import os
+import sys
+from itertools import islice
+from typing import Iterator, List, Optional, Tuple, Union
+from pathlib import Path
+
+from .image_io import load_line_image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.gif', '.webp')
+
+def iter_image_paths(source: str, extensions=IMAGE_EXTENSIONS) -> Iterator[str]:
+    """
+    Lazily list the images of a source without loading the whole list.
+
+    Args:
+        source: A directory (searched recursively for image files), a file
+            with one image path per line, or '-' to read paths from stdin
+        extensions: File extensions considered as images in directories
+    """
+    if source == '-':
+        lines = sys.stdin
+    elif os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    yield os.path.join(root, name)
+        return
+    else:
+        lines = open(source, 'r', encoding='utf-8')
+
+    try:
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+class ImagePathBatches:
+    def __init__(self, source: str, batch_size: int, extensions=IMAGE_EXTENSIONS):
+        """
+        Batches of image paths read lazily from a source, to be used as the
+        batch_sampler of an ImageListDataset without image_paths.
+
+        The paths are read in the main process as the DataLoader requests new
+        batches, so a single DataLoader (and its workers) serves the whole
+        input, however long, and sources like stdin are only read once.
+
+        Args:
+            source: Source of the image paths (see iter_image_paths)
+            batch_size: Number of paths per batch
+            extensions: File extensions considered as images in directories
+        """
+        self.source = source
+        self.batch_size = batch_size
+        self.extensions = extensions
+
+    def __iter__(self) -> Iterator[List[str]]:
+        paths = iter_image_paths(self.source, self.extensions)
+        while True:
+            batch = list(islice(paths, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+class ImageListDataset(Dataset):
+    def __init__(
+        self,
+        image_paths: Optional[List[str]] = None,
+        data_dir: Optional[str] = None,
+        img_height: int = 64,
+        max_width: Optional[int] = None,
+        fast_decode: bool = False
+    ):
+        """
+        Dataset of unlabeled line images, used for inference.
+
+        Args:
+            image_paths: Paths of the images, or None to index the dataset
+                by image path instead (see ImagePathBatches)
+            data_dir: Optional directory that relative paths are resolved against
+            img_height: Height to resize images to (maintaining aspect ratio)
+            max_width: Maximum width of images after resizing (None for no limit)
+            fast_decode: Downscale while decoding when the format allows it (see load_line_image)
+        """
+        self.image_paths = image_paths
+        self.data_dir = Path(data_dir) if data_dir else None
+        self.img_height = img_height
+        self.max_width = max_width
+        self.fast_decode = fast_decode
+
+    def __len__(self) -> int:
+        if self.image_paths is None:
+            raise TypeError("ImageListDataset indexed by image path has no length")
+        return len(self.image_paths)
+
+    def __getitem__(self, idx: Union[int, str]) -> Optional[Tuple[torch.Tensor, int, Union[int, str]]]:
+        """
+        Returns:
+            image: Tensor of shape (C, H, W)
+            width: Width of the resized image
+            idx: Index of the sample (its path without image_paths)
+            or None if the image could not be loaded
+        """
+        img_path = self.image_paths[idx] if self.image_paths is not None else idx
+        if self.data_dir is not None:
+            img_path = self.data_dir / img_path
+        try:
+            img = load_line_image(img_path, self.img_height, self.max_width, self.fast_decode)
+        except Exception as e:
+            print(f"Warning: Could not open image {img_path}: {e}", file=sys.stderr)
+            return None
+
+        img = torch.from_numpy(img.astype(np.float32)).view(1, self.img_height, img.shape[1])
+        img = img / 255.0  # Normalize to [0, 1]
+        return img, img.size(2), idx
+
+    @staticmethod
+    def collate_fn(batch: List[Optional[Tuple[torch.Tensor, int, Union[int, str]]]]):
+        """Pads a batch of images, keeping the order of the samples."""
+        batch = [x for x in batch if x is not None]
+        if not batch:
+            return None
+        images, widths, indices = zip(*batch)
+
+        max_width = max(widths)
+        height = images[0].size(1)
+        padded_images = torch.zeros(len(images), 1, height, max_width)
+        for i, img in enumerate(images):
+            padded_images[i, :, :, :img.size(2)] = img
+
+        # Unpadded image widths (see CRNN.get_output_lengths for the CTC input lengths)
+        widths = torch.tensor(widths)
+
+        return padded_images, widths, list(indices)
@@ -0,0 +1,202 @@
+import json
+import os
+import numpy as np
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+def read_samples(path: Union[str, Path]) -> List[Dict]:
+    """
+    Read a ground truth file.
+
+    Two formats are supported: a JSON list of samples, and JSON Lines (one
+    sample per line, as written by prepare_data.py), detected by the
+    ``.jsonl`` extension. Each sample has at least "image" and "text" fields,
+    and optionally the "width" and "height" of the image in pixels.
+    """
+    path = Path(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.suffix != '.jsonl':
+            return json.load(f)
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_samples(path: Union[str, Path], samples: Iterable[Dict]):
+    """
+    Write a ground truth file, as JSON Lines if its extension is ``.jsonl``
+    and as a JSON list otherwise.
+
+    The file is replaced atomically, so that readers never see a partially
+    written file.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        if path.suffix == '.jsonl':
+            for sample in samples:
+                f.write(json.dumps(sample, ensure_ascii=False) + '\n')
+        else:
+            json.dump(list(samples), f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+class StringArray:
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        """
+        Immutable array of strings stored as a single UTF-8 buffer plus offsets.
+
+        Unlike a list of str, it holds no Python objects, so forked DataLoader
+        workers reading it do not touch (and copy) its memory pages.
+
+        Args:
+            data: uint8 array with the concatenated UTF-8 encoded strings
+            offsets: int64 array of shape (N + 1,) with the start of each string
+                in data (and the end of the last one)
+        """
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+class SampleManifest:
+    def __init__(
+        self,
+        images: StringArray,
+        texts: StringArray,
+        targets: np.ndarray,
+        target_offsets: np.ndarray,
+        widths: np.ndarray,
+        heights: np.ndarray,
+        char_map: Dict[str, int]
+    ):
+        """
+        Compact, array-backed list of samples of a ground truth file.
+
+        Image paths and transcripts are kept as StringArray, transcripts are
+        also pre-encoded with char_map into a flat int32 array with offsets,
+        and image sizes (when recorded in the ground truth file) are int32
+        arrays (-1 if unknown). Indexing returns a dict like the samples of
+        the ground truth file, created on the fly.
+
+        Use SampleManifest.read to build it from a ground truth file, and
+        save/load to store it as a binary index (``.npz``) that loads without
+        parsing any JSON.
+        """
+        self.images = images
+        self.texts = texts
+        self.targets = targets
+        self.target_offsets = target_offsets
+        self.widths = widths
+        self.heights = heights
+        self.char_map = char_map
+
+    @classmethod
+    def from_samples(cls, samples: Iterable[Dict], char_map: Dict[str, int]) -> 'SampleManifest':
+        """Build a manifest from samples, encoding unknown characters as 0."""
+        images, texts = bytearray(), bytearray()
+        image_offsets, text_offsets, target_offsets = array('q', [0]), array('q', [0]), array('q', [0])
+        targets, widths, heights = array('i'), array('i'), array('i')
+        for sample in samples:
+            images += sample["image"].encode('utf-8')
+            image_offsets.append(len(images))
+            texts += sample["text"].encode('utf-8')
+            text_offsets.append(len(texts))
+            targets.extend(char_map.get(c, 0) for c in sample["text"])
+            target_offsets.append(len(targets))
+            widths.append(sample.get("width", -1))
+            heights.append(sample.get("height", -1))
+        return cls(
+            StringArray(np.frombuffer(bytes(images), dtype=np.uint8), np.frombuffer(image_offsets, dtype=np.int64)),
+            StringArray(np.frombuffer(bytes(texts), dtype=np.uint8), np.frombuffer(text_offsets, dtype=np.int64)),
+            np.frombuffer(targets, dtype=np.int32),
+            np.frombuffer(target_offsets, dtype=np.int64),
+            np.frombuffer(widths, dtype=np.int32),
+            np.frombuffer(heights, dtype=np.int32),
+            dict(char_map)
+        )
+
+    @classmethod
+    def read(cls, path: Union[str, Path], char_map: Dict[str, int]) -> 'SampleManifest':
+        """
+        Build a manifest from a ground truth file (JSON or JSON Lines, see
+        read_samples), or load it from a binary index (``.npz``, see save).
+
+        JSON Lines files are parsed one line at a time, so the samples are
+        never all held as Python objects.
+        """
+        path = Path(path)
+        if path.suffix == '.npz':
+            return cls.load(path, char_map)
+        if path.suffix != '.jsonl':
+            return cls.from_samples(read_samples(path), char_map)
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_samples((json.loads(line) for line in f if line.strip()), char_map)
+
+    def save(self, path: Union[str, Path]):
+        """Save as a binary index (an uncompressed ``.npz`` file)."""
+        np.savez(
+            path,
+            images=self.images.data, image_offsets=self.images.offsets,
+            texts=self.texts.data, text_offsets=self.texts.offsets,
+            targets=self.targets, target_offsets=self.target_offsets,
+            widths=self.widths, heights=self.heights,
+            char_map=np.array(json.dumps(self.char_map, ensure_ascii=False))
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path], char_map: Optional[Dict[str, int]] = None) -> 'SampleManifest':
+        """
+        Load a binary index written by save.
+
+        If char_map differs from the one the index was saved with, the
+        targets are encoded again with char_map.
+        """
+        with np.load(path) as index:
+            manifest = cls(
+                StringArray(index['images'], index['image_offsets']),
+                StringArray(index['texts'], index['text_offsets']),
+                index['targets'], index['target_offsets'],
+                index['widths'], index['heights'],
+                json.loads(str(index['char_map']))
+            )
+        if char_map is not None and char_map != manifest.char_map:
+            manifest = manifest.encode(char_map)
+        return manifest
+
+    def encode(self, char_map: Dict[str, int]) -> 'SampleManifest':
+        """A copy of this manifest with the transcripts encoded with another character map."""
+        targets = array('i')
+        for text in self.texts:
+            targets.extend(char_map.get(c, 0) for c in text)
+        return type(self)(
+            self.images, self.texts, np.frombuffer(targets, dtype=np.int32), self.target_offsets,
+            self.widths, self.heights, dict(char_map)
+        )
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __getitem__(self, idx: int) -> Dict:
+        sample = {"image": self.images[idx], "text": self.texts[idx]}
+        if self.widths[idx] >= 0:
+            sample["width"], sample["height"] = int(self.widths[idx]), int(self.heights[idx])
+        return sample
+
+    def target(self, idx: int) -> np.ndarray:
+        """Encoded transcript of a sample (a read-only int32 view)."""
+        return self.targets[self.target_offsets[idx]:self.target_offsets[idx + 1]]
+
+    @property
+    def target_lengths(self) -> np.ndarray:
+        """Length of the transcript of each sample, in characters."""
+        return np.diff(self.target_offsets)
+
+    @property
+    def has_sizes(self) -> np.ndarray:
+        """Whether the image size of each sample is known."""
+        return (self.widths >= 0) & (self.heights > 0)
@@ -0,0 +1,103 @@
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+from .image_io import load_line_image
+
+class PackedLineStore:
+    def __init__(self, prefix: Union[str, Path]):
+        """
+        Read-only store of pre-resized grayscale line images.
+
+        All lines are kept in a single contiguous uint8 file (``<prefix>.bin``),
+        each one stored row-major as (img_height, width). A small index
+        (``<prefix>.index.npz``) holds the byte offset and width of every line.
+        Lines are served as zero-copy views of a memory-mapped file, which is
+        opened lazily so that the store can be shipped to DataLoader workers.
+
+        Args:
+            prefix: Path prefix used when the store was packed
+        """
+        self.prefix = Path(prefix)
+        self.data_file = self.prefix.with_name(self.prefix.name + '.bin')
+        self.index_file = self.prefix.with_name(self.prefix.name + '.index.npz')
+
+        with np.load(self.index_file) as index:
+            self.offsets = index['offsets']
+            self.widths = index['widths']
+            self.images = index['images']
+            self.img_height = int(index['img_height'])
+            self.max_width = int(index['max_width']) or None
+
+        self._data = None
+
+    def __len__(self) -> int:
+        return len(self.widths)
+
+    @property
+    def data(self) -> np.memmap:
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=np.uint8, mode='r')
+        return self._data
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        """Returns a read-only uint8 view of shape (img_height, width)."""
+        offset = int(self.offsets[idx])
+        width = int(self.widths[idx])
+        return self.data[offset:offset + self.img_height * width].reshape(self.img_height, width)
+
+    def __getstate__(self) -> Dict:
+        # Never pickle the mapped data, each worker maps the file by itself
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
+def pack_lines(
+    data_dir: Union[str, Path],
+    image_names: Iterable[str],
+    prefix: Union[str, Path],
+    img_height: int = 64,
+    max_width: Optional[int] = None,
+    fast_decode: bool = False
+) -> PackedLineStore:
+    """
+    Decode, resize and write line images into a packed store.
+
+    Args:
+        data_dir: Directory containing the images
+        image_names: Image paths, relative to data_dir, in dataset order
+        prefix: Output path prefix (``.bin`` and ``.index.npz`` are appended)
+        img_height: Height to resize images to (maintaining aspect ratio)
+        max_width: Maximum width of images after resizing (None for no limit)
+        fast_decode: Downscale while decoding when the format allows it (see load_line_image)
+
+    Returns:
+        The newly written store
+    """
+    data_dir = Path(data_dir)
+    prefix = Path(prefix)
+    prefix.parent.mkdir(parents=True, exist_ok=True)
+
+    offsets: List[int] = []
+    widths: List[int] = []
+    images: List[str] = []
+    offset = 0
+    with open(prefix.with_name(prefix.name + '.bin'), 'wb') as f:
+        for name in image_names:
+            img = load_line_image(data_dir / name, img_height, max_width, fast_decode)
+            f.write(np.ascontiguousarray(img).tobytes())
+            offsets.append(offset)
+            widths.append(img.shape[1])
+            images.append(name)
+            offset += img.size
+
+    np.savez(
+        prefix.with_name(prefix.name + '.index.npz'),
+        offsets=np.asarray(offsets, dtype=np.int64),
+        widths=np.asarray(widths, dtype=np.int32),
+        images=np.asarray(images, dtype=str),
+        img_height=np.int32(img_height),
+        max_width=np.int32(max_width or 0)
+    )
+    return PackedLineStore(prefix)
@@ -0,0 +1,227 @@
+import torch
+import numpy as np
+import xml.etree.ElementTree as ET
+from array import array
+from pathlib import Path
+from PIL import Image, ImageDraw
+from torch.utils.data import Dataset
+from typing import Dict, List, Optional, Tuple, Union
+
+from .handwriting_dataset import HandwritingDataset
+from .image_cache import ImageCache
+from .image_io import resized_width
+from .manifest import SampleManifest, read_samples
+
+def _local_name(tag: str) -> str:
+    # PAGE-XML elements are namespaced, and the namespace depends on the schema version
+    return tag.rsplit('}', 1)[-1]
+
+def _child(element: ET.Element, name: str) -> Optional[ET.Element]:
+    return next((c for c in element if _local_name(c.tag) == name), None)
+
+def _parse_points(coords: ET.Element) -> List[List[int]]:
+    if coords.get('points'):
+        # PAGE 2013 and later: points="x1,y1 x2,y2 ..."
+        return [[int(float(v)) for v in point.split(',')] for point in coords.get('points').split()]
+    # PAGE 2010: <Point x="..." y="..."/> children
+    return [[int(float(p.get('x'))), int(float(p.get('y')))] for p in coords if _local_name(p.tag) == 'Point']
+
+def read_page_xml(xml_path: Union[str, Path], require_text: bool = True) -> List[Dict]:
+    """
+    Read the text lines of a PAGE-XML file as page line regions.
+
+    Args:
+        xml_path: PAGE-XML file
+        require_text: Skip lines without a transcript (TextEquiv)
+
+    Returns:
+        A sample per line, in the order of the file, with its "id", "page"
+        (the imageFilename of the page), "polygon" ([[x, y], ...] in page
+        pixels) and "text"
+    """
+    root = ET.parse(xml_path).getroot()
+    page = next(e for e in root.iter() if _local_name(e.tag) == 'Page')
+    page_image = page.get('imageFilename')
+
+    samples = []
+    for line in page.iter():
+        if _local_name(line.tag) != 'TextLine':
+            continue
+        coords = _child(line, 'Coords')
+        polygon = _parse_points(coords) if coords is not None else []
+        if len(polygon) < 2:
+            continue
+        # Only the transcript of the line itself, not those of its words
+        equiv = _child(line, 'TextEquiv')
+        unicode = _child(equiv, 'Unicode') if equiv is not None else None
+        text = unicode.text if unicode is not None and unicode.text else None
+        if text is None and require_text:
+            continue
+        samples.append({
+            "id": line.get('id'),
+            "page": page_image,
+            "polygon": polygon,
+            "text": text or ""
+        })
+    return samples
+
+def read_page_regions(path: Union[str, Path]) -> List[Dict]:
+    """
+    Read page line regions from a PAGE-XML file, a directory of PAGE-XML
+    files (searched recursively), or a JSON/JSON Lines file (see read_samples)
+    whose samples have a "page" image, a "text" and either a "bbox"
+    ([x0, y0, x1, y1], exclusive end) or a "polygon" ([[x, y], ...]).
+    """
+    path = Path(path)
+    if path.is_dir():
+        return [sample for xml_path in sorted(path.rglob('*.xml')) for sample in read_page_xml(xml_path)]
+    if path.suffix == '.xml':
+        return read_page_xml(path)
+    return read_samples(path)
+
+class PageLineDataset(Dataset):
+    def __init__(
+        self,
+        data_dir: str,
+        regions: Union[str, Path, List[Dict]],
+        char_map: Dict[str, int],
+        img_height: int = 64,
+        max_width: Optional[int] = None,
+        page_cache: Optional[ImageCache] = None,
+        normalize: bool = True,
+        background: int = 255
+    ):
+        """
+        Dataset of text lines cropped on the fly from page images.
+
+        Each page image is decoded once and kept in a per-process LRU cache
+        (use PageGroupedBatchSampler so that consecutive samples come from
+        the same page), and its lines are cropped from it, so that no line
+        image files are needed. Samples are the same as HandwritingDataset's,
+        and can be collated with HandwritingDataset.collate_fn or
+        PaddedBatchCollator.
+
+        Args:
+            data_dir: Directory of the page images, that their paths (the
+                imageFilename of PAGE-XML files) are relative to
+            regions: Line regions, or a path to read them from (see
+                read_page_regions)
+            char_map: Dictionary mapping characters to indices
+            img_height: Height to resize lines to (maintaining aspect ratio)
+            max_width: Maximum width of lines after resizing (None for no limit)
+            page_cache: Cache of decoded grayscale pages (default: an
+                ImageCache of 512 MB, in each DataLoader worker)
+            normalize: Return float images in [0, 1] (see HandwritingDataset)
+            background: Gray level of the pixels outside polygonal regions
+        """
+        self.data_dir = Path(data_dir)
+        self.char_map = char_map
+        self.img_height = img_height
+        self.max_width = max_width
+        self.page_cache = page_cache if page_cache is not None else ImageCache(512 * 2**20)
+        self.normalize = normalize
+        self.background = background
+
+        if not isinstance(regions, list):
+            regions = read_page_regions(regions)
+
+        # Regions are kept in arrays, like the samples of HandwritingDataset:
+        # bounding boxes (x0, y0, x1, y1), polygons as flat (x, y) pairs with
+        # offsets (empty for rectangular regions) and page indices
+        boxes = np.empty((len(regions), 4), dtype=np.int32)
+        polygons, polygon_offsets = array('i'), array('q', [0])
+        page_index: Dict[str, int] = {}
+        page_ids = np.empty(len(regions), dtype=np.int64)
+        for i, region in enumerate(regions):
+            if "polygon" in region:
+                points = np.asarray(region["polygon"], dtype=np.int32).reshape(-1, 2)
+                boxes[i] = (*points.min(axis=0), *(points.max(axis=0) + 1))
+                polygons.extend(points.reshape(-1).tolist())
+            else:
+                boxes[i] = region["bbox"]
+            polygon_offsets.append(len(polygons))
+            page_ids[i] = page_index.setdefault(region["page"], len(page_index))
+
+        # Clamp the boxes to their pages (only the image headers are read), so
+        # that the widths used for batching are those of the actual crops
+        page_sizes = np.empty((len(page_index), 2), dtype=np.int32)
+        for page, i in page_index.items():
+            with Image.open(self.data_dir / page) as img:
+                page_sizes[i] = img.size
+        boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, page_sizes[page_ids, 0:1])
+        boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, page_sizes[page_ids, 1:2])
+        outside = np.flatnonzero((boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1]))
+        if len(outside):
+            raise ValueError(f"Region {outside[0]} is outside of its page {regions[outside[0]]['page']}")
+        self.boxes = boxes
+        self.polygons = np.frombuffer(polygons, dtype=np.int32)
+        self.polygon_offsets = np.frombuffer(polygon_offsets, dtype=np.int64)
+        self.page_ids = page_ids
+        self.manifest = SampleManifest.from_samples(
+            ({
+                "image": region["page"],
+                "text": region["text"],
+                "width": int(box[2] - box[0]),
+                "height": int(box[3] - box[1])
+            } for region, box in zip(regions, boxes)),
+            char_map
+        )
+
+    def __len__(self) -> int:
+        return len(self.manifest)
+
+    def get_widths(self) -> np.ndarray:
+        """Width of each line after resizing, without decoding the pages."""
+        # Same computation as resized_width, vectorized
+        widths = (self.manifest.widths * (self.img_height / self.manifest.heights)).astype(np.int64)
+        if self.max_width:
+            widths = np.minimum(widths, self.max_width)
+        return widths
+
+    def get_text_lengths(self) -> np.ndarray:
+        """Length of the transcript of each line."""
+        return self.manifest.target_lengths.astype(np.int64)
+
+    def load_page(self, idx: int) -> np.ndarray:
+        """Grayscale page of a sample, going through the page cache."""
+        path = str(self.data_dir / self.manifest.images[idx])
+        key = ('page', path)
+        page = self.page_cache.get(key)
+        if page is None:
+            with Image.open(path) as img:
+                page = np.asarray(img.convert('L'), dtype=np.uint8)
+            self.page_cache.put(key, page)
+        return page
+
+    def crop_line(self, idx: int) -> np.ndarray:
+        """Crop a line from its page, resized to img_height (writable uint8 array)."""
+        page = self.load_page(idx)
+        x0, y0, x1, y1 = self.boxes[idx].tolist()
+        crop = Image.fromarray(page[y0:y1, x0:x1])
+
+        start, end = self.polygon_offsets[idx], self.polygon_offsets[idx + 1]
+        if end > start:
+            points = self.polygons[start:end].reshape(-1, 2) - (x0, y0)
+            mask = Image.new('1', crop.size, 0)
+            ImageDraw.Draw(mask).polygon([tuple(p) for p in points.tolist()], fill=1)
+            crop = Image.composite(crop, Image.new('L', crop.size, self.background), mask)
+
+        # Resize maintaining aspect ratio (as load_line_image)
+        new_width = resized_width(crop.width, crop.height, self.img_height, self.max_width)
+        crop = crop.resize((new_width, self.img_height), Image.Resampling.BILINEAR)
+        # Arrays viewing PIL images are read-only, which torch.from_numpy does not support
+        return np.array(crop, dtype=np.uint8)
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor, int]:
+        """Same as HandwritingDataset.__getitem__."""
+        img = self.crop_line(idx)
+        new_width = img.shape[1]
+        if self.normalize:
+            img = torch.from_numpy(img.astype(np.float32)).view(1, self.img_height, new_width)
+            img = img / 255.0  # Normalize to [0, 1]
+        else:
+            img = torch.from_numpy(img).view(1, self.img_height, new_width)
+        text = torch.from_numpy(self.manifest.target(idx).astype(np.int64))
+        return img, text, new_width
+
+    collate_fn = staticmethod(HandwritingDataset.collate_fn)
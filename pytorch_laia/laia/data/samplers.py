@@ -0,0 +1,346 @@
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+class WidthBucketBatchSampler(Sampler[List[int]]):
+    def __init__(
+        self,
+        widths: Sequence[int],
+        batch_size: int = 16,
+        num_buckets: int = 10,
+        max_pixels: Optional[int] = None,
+        img_height: int = 64,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        text_lengths: Optional[Sequence[int]] = None,
+        curriculum_lambda: float = 0.0,
+        curriculum_min_length: float = 1.0,
+        seed: int = 0
+    ):
+        """
+        Batch sampler that groups samples of similar width to reduce padding.
+
+        Samples are sorted by width and split into buckets of (roughly) equal
+        size. Batches are formed inside each bucket, so that the images in a
+        batch have similar widths; the samples left over at the end of a
+        bucket are carried over to the next one, so that only the last batch
+        can be incomplete. When shuffling, samples are shuffled within
+        each bucket and the resulting batches are shuffled across buckets.
+        Without shuffling, batches are produced in increasing width order
+        (like the Lua WidthBatcher).
+
+        Args:
+            widths: Width (after resizing) of each sample in the dataset
+            batch_size: Number of samples per batch (ignored if max_pixels is set)
+            num_buckets: Number of width buckets
+            max_pixels: If not None, batches are filled until the padded batch
+                (batch size x max width x img_height) would exceed this number
+                of pixels, instead of using a fixed batch_size
+            img_height: Height of the images, used with max_pixels
+            shuffle: Shuffle samples within buckets and batches across buckets
+            drop_last: Drop the last incomplete batch
+            text_lengths: Transcript length of each sample, required for
+                curriculum sampling
+            curriculum_lambda: If > 0, each epoch draws len(widths) samples
+                with replacement with probability proportional to
+                max(curriculum_min_length, length)^(-curriculum_lambda)
+                (like the Lua CurriculumBatcher)
+            curriculum_min_length: Avoids that very short samples get an
+                excessively high probability
+            seed: Base random seed; the epoch number is added to it
+        """
+        if curriculum_lambda < 0:
+            raise ValueError("curriculum_lambda must be greater than or equal to 0")
+        if curriculum_min_length < 1:
+            raise ValueError("curriculum_min_length must be greater than or equal to 1")
+        if curriculum_lambda > 0 and text_lengths is None:
+            raise ValueError("Curriculum sampling needs the text lengths")
+        self.widths = np.asarray(widths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.num_buckets = max(1, min(num_buckets, len(self.widths)))
+        self.max_pixels = max_pixels
+        self.img_height = img_height
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.text_lengths = None if text_lengths is None else np.asarray(text_lengths, dtype=np.float64)
+        self.curriculum_lambda = curriculum_lambda
+        self.curriculum_min_length = curriculum_min_length
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch used to seed the shuffling (called by CTCTrainer every epoch)."""
+        self.epoch = epoch
+
+    def _sample_indices(self, rng: np.random.Generator) -> np.ndarray:
+        if self.curriculum_lambda > 0:
+            lengths = np.maximum(self.text_lengths, self.curriculum_min_length)
+            # Normalize lengths so that the exponentiation does not overflow
+            likelihoods = (lengths / (1 + lengths.max())) ** -self.curriculum_lambda
+            return rng.choice(len(self.widths), size=len(self.widths), p=likelihoods / likelihoods.sum())
+        return np.arange(len(self.widths))
+
+    def _split_batches(self, bucket: np.ndarray) -> Tuple[List[List[int]], List[int]]:
+        """Split a bucket into full batches and the incomplete last batch."""
+        batches = []
+        if self.max_pixels is None:
+            end = len(bucket) - len(bucket) % self.batch_size
+            for start in range(0, end, self.batch_size):
+                batches.append(bucket[start:start + self.batch_size].tolist())
+            return batches, bucket[end:].tolist()
+
+        batch: List[int] = []
+        batch_width = 0
+        for idx in bucket.tolist():
+            width = max(batch_width, int(self.widths[idx]))
+            if batch and (len(batch) + 1) * width * self.img_height > self.max_pixels:
+                batches.append(batch)
+                batch, width = [], int(self.widths[idx])
+            batch.append(idx)
+            batch_width = width
+        return batches, batch
+
+    def _batches(self) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = self._sample_indices(rng)
+        if self.shuffle:
+            # Random tie-breaking between samples of equal width
+            indices = indices[rng.permutation(len(indices))]
+        indices = indices[np.argsort(self.widths[indices], kind='stable')]
+
+        batches = []
+        leftover: List[int] = []
+        for bucket in np.array_split(indices, self.num_buckets):
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            # The leftover samples of the previous (narrower) bucket go first
+            bucket_batches, leftover = self._split_batches(np.concatenate([leftover, bucket]).astype(np.int64))
+            batches.extend(bucket_batches)
+        if leftover and not self.drop_last:
+            batches.append(leftover)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self._batches())
+
+    def __len__(self) -> int:
+        if self.max_pixels is None and self.curriculum_lambda == 0:
+            if self.drop_last:
+                return len(self.widths) // self.batch_size
+            return -(-len(self.widths) // self.batch_size)
+        # The number of batches depends on the sampled widths
+        return len(self._batches())
+
+class DistributedWidthBucketBatchSampler(WidthBucketBatchSampler):
+    def __init__(
+        self,
+        widths: Sequence[int],
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        even_batches: bool = True,
+        **kwargs
+    ):
+        """
+        Width-bucketed batch sampler that splits the batches among distributed ranks.
+
+        All ranks form the same batches (see WidthBucketBatchSampler; the seed
+        must be the same on all ranks). The batches are then sorted by padded
+        size (batch size x max width) and grouped into consecutive groups of
+        num_replicas batches, so that the batches processed by the ranks in
+        the same step have similar costs and no rank waits for a much wider
+        batch. Groups are shuffled if shuffle is set, and each rank gets one
+        batch of each group.
+
+        Args:
+            widths: Width (after resizing) of each sample in the dataset
+            num_replicas: Number of ranks (default: the world size of the
+                default process group when iterating, or 1)
+            rank: Rank of this process (default: its rank in the default
+                process group when iterating, or 0)
+            even_batches: Pad the last group by repeating batches so that all
+                ranks get the same number of batches (needed for training,
+                where gradients are synchronized every step). Otherwise, the
+                last group is incomplete and no sample is repeated (useful to
+                compute exact metrics on evaluation sets)
+            **kwargs: Arguments of WidthBucketBatchSampler
+        """
+        super().__init__(widths, **kwargs)
+        self._num_replicas = num_replicas
+        self._rank = rank
+        self.even_batches = even_batches
+        if num_replicas is not None and rank is not None and not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, it must be in [0, {num_replicas})")
+
+    @property
+    def num_replicas(self) -> int:
+        if self._num_replicas is not None:
+            return self._num_replicas
+        # Resolved lazily, since the process group is usually created after the sampler
+        return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+    @property
+    def rank(self) -> int:
+        if self._rank is not None:
+            return self._rank
+        return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+    def _groups(self) -> List[List[List[int]]]:
+        batches = self._batches()
+        num_replicas = self.num_replicas
+        if not batches:
+            return []
+        costs = np.array([len(b) * self.widths[b].max() for b in batches])
+        batches = [batches[i] for i in np.argsort(costs, kind='stable')]
+
+        remainder = len(batches) % num_replicas
+        if remainder and self.drop_last:
+            # Drop the cheapest batches
+            batches = batches[remainder:]
+        elif remainder and self.even_batches:
+            # Repeat the cheapest batches (they go to the first group)
+            padding = num_replicas - remainder
+            batches = (batches * (padding // len(batches) + 1))[:padding] + batches
+        # Incomplete group (if any) first, so that it holds the cheapest batches
+        start = len(batches) % num_replicas
+        groups = ([batches[:start]] if start else []) + [
+            batches[i:i + num_replicas] for i in range(start, len(batches), num_replicas)
+        ]
+
+        if self.shuffle:
+            # Independent of the stream used to form the batches
+            rng = np.random.default_rng([self.seed + self.epoch, 1])
+            groups = [groups[i] for i in rng.permutation(len(groups))]
+        return groups
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rank = self.rank
+        return iter([group[rank] for group in self._groups() if rank < len(group)])
+
+    def __len__(self) -> int:
+        rank = self.rank
+        return sum(rank < len(group) for group in self._groups())
+
+class PageGroupedBatchSampler(Sampler[List[int]]):
+    def __init__(
+        self,
+        page_ids: Sequence[int],
+        batch_size: int = 16,
+        num_workers: int = 0,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        even_batches: bool = True,
+        seed: int = 0
+    ):
+        """
+        Batch sampler that keeps the lines of each page together (for PageLineDataset).
+
+        Pages are (optionally shuffled and) distributed among streams, one
+        per DataLoader worker of each rank, balancing their number of lines.
+        Each stream yields the lines of its pages one page after another, cut
+        into batches, and the streams of a rank are interleaved. Since the
+        DataLoader hands batches to its workers in round-robin order, every
+        worker then gets all the lines of its pages, and decodes each page
+        once per epoch (with a page cache of at least a couple of pages).
+
+        Args:
+            page_ids: Page of each sample in the dataset
+            batch_size: Number of samples per batch
+            num_workers: Number of DataLoader workers (0 for none)
+            shuffle: Shuffle the pages, and the lines within each page
+            drop_last: Drop the last incomplete batch of each stream
+            num_replicas: Number of ranks (default: the world size of the
+                default process group when iterating, or 1)
+            rank: Rank of this process (default: its rank in the default
+                process group when iterating, or 0)
+            even_batches: Repeat batches so that all ranks get the same
+                number of batches (see DistributedWidthBucketBatchSampler)
+            seed: Base random seed; the epoch number is added to it
+        """
+        self.page_ids = np.asarray(page_ids, dtype=np.int64)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self._num_replicas = num_replicas
+        self._rank = rank
+        self.even_batches = even_batches
+        self.seed = seed
+        self.epoch = 0
+        if num_replicas is not None and rank is not None and not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, it must be in [0, {num_replicas})")
+
+    @property
+    def num_replicas(self) -> int:
+        if self._num_replicas is not None:
+            return self._num_replicas
+        return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+    @property
+    def rank(self) -> int:
+        if self._rank is not None:
+            return self._rank
+        return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch used to seed the shuffling (called by CTCTrainer every epoch)."""
+        self.epoch = epoch
+
+    def _rank_batches(self) -> List[List[List[int]]]:
+        """Batches of each stream, for every rank."""
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = np.arange(len(self.page_ids))
+        if self.shuffle:
+            indices = rng.permutation(indices)
+        # Lines grouped by page, in their (shuffled) order within each page
+        indices = indices[np.argsort(self.page_ids[indices], kind='stable')]
+        pages, starts = np.unique(self.page_ids[indices], return_index=True)
+        page_lines = np.split(indices, starts[1:]) if len(indices) else []
+        order = rng.permutation(len(pages)) if self.shuffle else np.arange(len(pages))
+
+        num_workers = max(1, self.num_workers)
+        num_streams = self.num_replicas * num_workers
+        streams: List[List[np.ndarray]] = [[] for _ in range(num_streams)]
+        stream_lines = np.zeros(num_streams, dtype=np.int64)
+        for page in order.tolist():
+            # Greedy balancing: the next page goes to the stream with fewer lines
+            stream = int(np.argmin(stream_lines))
+            streams[stream].append(page_lines[page])
+            stream_lines[stream] += len(page_lines[page])
+
+        rank_batches = []
+        for rank in range(self.num_replicas):
+            stream_batches = []
+            for stream in streams[rank * num_workers:(rank + 1) * num_workers]:
+                lines = np.concatenate(stream) if stream else np.empty(0, dtype=np.int64)
+                batches = [lines[i:i + self.batch_size].tolist() for i in range(0, len(lines), self.batch_size)]
+                if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+                    batches.pop()
+                stream_batches.append(batches)
+            # Interleave the streams of the rank's workers
+            rank_batches.append([
+                batches[i] for i in range(max(map(len, stream_batches), default=0))
+                for batches in stream_batches if i < len(batches)
+            ])
+        return rank_batches
+
+    def _batches(self) -> List[List[int]]:
+        rank_batches = self._rank_batches()
+        batches = rank_batches[self.rank]
+        if self.num_replicas > 1 and self.even_batches:
+            num_batches = max(map(len, rank_batches))
+            if batches and len(batches) < num_batches:
+                # Repeat the first batches of the rank
+                batches = (batches * (num_batches // len(batches) + 1))[:num_batches]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self._batches())
+
+    def __len__(self) -> int:
+        return len(self._batches())
@@ -0,0 +1,380 @@
+import io
+import itertools
+import json
+import os
+import tarfile
+import numpy as np
+import torch
+import torch.distributed as dist
+from multiprocessing import Pool
+from pathlib import Path
+from PIL import Image
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .collate import PaddedBatchCollator
+from .image_io import load_line_image
+
+def _encode_line(task: Tuple[str, Dict, Optional[int], Optional[int], bool]) -> Tuple[Dict, str, bytes]:
+    """Read (and optionally resize and re-encode as PNG) the image of a sample (run in worker processes)."""
+    data_dir, sample, img_height, max_width, fast_decode = task
+    img_path = Path(data_dir) / sample["image"]
+    meta = {"image": sample["image"], "text": sample["text"]}
+    if img_height is None:
+        with open(img_path, 'rb') as f:
+            data = f.read()
+        return meta, img_path.suffix.lower() or '.img', data
+    img = load_line_image(img_path, img_height, max_width, fast_decode=fast_decode)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format='PNG')
+    return meta, '.png', buffer.getvalue()
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+def write_shards(
+    data_dir: Union[str, Path],
+    samples: Iterable[Dict],
+    prefix: Union[str, Path],
+    shard_size: int = 5000,
+    img_height: Optional[int] = None,
+    max_width: Optional[int] = None,
+    fast_decode: bool = False,
+    jobs: int = 1
+) -> Dict:
+    """
+    Write samples into tar shards for ShardedLineDataset.
+
+    Each shard (``<prefix>-00000.tar``, ...) holds shard_size samples, each
+    one as two consecutive members named after its position: ``<key>.json``
+    (its "image" path and "text") and the image itself. An index
+    (``<prefix>.json``) lists the shards and their number of samples. Shards
+    are written atomically, one after another, and the index last.
+
+    Samples are written in the given order; shuffle them beforehand for
+    training, so that each shard holds a random subset of the data.
+
+    Args:
+        data_dir: Directory containing images
+        samples: Samples of a ground truth file
+        prefix: Output path prefix
+        shard_size: Number of samples per shard
+        img_height: If not None, store the lines resized to this height (as
+            PNG) instead of the original image files
+        max_width: Maximum width of the resized lines
+        fast_decode: Decode the images with fast_decode when resizing
+        jobs: Number of processes reading (and resizing) the images
+
+    Returns:
+        The index
+    """
+    prefix = Path(prefix)
+    prefix.parent.mkdir(parents=True, exist_ok=True)
+    samples = iter(samples)
+    shard_files: List[str] = []
+    shard_sizes: List[int] = []
+    with Pool(max(1, jobs)) as pool:
+        # One shard at a time, so that memory use is bounded by the shard size
+        while True:
+            tasks = [(str(data_dir), sample, img_height, max_width, fast_decode)
+                     for sample in itertools.islice(samples, shard_size)]
+            if not tasks:
+                break
+            shard_file = f"{prefix.name}-{len(shard_files):05d}.tar"
+            tmp_path = prefix.with_name(shard_file + '.tmp')
+            with tarfile.open(tmp_path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+                for i, (meta, ext, data) in enumerate(pool.imap(_encode_line, tasks, chunksize=16)):
+                    key = f"{sum(shard_sizes) + i:09d}"
+                    _add_member(tar, key + '.json', json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+                    _add_member(tar, key + ext, data)
+            os.replace(tmp_path, prefix.with_name(shard_file))
+            shard_files.append(shard_file)
+            shard_sizes.append(len(tasks))
+
+    index = {"shards": shard_files, "num_samples": shard_sizes, "img_height": img_height, "max_width": max_width}
+    index_path = prefix.with_name(prefix.name + '.json')
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_path, index_path)
+    return index
+
+def _read_tar(f: BinaryIO) -> Iterator[Tuple[str, bytes]]:
+    """
+    Name and content of the files of a USTAR archive (as written by
+    write_shards), read sequentially.
+
+    Much faster than tarfile, which parses every header field.
+    """
+    while True:
+        header = f.read(512)
+        if len(header) < 512 or header[0] == 0:
+            # End of archive (two zero blocks)
+            return
+        name = header[:100].split(b'\0', 1)[0].decode('utf-8')
+        prefix = header[345:500].split(b'\0', 1)[0]
+        if prefix:
+            name = prefix.decode('utf-8') + '/' + name
+        size = int(header[124:136].split(b'\0', 1)[0].strip() or b'0', 8)
+        data = f.read(size)
+        if len(data) < size:
+            raise tarfile.ReadError(f"Truncated archive {getattr(f, 'name', '')}")
+        f.read(-size % 512)
+        if header[156:157] in (b'0', b'\0'):
+            yield name, data
+
+class ShardedLineDataset(IterableDataset):
+    def __init__(
+        self,
+        index_file: Union[str, Path],
+        char_map: Dict[str, int],
+        img_height: int = 64,
+        max_width: Optional[int] = None,
+        shuffle: bool = True,
+        shuffle_buffer: int = 2000,
+        even_batches: bool = True,
+        seed: int = 0,
+        normalize: bool = True,
+        fast_decode: bool = False,
+        read_buffer_size: int = 4 * 2**20
+    ):
+        """
+        Streaming dataset of text lines stored in tar shards (see write_shards).
+
+        Every shard is read sequentially, with large reads, which is much
+        faster than random small-file reads on network filesystems and object
+        store mounts. Each epoch, the shards are (optionally shuffled and)
+        concatenated, and the samples are split into contiguous ranges, one
+        per stream (i.e. per DataLoader worker of each rank), so that a
+        stream reads whole shards except at most one partial shard at each
+        end. When shuffling, each stream goes through a bounded shuffle
+        buffer of encoded samples; images are decoded when they leave it.
+
+        Everything is seeded with (seed, epoch, stream), so the order of the
+        samples is reproducible, and set_position restarts an epoch after a
+        number of samples without decoding them. Use ShardedLineLoader, which
+        sets the epoch, rank and position of the dataset before its workers
+        start.
+
+        Args:
+            index_file: Index written by write_shards (``<prefix>.json``)
+            char_map: Dictionary mapping characters to indices
+            img_height: Height to resize images to (maintaining aspect ratio)
+            max_width: Maximum width of images after resizing (None for no limit)
+            shuffle: Shuffle the shards and the samples (with the buffer)
+            shuffle_buffer: Number of samples in the shuffle buffer of each stream
+            even_batches: Drop up to (number of streams - 1) samples per epoch
+                so that all streams have the same number of samples (needed
+                for distributed training and for exact resuming). Otherwise,
+                the numbers of samples differ by at most one and no sample is
+                dropped (useful to compute exact metrics on evaluation sets)
+            seed: Base random seed
+            normalize: Return float images in [0, 1] (see HandwritingDataset)
+            fast_decode: Downscale images while decoding (see load_line_image)
+            read_buffer_size: Size of the reads from the shard files
+        """
+        self.index_file = Path(index_file)
+        with open(self.index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.shard_files = [str(self.index_file.parent / name) for name in index["shards"]]
+        self.shard_sizes = np.asarray(index["num_samples"], dtype=np.int64)
+        self.char_map = char_map
+        self.img_height = img_height
+        self.max_width = max_width
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.even_batches = even_batches
+        self.seed = seed
+        self.normalize = normalize
+        self.fast_decode = fast_decode
+        self.read_buffer_size = read_buffer_size
+
+        self.epoch = 0
+        self.num_replicas: Optional[int] = None
+        self.rank: Optional[int] = None
+        self._skip: List[int] = []
+        self._first_stream = 0
+
+    @property
+    def num_samples(self) -> int:
+        return int(self.shard_sizes.sum())
+
+    def set_position(self, epoch: int, skip: Optional[List[int]] = None, first_stream: int = 0,
+                     num_replicas: Optional[int] = None, rank: Optional[int] = None):
+        """
+        Set where the next iteration starts.
+
+        Args:
+            epoch: Epoch, which seeds the shuffling
+            skip: Number of samples to skip at the beginning of the stream of
+                each DataLoader worker of this rank
+            first_stream: Stream read by the first DataLoader worker (the
+                next ones read the following streams of this rank, cyclically)
+            num_replicas: Number of ranks (default: the world size of the
+                default process group, or 1)
+            rank: Rank of this process (default: its rank in the default
+                process group, or 0)
+        """
+        self.epoch = epoch
+        self._skip = list(skip or [])
+        self._first_stream = first_stream
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def _world(self) -> Tuple[int, int]:
+        distributed = dist.is_available() and dist.is_initialized()
+        num_replicas = self.num_replicas or (dist.get_world_size() if distributed else 1)
+        rank = self.rank if self.rank is not None else (dist.get_rank() if distributed else 0)
+        return num_replicas, rank
+
+    def stream_bounds(self, num_streams: int) -> np.ndarray:
+        """Start of the range of samples of each stream (and the end of the last one)."""
+        total = self.num_samples
+        if self.even_batches:
+            return np.arange(num_streams + 1, dtype=np.int64) * (total // num_streams)
+        return np.arange(num_streams + 1, dtype=np.int64) * total // num_streams
+
+    def _shard_order(self) -> np.ndarray:
+        if not self.shuffle:
+            return np.arange(len(self.shard_files))
+        return np.random.default_rng([self.seed, self.epoch]).permutation(len(self.shard_files))
+
+    def _segments(self, start: int, end: int) -> List[Tuple[int, int, int]]:
+        """(shard, first sample, end sample) of the shards read for a range of samples of the epoch."""
+        order = self._shard_order()
+        shard_ends = np.cumsum(self.shard_sizes[order])
+        segments = []
+        shard_start = 0
+        for shard, shard_end in zip(order.tolist(), shard_ends.tolist()):
+            if shard_end > start and shard_start < end:
+                segments.append((shard, max(start, shard_start) - shard_start, min(end, shard_end) - shard_start))
+            shard_start = shard_end
+        return segments
+
+    def _read_shard(self, shard: int, first: int, end: int) -> Iterator[Tuple[Dict, bytes]]:
+        # The file is read strictly sequentially, never seeked
+        with open(self.shard_files[shard], 'rb', buffering=self.read_buffer_size) as f:
+            meta = None
+            position = 0
+            for name, data in _read_tar(f):
+                if position >= end:
+                    break
+                if name.endswith('.json'):
+                    meta = json.loads(data) if position >= first else None
+                    continue
+                if position >= first:
+                    yield meta, data
+                position += 1
+
+    def _shuffled(self, samples: Iterator, rng: np.random.Generator) -> Iterator:
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = int(rng.integers(len(buffer)))
+            yield buffer[i]
+            buffer[i] = sample
+        for i in rng.permutation(len(buffer)).tolist():
+            yield buffer[i]
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor, int]]:
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        worker_id = (worker_id + self._first_stream) % num_workers
+        num_replicas, rank = self._world()
+        stream = rank * num_workers + worker_id
+        bounds = self.stream_bounds(num_replicas * num_workers)
+
+        samples = itertools.chain.from_iterable(
+            self._read_shard(*segment) for segment in self._segments(bounds[stream], bounds[stream + 1])
+        )
+        if self.shuffle:
+            samples = self._shuffled(samples, np.random.default_rng([self.seed, self.epoch, stream]))
+        skip = self._skip[worker_id] if worker_id < len(self._skip) else 0
+        for meta, data in itertools.islice(samples, skip, None):
+            yield self._decode(meta, data)
+
+    def _decode(self, meta: Dict, data: bytes) -> Tuple[torch.Tensor, torch.Tensor, int]:
+        """Same samples as HandwritingDataset.__getitem__."""
+        img = load_line_image(io.BytesIO(data), self.img_height, self.max_width, fast_decode=self.fast_decode)
+        new_width = img.shape[1]
+        if self.normalize:
+            img = torch.from_numpy(img.astype(np.float32)).view(1, self.img_height, new_width)
+            img = img / 255.0  # Normalize to [0, 1]
+        else:
+            img = torch.from_numpy(np.array(img, dtype=np.uint8)).view(1, self.img_height, new_width)
+        text = torch.tensor([self.char_map.get(c, 0) for c in meta["text"]], dtype=torch.long)
+        return img, text, new_width
+
+class ShardedLineLoader(DataLoader):
+    def __init__(self, dataset: ShardedLineDataset, batch_size: int = 16, drop_last: bool = False, **kwargs):
+        """
+        DataLoader of a ShardedLineDataset that keeps track of its position.
+
+        Each iteration is a new epoch of the dataset. Since the DataLoader
+        takes batches from its workers in round-robin order, the number of
+        batches returned tells how many samples each worker has produced, so
+        state_dict/load_state_dict (used by Lightning in its checkpoints)
+        resume an epoch right after the last batch returned before the
+        checkpoint, with the same number of workers and ranks.
+
+        Args:
+            dataset: Dataset to load
+            batch_size: Number of samples per batch
+            drop_last: Drop the last incomplete batch of each worker
+            **kwargs: Other DataLoader arguments (the default collate_fn is
+                PaddedBatchCollator; persistent_workers is not supported,
+                since workers need the epoch and position of the dataset)
+        """
+        if kwargs.get('persistent_workers'):
+            raise ValueError("ShardedLineLoader does not support persistent workers")
+        kwargs.setdefault('collate_fn', PaddedBatchCollator(pin_memory=kwargs.get('pin_memory', False)))
+        super().__init__(dataset, batch_size=batch_size, drop_last=drop_last, **kwargs)
+        self.epoch = 0
+        self.batches = 0
+        self._resumed = True
+
+    def _world(self) -> Tuple[int, int]:
+        return self.dataset._world()
+
+    def worker_batches(self) -> List[int]:
+        """Number of batches of each worker of this rank in an epoch."""
+        num_workers = max(1, self.num_workers)
+        num_replicas, rank = self._world()
+        lengths = np.diff(self.dataset.stream_bounds(num_replicas * num_workers))
+        lengths = lengths[rank * num_workers:(rank + 1) * num_workers]
+        if self.drop_last:
+            return (lengths // self.batch_size).tolist()
+        return (-(-lengths // self.batch_size)).tolist()
+
+    def __len__(self) -> int:
+        return sum(self.worker_batches())
+
+    def __iter__(self):
+        if not self._resumed:
+            self.epoch += 1
+            self.batches = 0
+        self._resumed = False
+
+        num_workers = max(1, self.num_workers)
+        num_replicas, rank = self._world()
+        # Batches already returned by each worker (in round-robin order), the
+        # next batch being from worker batches % num_workers
+        skip = [len(range(worker, self.batches, num_workers)) * self.batch_size for worker in range(num_workers)]
+        self.dataset.set_position(self.epoch, skip, self.batches % num_workers, num_replicas, rank)
+        for batch in super().__iter__():
+            self.batches += 1
+            yield batch
+
+    def state_dict(self) -> Dict[str, int]:
+        if self.batches >= len(self):
+            return {"epoch": self.epoch + 1, "batches": 0}
+        return {"epoch": self.epoch, "batches": self.batches}
+
+    def load_state_dict(self, state_dict: Dict[str, int]):
+        self.epoch = state_dict["epoch"]
+        self.batches = state_dict["batches"]
+        self._resumed = True
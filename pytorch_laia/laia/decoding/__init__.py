@@ -0,0 +1,5 @@
+from .ctc_beam_search import CTCBeamSearchDecoder
+from .force_alignment import Alignment, force_align
+from .ngram_lm import NGramLM
+
+__all__ = ['Alignment', 'CTCBeamSearchDecoder', 'NGramLM', 'force_align']
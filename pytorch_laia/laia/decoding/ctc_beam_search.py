@@ -0,0 +1,268 @@
+import math
+import multiprocessing
+import numpy as np
+import torch
+from typing import Dict, List, Optional, Tuple
+
+from .ngram_lm import NGramLM
+
+NEG_INF = float('-inf')
+
+def _logaddexp(a: float, b: float) -> float:
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    if a > b:
+        return a + math.log1p(math.exp(b - a))
+    return b + math.log1p(math.exp(a - b))
+
+# Decoder used by the worker processes, set by _init_worker
+_worker_decoder = None
+
+def _init_worker(decoder: 'CTCBeamSearchDecoder'):
+    global _worker_decoder
+    _worker_decoder = decoder
+    # Each worker decodes a single sample at a time
+    torch.set_num_threads(1)
+
+def _search_worker(log_probs: np.ndarray) -> Tuple[int, ...]:
+    return _worker_decoder.search(log_probs)
+
+class CTCBeamSearchDecoder:
+    def __init__(
+        self,
+        char_map: Dict[str, int],
+        beam_width: int = 10,
+        top_k: int = 16,
+        prune_threshold: float = -12.0,
+        lm: Optional[NGramLM] = None,
+        lm_unit: str = 'char',
+        lm_weight: float = 0.5,
+        insertion_bonus: float = 0.0,
+        space_token: str = '<space>',
+        blank: int = 0,
+        num_workers: int = 0
+    ):
+        """
+        CTC prefix beam search with optional shallow fusion of an n-gram LM.
+
+        Args:
+            char_map: Dictionary mapping characters to indices
+            beam_width: Number of prefixes kept after each frame
+            top_k: Number of most likely labels considered at each frame
+            prune_threshold: Labels with a log probability below this value
+                are not considered (the most likely label is always kept)
+            lm: Optional n-gram language model
+            lm_unit: 'char' if the LM tokens are characters, 'word' if they
+                are words separated by spaces
+            lm_weight: Weight of the LM log probability
+            insertion_bonus: Bonus added for each character ('char' LM) or
+                word ('word' LM) inserted in a prefix
+            space_token: LM token used for the space character ('char' LM)
+            blank: Index of the CTC blank label
+            num_workers: Number of processes used to decode the samples of a
+                batch in parallel (0 decodes in the calling process)
+        """
+        if lm_unit not in ('char', 'word'):
+            raise ValueError(f"Unknown LM unit: {lm_unit}")
+        self.idx_to_char = {v: k for k, v in char_map.items()}
+        self.beam_width = beam_width
+        self.top_k = top_k
+        self.prune_threshold = prune_threshold
+        self.lm = lm
+        self.lm_unit = lm_unit
+        self.lm_weight = lm_weight
+        self.insertion_bonus = insertion_bonus
+        self.blank = blank
+        self.space = char_map.get(' ', -1)
+        self.num_workers = num_workers
+        self._pool = None
+
+        if lm is not None and lm_unit == 'char':
+            # LM token id of each label
+            self.label_to_lm = {
+                idx: lm.vocab.get(space_token if c == ' ' else c, lm.unk)
+                for idx, c in self.idx_to_char.items()
+            }
+
+    def _extend_lm(self, state: Tuple, label: int) -> Tuple[float, Tuple]:
+        """Returns the (weighted) LM score of appending label and the new state."""
+        if self.lm_unit == 'char':
+            logprob, lm_state = self.lm.score(state, self.label_to_lm[label])
+            return self.lm_weight * logprob + self.insertion_bonus, lm_state
+
+        # Word LM: state is (LM history, labels of the word being built)
+        lm_state, word = state
+        if label != self.space:
+            return 0.0, (lm_state, word + (label,))
+        if not word:
+            return 0.0, state
+        logprob, lm_state = self._score_word(lm_state, word)
+        return self.lm_weight * logprob + self.insertion_bonus, (lm_state, ())
+
+    def _score_word(self, lm_state: Tuple[int, ...], word: Tuple[int, ...]) -> Tuple[float, Tuple[int, ...]]:
+        token = self.lm.vocab.get(''.join(self.idx_to_char[c] for c in word), self.lm.unk)
+        return self.lm.score(lm_state, token)
+
+    def _final_lm(self, state: Tuple) -> float:
+        if self.lm_unit == 'char':
+            return self.lm_weight * self.lm.final_score(state)
+        lm_state, word = state
+        score = 0.0
+        if word:
+            logprob, lm_state = self._score_word(lm_state, word)
+            score += self.lm_weight * logprob + self.insertion_bonus
+        return score + self.lm_weight * self.lm.final_score(lm_state)
+
+    def search(self, log_probs: np.ndarray) -> Tuple[int, ...]:
+        """
+        Decode a single sample.
+
+        Args:
+            log_probs: Array of shape (T, C) containing log probabilities
+
+        Returns:
+            Tuple with the decoded label indices
+        """
+        num_frames, num_labels = log_probs.shape
+        if num_frames == 0:
+            return ()
+
+        # Candidate labels of every frame, computed at once
+        k = min(self.top_k, num_labels)
+        candidates = np.argpartition(log_probs, num_labels - k, axis=1)[:, num_labels - k:]
+        scores = np.take_along_axis(log_probs, candidates, axis=1)
+        best = scores.argmax(axis=1)
+
+        use_lm = self.lm is not None
+        if use_lm:
+            init = self.lm.initial_state()
+            lm_states = {(): init if self.lm_unit == 'char' else (init, ())}
+            lm_bonus = {}
+
+        # Prefix -> [log prob ending in blank, log prob ending in non-blank]
+        beams = {(): [0.0, NEG_INF]}
+        for t in range(num_frames):
+            frame = [
+                (c, p) for i, (c, p) in enumerate(zip(candidates[t].tolist(), scores[t].tolist()))
+                if p >= self.prune_threshold or i == best[t]
+            ]
+            next_beams: Dict[Tuple[int, ...], List[float]] = {}
+            for prefix, (p_b, p_nb) in beams.items():
+                p_total = _logaddexp(p_b, p_nb)
+                last = prefix[-1] if prefix else None
+                for c, p in frame:
+                    if c == self.blank:
+                        entry = next_beams.setdefault(prefix, [NEG_INF, NEG_INF])
+                        entry[0] = _logaddexp(entry[0], p_total + p)
+                        continue
+
+                    new_prefix = prefix + (c,)
+                    bonus = 0.0
+                    if use_lm:
+                        bonus = lm_bonus.get(new_prefix)
+                        if bonus is None:
+                            bonus, lm_states[new_prefix] = self._extend_lm(lm_states[prefix], c)
+                            lm_bonus[new_prefix] = bonus
+
+                    entry = next_beams.setdefault(new_prefix, [NEG_INF, NEG_INF])
+                    if c == last:
+                        # Repeated labels need a blank in between
+                        entry[1] = _logaddexp(entry[1], p_b + p + bonus)
+                        same = next_beams.setdefault(prefix, [NEG_INF, NEG_INF])
+                        same[1] = _logaddexp(same[1], p_nb + p)
+                    else:
+                        entry[1] = _logaddexp(entry[1], p_total + p + bonus)
+
+            beams = dict(sorted(
+                next_beams.items(), key=lambda kv: _logaddexp(*kv[1]), reverse=True
+            )[:self.beam_width])
+
+        def final_score(item):
+            prefix, (p_b, p_nb) = item
+            score = _logaddexp(p_b, p_nb)
+            if use_lm:
+                score += self._final_lm(lm_states[prefix])
+            return score
+
+        return max(beams.items(), key=final_score)[0]
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                self.num_workers, initializer=_init_worker, initargs=(self,)
+            )
+        return self._pool
+
+    def close(self):
+        """Terminate the worker processes, if any."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def decode_labels(
+        self, log_probs: torch.Tensor, input_lengths: Optional[torch.Tensor] = None
+    ) -> List[Tuple[int, ...]]:
+        """
+        Decode a batch of samples into label indices.
+
+        Args:
+            log_probs: Tensor of shape (T, B, C) containing log probabilities
+            input_lengths: Optional tensor of shape (B,) with the number of
+                valid frames of each sample
+
+        Returns:
+            List with the decoded label indices of each sample
+        """
+        # Single transfer to host
+        log_probs = log_probs.detach().float().transpose(0, 1).cpu().numpy()  # (B, T, C)
+        if input_lengths is None:
+            lengths = [log_probs.shape[1]] * log_probs.shape[0]
+        else:
+            lengths = input_lengths.cpu().tolist()
+        samples = [np.ascontiguousarray(lp[:n]) for lp, n in zip(log_probs, lengths)]
+
+        if self.num_workers > 1 and len(samples) > 1:
+            chunksize = max(1, len(samples) // (4 * self.num_workers))
+            return self._get_pool().map(_search_worker, samples, chunksize=chunksize)
+        return [self.search(lp) for lp in samples]
+
+    def decode_predictions(
+        self, log_probs: torch.Tensor, input_lengths: Optional[torch.Tensor] = None
+    ) -> List[str]:
+        """
+        Decode a batch of samples into strings.
+
+        Args:
+            log_probs: Tensor of shape (T, B, C) containing log probabilities
+            input_lengths: Optional tensor of shape (B,) with the number of
+                valid frames of each sample
+
+        Returns:
+            List of decoded strings
+        """
+        return [
+            ''.join(self.idx_to_char[c] for c in labels)
+            for labels in self.decode_labels(log_probs, input_lengths)
+        ]
+
+    @staticmethod
+    def add_model_specific_args(parent_parser):
+        parser = parent_parser.add_argument_group("CTCBeamSearchDecoder")
+        parser.add_argument("--beam_width", type=int, default=10)
+        parser.add_argument("--beam_top_k", type=int, default=16)
+        parser.add_argument("--beam_prune_threshold", type=float, default=-12.0)
+        parser.add_argument("--lm", type=str, default=None, help="ARPA n-gram language model")
+        parser.add_argument("--lm_unit", type=str, default="char", choices=["char", "word"])
+        parser.add_argument("--lm_weight", type=float, default=0.5)
+        parser.add_argument("--insertion_bonus", type=float, default=0.0)
+        parser.add_argument("--lm_space_token", type=str, default="<space>")
+        parser.add_argument("--decoder_workers", type=int, default=0)
+        return parent_parser
@@ -0,0 +1,128 @@
+import torch
+from typing import NamedTuple
+
+NEG_INF = float('-inf')
+
+class Alignment(NamedTuple):
+    """
+    Result of force_align for a batch of B samples with up to S target labels
+    and T frames. Entries beyond each sample's length are undefined.
+    """
+    # (B, T) label aligned to each frame (blank included)
+    frame_labels: torch.Tensor
+    # (B, S) first frame of each target label
+    label_start: torch.Tensor
+    # (B, S) one past the last frame of each target label
+    label_end: torch.Tensor
+    # (B, S) mean posterior probability of each target label over its frames
+    label_confidence: torch.Tensor
+    # (B,) log probability of the best path (-inf if no alignment exists)
+    score: torch.Tensor
+
+def force_align(
+    log_probs: torch.Tensor,
+    targets: torch.Tensor,
+    input_lengths: torch.Tensor,
+    target_lengths: torch.Tensor,
+    blank: int = 0
+) -> Alignment:
+    """
+    Batched CTC Viterbi (forced) alignment.
+
+    The trellis of all samples is computed at once over the CTC extended
+    label sequence (targets interleaved with blanks), one frame at a time, on
+    the device of log_probs. Back-pointers are kept as int8 and the best path
+    is traced back for the whole batch with tensor ops.
+
+    Args:
+        log_probs: Tensor of shape (T, B, C) containing log probabilities
+        targets: Tensor of shape (B, S) with the padded target labels
+        input_lengths: Tensor of shape (B,) with the number of valid frames
+        target_lengths: Tensor of shape (B,) with the number of target labels
+
+    Returns:
+        Alignment of each sample
+    """
+    num_frames, batch_size, _ = log_probs.shape
+    device = log_probs.device
+    targets = targets.to(device).long()
+    input_lengths = input_lengths.to(device).long()
+    target_lengths = target_lengths.to(device).long()
+    max_labels = targets.size(1)
+    num_states = 2 * max_labels + 1
+
+    # Extended label sequence: blank, y1, blank, y2, ..., blank
+    ext = torch.full((batch_size, num_states), blank, dtype=torch.long, device=device)
+    ext[:, 1::2] = targets
+    states = torch.arange(num_states, device=device)
+    valid_state = states.unsqueeze(0) < (2 * target_lengths + 1).unsqueeze(1)
+
+    # Skipping the previous blank is allowed between different labels
+    can_skip = torch.zeros(batch_size, num_states, dtype=torch.bool, device=device)
+    can_skip[:, 2:] = (ext[:, 2:] != blank) & (ext[:, 2:] != ext[:, :-2])
+
+    emissions = log_probs.float().gather(2, ext.unsqueeze(0).expand(num_frames, -1, -1))  # (T, B, S')
+
+    alpha = torch.full((batch_size, num_states), NEG_INF, device=device)
+    alpha[:, 0] = emissions[0, :, 0]
+    if num_states > 1:
+        alpha[:, 1] = emissions[0, :, 1]
+    alpha = alpha.masked_fill(~valid_state, NEG_INF)
+
+    backpointers = torch.zeros(num_frames, batch_size, num_states, dtype=torch.int8, device=device)
+    neg_inf = torch.full((batch_size, 1), NEG_INF, device=device)
+    for t in range(1, num_frames):
+        stay = alpha
+        step = torch.cat([neg_inf, alpha[:, :-1]], dim=1)
+        skip = torch.cat([neg_inf, neg_inf, alpha[:, :-2]], dim=1).masked_fill(~can_skip, NEG_INF)
+        best, move = torch.stack([stay, step, skip], dim=0).max(dim=0)
+        new_alpha = (best + emissions[t]).masked_fill(~valid_state, NEG_INF)
+        # Samples that already ended keep their last trellis column
+        active = (t < input_lengths).unsqueeze(1)
+        alpha = torch.where(active, new_alpha, alpha)
+        backpointers[t] = move.to(torch.int8)
+
+    # A path ends either in the last label or in the final blank
+    batch = torch.arange(batch_size, device=device)
+    last_blank = 2 * target_lengths
+    last_label = (last_blank - 1).clamp(min=0)
+    end_blank = alpha[batch, last_blank]
+    end_label = torch.where(target_lengths > 0, alpha[batch, last_label], torch.full_like(end_blank, NEG_INF))
+    state = torch.where(end_label > end_blank, last_label, last_blank)
+    score = torch.maximum(end_label, end_blank)
+
+    # Trace back the best path of all samples at once
+    path = torch.zeros(num_frames, batch_size, dtype=torch.long, device=device)
+    for t in range(num_frames - 1, -1, -1):
+        active = t < input_lengths
+        path[t] = torch.where(active, state, path[t])
+        if t > 0:
+            state = torch.where(active, state - backpointers[t, batch, state].long(), state)
+    path = path.transpose(0, 1)  # (B, T)
+
+    frames = torch.arange(num_frames, device=device).unsqueeze(0).expand(batch_size, -1)
+    in_sample = frames < input_lengths.unsqueeze(1)
+    frame_labels = ext.gather(1, path).masked_fill(~in_sample, blank)
+
+    # Frame span and confidence of each target label (odd states)
+    is_label = in_sample & (path % 2 == 1)
+    label_idx = torch.where(is_label, path // 2, torch.full_like(path, max_labels))
+    label_start = torch.full((batch_size, max_labels + 1), num_frames, dtype=torch.long, device=device)
+    label_start.scatter_reduce_(1, label_idx, frames, reduce='amin')
+    label_end = torch.zeros(batch_size, max_labels + 1, dtype=torch.long, device=device)
+    label_end.scatter_reduce_(1, label_idx, frames + 1, reduce='amax')
+
+    frame_probs = emissions.transpose(0, 1).gather(2, path.unsqueeze(2)).squeeze(2).exp()
+    prob_sum = torch.zeros(batch_size, max_labels + 1, device=device)
+    prob_sum.scatter_add_(1, label_idx, frame_probs.masked_fill(~is_label, 0.0))
+    count = torch.zeros(batch_size, max_labels + 1, device=device)
+    count.scatter_add_(1, label_idx, is_label.float())
+    label_confidence = prob_sum / count.clamp(min=1)
+
+    return Alignment(
+        frame_labels=frame_labels,
+        label_start=label_start[:, :max_labels],
+        label_end=label_end[:, :max_labels],
+        label_confidence=label_confidence[:, :max_labels],
+        score=score
+    )
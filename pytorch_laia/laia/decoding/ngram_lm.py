@@ -0,0 +1,153 @@
+import math
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+LOG_10 = math.log(10.0)
+
+class NGramLM:
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        levels: List[List[Tuple[Tuple[int, ...], float, float]]],
+        bos: str = '<s>',
+        eos: str = '</s>',
+        unk: str = '<unk>',
+        unk_logprob: float = -10.0
+    ):
+        """
+        Backoff n-gram language model stored in a compact array-based trie.
+
+        Nodes of each order are stored contiguously in flat arrays and sorted
+        by (parent, token), so the children of a node form a contiguous range
+        that is searched with bisection. Use NGramLM.from_arpa to load a model.
+
+        Args:
+            vocab: Mapping from LM tokens to integer ids
+            levels: For each order n (starting at 1), a list of
+                (ngram ids, log10 prob, log10 backoff) entries
+            bos: Sentence begin token
+            eos: Sentence end token
+            unk: Unknown token
+            unk_logprob: log10 probability of tokens unknown to the model,
+                used when unk is not part of the model
+        """
+        self.vocab = vocab
+        self.order = len(levels)
+        self.bos = vocab.get(bos, -1)
+        self.eos = vocab.get(eos, -1)
+        self.unk = vocab.get(unk, -1)
+
+        self.tokens = array('i')
+        self.logprobs = array('f')
+        self.backoffs = array('f')
+        self.child_begin = array('i')
+        self.child_end = array('i')
+
+        # Node ids of the previous order, indexed by their n-gram
+        parents: Dict[Tuple[int, ...], int] = {(): -1}
+        root_begin, root_end = 0, 0
+        for n, entries in enumerate(levels, start=1):
+            entries = [e for e in entries if e[0][:-1] in parents]
+            entries.sort(key=lambda e: (parents[e[0][:-1]], e[0][-1]))
+            first = len(self.tokens)
+            nodes: Dict[Tuple[int, ...], int] = {}
+            for i, (ngram, logprob, backoff) in enumerate(entries):
+                node = first + i
+                nodes[ngram] = node
+                self.tokens.append(ngram[-1])
+                self.logprobs.append(logprob)
+                self.backoffs.append(backoff)
+                self.child_begin.append(0)
+                self.child_end.append(0)
+                parent = parents[ngram[:-1]]
+                if parent >= 0:
+                    if self.child_end[parent] == 0:
+                        self.child_begin[parent] = node
+                    self.child_end[parent] = node + 1
+            if n == 1:
+                root_begin, root_end = first, len(self.tokens)
+            parents = nodes
+        self.root_range = (root_begin, root_end)
+
+        if self.unk >= 0 and self._find((self.unk,)) >= 0:
+            unk_logprob = self.logprobs[self._find((self.unk,))]
+        self.unk_logprob = unk_logprob * LOG_10
+        self.max_cache_size = 1 << 20
+        self._cache: Dict[Tuple[Tuple[int, ...], int], Tuple[float, Tuple[int, ...]]] = {}
+
+    @classmethod
+    def from_arpa(cls, path: str, **kwargs) -> 'NGramLM':
+        """Load a model from an ARPA file."""
+        vocab: Dict[str, int] = {}
+        levels: List[List[Tuple[Tuple[int, ...], float, float]]] = []
+        order = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('ngram ') or line in ('\\data\\', '\\end\\'):
+                    continue
+                if line.startswith('\\') and line.endswith('-grams:'):
+                    order = int(line[1:line.index('-')])
+                    while len(levels) < order:
+                        levels.append([])
+                    continue
+                if order == 0:
+                    continue
+                fields = line.split()
+                logprob = float(fields[0])
+                words = fields[1:order + 1]
+                backoff = float(fields[order + 1]) if len(fields) > order + 1 else 0.0
+                ngram = tuple(vocab.setdefault(w, len(vocab)) for w in words)
+                levels[order - 1].append((ngram, logprob, backoff))
+        return cls(vocab, levels, **kwargs)
+
+    def _find(self, ngram: Sequence[int]) -> int:
+        begin, end = self.root_range
+        node = -1
+        for token in ngram:
+            i = bisect_left(self.tokens, token, begin, end)
+            if i >= end or self.tokens[i] != token:
+                return -1
+            node = i
+            begin, end = self.child_begin[node], self.child_end[node]
+        return node
+
+    def initial_state(self) -> Tuple[int, ...]:
+        return (self.bos,) if self.bos >= 0 else ()
+
+    def score(self, state: Tuple[int, ...], token: int) -> Tuple[float, Tuple[int, ...]]:
+        """
+        Natural log probability of token given the history in state.
+
+        Returns:
+            The log probability and the state after observing token
+        """
+        key = (state, token)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        logprob = None
+        backoff = 0.0
+        for start in range(len(state) + 1):
+            context = state[start:]
+            node = self._find(context + (token,))
+            if node >= 0:
+                logprob = (backoff + self.logprobs[node]) * LOG_10
+                break
+            node = self._find(context)
+            if node >= 0:
+                backoff += self.backoffs[node]
+        if logprob is None:
+            logprob = backoff * LOG_10 + self.unk_logprob
+
+        new_state = (state + (token,))[-(self.order - 1):] if self.order > 1 else ()
+        if len(self._cache) >= self.max_cache_size:
+            self._cache.clear()
+        self._cache[key] = (logprob, new_state)
+        return logprob, new_state
+
+    def final_score(self, state: Tuple[int, ...]) -> float:
+        """Natural log probability of ending the sentence after state."""
+        return self.score(state, self.eos)[0] if self.eos >= 0 else 0.0
@@ -0,0 +1,4 @@
+from .pool import InferencePool
+from .precision import PRECISIONS, inference_context, prepare_model
+
+__all__ = ['InferencePool', 'PRECISIONS', 'inference_context', 'prepare_model']
@@ -0,0 +1,171 @@
+import time
+import torch
+from torch import nn
+from torch.ao import quantization
+from typing import Dict, Iterable, Optional
+
+from ..data.collate import normalize_images
+from ..models.crnn import CRNN
+from ..utils.metrics import EditOperationCounts, TextRecognitionMetrics
+from .precision import inference_context
+
+def load_model(
+    checkpoint: str,
+    num_classes: int,
+    cnn_output_size: int = 512,
+    lstm_hidden_size: int = 256,
+    lstm_layers: int = 2
+) -> nn.Module:
+    """
+    Load a model for inference, on the CPU and in evaluation mode.
+
+    Args:
+        checkpoint: Either a TorchScript model written by export_model.py, or a
+            (Lightning) checkpoint / state dict of a CRNN
+        num_classes: Number of output classes (including blank)
+        cnn_output_size: Size of CNN feature maps (CRNN checkpoints only)
+        lstm_hidden_size: Number of LSTM hidden units (CRNN checkpoints only)
+        lstm_layers: Number of LSTM layers (CRNN checkpoints only)
+    """
+    try:
+        model = torch.jit.load(checkpoint, map_location='cpu')
+    except RuntimeError:
+        model = None
+
+    if model is None:
+        model = CRNN(
+            num_classes=num_classes,
+            cnn_output_size=cnn_output_size,
+            lstm_hidden_size=lstm_hidden_size,
+            lstm_layers=lstm_layers,
+            dropout=0.0  # No dropout during evaluation
+        )
+        # Lightning checkpoints written before the optimizer class was left
+        # out of the hyperparameters pickle it, which weights_only=True rejects
+        state_dict = torch.load(checkpoint, map_location='cpu', weights_only=False)
+        if 'state_dict' in state_dict:
+            state_dict = state_dict['state_dict']
+            # Remove 'model.' prefix if it exists (from Lightning checkpoint)
+            state_dict = {k.replace('model.', ''): v for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+
+    model.eval()
+    return model
+
+def _fusable_groups(cnn: nn.Sequential, with_relu: bool):
+    """Names of the (Conv2d, BatchNorm2d[, ReLU]) groups of a Sequential."""
+    modules = list(cnn.named_children())
+    groups = []
+    for i, (name, module) in enumerate(modules):
+        if not isinstance(module, nn.Conv2d):
+            continue
+        group = [name]
+        if i + 1 < len(modules) and isinstance(modules[i + 1][1], nn.BatchNorm2d):
+            group.append(modules[i + 1][0])
+        if with_relu:
+            j = i + len(group)
+            if j < len(modules) and isinstance(modules[j][1], nn.ReLU):
+                group.append(modules[j][0])
+        if len(group) > 1:
+            groups.append(group)
+    return groups
+
+def fold_batch_norm(model: CRNN, with_relu: bool = False) -> CRNN:
+    """
+    Fold every BatchNorm2d of the CNN into its preceding convolution.
+
+    Args:
+        model: CRNN in evaluation mode (modified in place)
+        with_relu: Also fuse the following ReLU (needed for static quantization)
+    """
+    model.eval()
+    quantization.fuse_modules(model.cnn, _fusable_groups(model.cnn, with_relu), inplace=True)
+    return model
+
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    """Dynamic int8 quantization of the LSTM and linear layers."""
+    return quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+def quantize_cnn_static(
+    model: CRNN,
+    calibration_batches: Iterable[torch.Tensor],
+    backend: Optional[str] = None
+) -> CRNN:
+    """
+    Static int8 quantization of the convolutional layers.
+
+    Activation ranges are observed on the calibration batches. The CNN
+    receives and returns float tensors, so the rest of the model is unchanged.
+
+    Args:
+        model: CRNN in evaluation mode (modified in place)
+        calibration_batches: Iterable over image batches of shape (B, C, H, W)
+        backend: Quantized engine (by default, the current one)
+    """
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    fold_batch_norm(model, with_relu=True)
+    model.cnn = nn.Sequential(quantization.QuantStub(), model.cnn, quantization.DeQuantStub())
+    model.cnn.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(model.cnn, inplace=True)
+    with torch.no_grad():
+        for images in calibration_batches:
+            model.cnn(images)
+    quantization.convert(model.cnn, inplace=True)
+    return model
+
+def to_torchscript(model: nn.Module) -> torch.jit.ScriptModule:
+    """
+    Compile a model with TorchScript.
+
+    The model is scripted rather than traced: a traced model would only take
+    the images, not the (images, widths) called by predict.py and
+    InferencePool.
+    """
+    try:
+        return torch.jit.script(model)
+    except Exception as e:
+        raise RuntimeError(f"The model must be scriptable to be exported: {e}") from e
+
+def evaluate_model(
+    model: nn.Module,
+    loader: Iterable,
+    metrics: TextRecognitionMetrics,
+    device: torch.device = torch.device('cpu'),
+    precision: str = 'fp32',
+    channels_last: bool = False
+) -> Dict[str, float]:
+    """
+    Compute the CER and WER of a model over a HandwritingDataset loader and
+    its throughput in lines per second (model forward and decoding only).
+
+    Args:
+        model: Model, already on device
+        loader: HandwritingDataset loader
+        metrics: Metrics used for decoding and edit operations
+        device: Device to run the model on
+        precision: Autocast precision, see laia.inference.precision
+        channels_last: Pass the images in channels-last memory format
+    """
+    char_errors, word_errors = EditOperationCounts(), EditOperationCounts()
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    elapsed, num_lines = 0.0, 0
+    with inference_context(device, precision):
+        for images, texts, widths, text_lengths in loader:
+            start = time.perf_counter()
+            images = normalize_images(images.to(device)).contiguous(memory_format=memory_format)
+            outputs = model(images, widths.to(device))
+            input_lengths = model.get_output_lengths(widths)
+            outputs = torch.nn.functional.log_softmax(outputs.float(), dim=2).transpose(0, 1)  # (T, B, C)
+            labels, lengths = metrics.greedy_decode(outputs, input_lengths)
+            predictions = metrics.labels_to_strings(labels, lengths)
+            elapsed += time.perf_counter() - start
+            num_lines += images.size(0)
+            operations = metrics.edit_operations(labels, lengths, texts, text_lengths, predictions=predictions)
+            char_errors.update(*operations['char'])
+            word_errors.update(*operations['word'])
+    return {
+        'cer': char_errors.compute()['rate'],
+        'wer': word_errors.compute()['rate'],
+        'lines_per_second': num_lines / elapsed if elapsed > 0 else 0.0
+    }
@@ -0,0 +1,201 @@
+import io
+import os
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ..data.image_list_dataset import ImageListDataset
+
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    """Split an iterable into lists of (at most) size elements."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def split_cores(num_procs: int) -> List[List[int]]:
+    """Split the cores available to this process into num_procs contiguous groups."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    groups = [cores[i * len(cores) // num_procs:(i + 1) * len(cores) // num_procs] for i in range(num_procs)]
+    # With more processes than cores, some processes share a core
+    return [group or [cores[i % len(cores)]] for i, group in enumerate(groups)]
+
+def _worker_main(
+    model: nn.Module,
+    decoder: Any,
+    cores: List[int],
+    num_threads: int,
+    dataset_kwargs: Dict,
+    tasks,
+    results
+):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    if isinstance(model, bytes):
+        # Serialized TorchScript model
+        model = torch.jit.load(io.BytesIO(model), map_location='cpu')
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, image_paths = task
+        try:
+            dataset = ImageListDataset(image_paths, **dataset_kwargs)
+            batch = ImageListDataset.collate_fn([dataset[i] for i in range(len(dataset))])
+            texts: List[Optional[str]] = [None] * len(image_paths)
+            if batch is not None:
+                images, widths, indices = batch
+                with torch.no_grad():
+                    outputs = model(images, widths)
+                    input_lengths = model.get_output_lengths(widths)
+                    outputs = torch.nn.functional.log_softmax(outputs, dim=2).transpose(0, 1)  # (T, B, C)
+                    predictions = decoder.decode_predictions(outputs, input_lengths)
+                for idx, text in zip(indices, predictions):
+                    texts[idx] = text
+            results.put((task_id, texts, None))
+        except Exception:
+            results.put((task_id, None, traceback.format_exc()))
+
+class InferencePool:
+    def __init__(
+        self,
+        model: nn.Module,
+        decoder: Any,
+        num_procs: int,
+        threads_per_proc: Optional[int] = None,
+        data_dir: Optional[str] = None,
+        img_height: int = 64,
+        max_width: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        fast_decode: bool = False
+    ):
+        """
+        Pool of CPU worker processes running a model over lists of images.
+
+        The model parameters are moved to shared memory, so all workers use
+        the same read-only copy of the weights (TorchScript models are
+        instead loaded by each worker). Each worker is pinned to its
+        own group of cores and uses that many intra-op threads. Batches are
+        dispatched to the workers as they become free, and the results are
+        returned in input order.
+
+        Args:
+            model: Model (or TorchScript model) in evaluation mode, on the CPU
+            decoder: Object with a decode_predictions(log_probs, input_lengths)
+                method, e.g. TextRecognitionMetrics or CTCBeamSearchDecoder
+            num_procs: Number of worker processes
+            threads_per_proc: Intra-op threads per worker (by default, the
+                number of cores assigned to it)
+            data_dir: Optional directory that relative paths are resolved against
+            img_height: Height to resize images to (maintaining aspect ratio)
+            max_width: Maximum width of images after resizing (None for no limit)
+            max_pending: Maximum number of batches in flight (by default,
+                4 per worker), which bounds memory usage
+            fast_decode: Downscale while decoding when the format allows it (see load_line_image)
+        """
+        self.num_procs = num_procs
+        self.max_pending = max_pending or 4 * num_procs
+
+        model.eval()
+        if isinstance(model, torch.jit.ScriptModule):
+            # TorchScript models cannot be pickled, so each worker loads its
+            # own copy of the (usually quantized, hence small) weights
+            buffer = io.BytesIO()
+            torch.jit.save(model, buffer)
+            model = buffer.getvalue()
+        else:
+            model.share_memory()
+
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        dataset_kwargs = {
+            'data_dir': data_dir, 'img_height': img_height, 'max_width': max_width, 'fast_decode': fast_decode
+        }
+        self.processes = []
+        for cores in split_cores(num_procs):
+            process = ctx.Process(
+                target=_worker_main,
+                args=(model, decoder, cores, threads_per_proc or len(cores), dataset_kwargs,
+                      self.tasks, self.results),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+
+    def _get_result(self) -> Tuple[int, List[Optional[str]]]:
+        while True:
+            try:
+                task_id, texts, error = self.results.get(timeout=1.0)
+            except queue.Empty:
+                if any(not p.is_alive() for p in self.processes):
+                    raise RuntimeError("An inference worker died unexpectedly")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Inference worker failed:\n{error}")
+            return task_id, texts
+
+    def map(self, image_paths: Iterable[str], batch_size: int = 32) -> Iterator[Tuple[str, Optional[str]]]:
+        """
+        Transcribe images.
+
+        Args:
+            image_paths: Iterable over image paths (consumed lazily)
+            batch_size: Number of images per batch
+
+        Yields:
+            (image path, transcript) pairs in input order; the transcript is
+            None if the image could not be loaded
+        """
+        batches = iter_chunks(image_paths, batch_size)
+        submitted: Dict[int, List[str]] = {}
+        finished: Dict[int, List[Optional[str]]] = {}
+        next_task, next_output = 0, 0
+
+        while True:
+            # Keep the workers busy, without reading the whole input
+            while next_task - next_output < self.max_pending:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                self.tasks.put((next_task, batch))
+                submitted[next_task] = batch
+                next_task += 1
+
+            if next_output == next_task:
+                return
+
+            while next_output not in finished:
+                task_id, texts = self._get_result()
+                finished[task_id] = texts
+            yield from zip(submitted.pop(next_output), finished.pop(next_output))
+            next_output += 1
+
+    def close(self):
+        """Stop the worker processes."""
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self) -> 'InferencePool':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
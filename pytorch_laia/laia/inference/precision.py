@@ -0,0 +1,64 @@
+import contextlib
+import warnings
+import torch
+from torch import nn
+from typing import Iterator, Optional
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+def autocast_dtype(precision: str, device: torch.device) -> Optional[torch.dtype]:
+    """
+    Data type to autocast to for a precision on a device (None for fp32).
+
+    fp16 is replaced by bf16 on the CPU, and bf16 by fp16 on GPUs that do not
+    support it.
+    """
+    dtype = PRECISIONS[precision]
+    if dtype == torch.float32:
+        return None
+    if device.type == 'cpu' and dtype == torch.float16:
+        warnings.warn("fp16 autocast is not efficient on the CPU, using bf16 instead")
+        return torch.bfloat16
+    if device.type == 'cuda' and dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        warnings.warn("This GPU does not support bf16, using fp16 instead")
+        return torch.float16
+    return dtype
+
+def prepare_model(
+    model: nn.Module,
+    device: torch.device,
+    channels_last: bool = False,
+    compile: bool = False
+) -> nn.Module:
+    """
+    Move a model to a device for inference, optionally converting its
+    convolutions to the channels-last memory format and compiling it.
+
+    TorchScript models are not compiled (they are already optimized by the
+    TorchScript runtime).
+    """
+    model = model.to(device).eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if compile:
+        if isinstance(model, torch.jit.ScriptModule):
+            warnings.warn("TorchScript models cannot be compiled, ignoring compile")
+        else:
+            # Image widths vary across batches
+            model = torch.compile(model, dynamic=True)
+    return model
+
+@contextlib.contextmanager
+def inference_context(device: torch.device, precision: str = 'fp32') -> Iterator[None]:
+    """Context for running inference: no autograd tracking, and autocast if precision is not fp32."""
+    dtype = autocast_dtype(precision, device)
+    with torch.inference_mode():
+        if dtype is None:
+            yield
+        else:
+            with torch.autocast(device.type, dtype=dtype):
+                yield
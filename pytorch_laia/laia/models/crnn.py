@@ -1,6 +1,11 @@
 import torch
 import torch.nn as nn
-from typing import Optional, Tuple
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from typing import List, Optional, Tuple
+
+def _width_param(value) -> int:
+    """Width component of a (possibly per-dimension) layer parameter."""
+    return value[1] if isinstance(value, tuple) else value
 
 class CRNN(nn.Module):
     def __init__(
@@ -61,6 +66,16 @@ class CRNN(nn.Module):
             nn.MaxPool2d((2, 1), (2, 1)),  # 512 x H/16 x W/4
         )
         
+        # Width reduction of the CNN, as (kernel, stride, padding, dilation)
+        # along the width of each convolution and pooling layer
+        self.width_reductions: List[Tuple[int, int, int, int]] = [
+            (
+                _width_param(m.kernel_size), _width_param(m.stride),
+                _width_param(m.padding), _width_param(m.dilation)
+            )
+            for m in self.cnn if isinstance(m, (nn.Conv2d, nn.MaxPool2d))
+        ]
+        
         # Bidirectional LSTM
         self.rnn = nn.LSTM(
             input_size=cnn_output_size * 4,  # Height is reduced to H/16
@@ -74,7 +89,35 @@ class CRNN(nn.Module):
         # Final classifier
         self.classifier = nn.Linear(lstm_hidden_size * 2, num_classes)
         
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    @torch.jit.export
+    def get_output_lengths(self, widths: torch.Tensor) -> torch.Tensor:
+        """
+        Number of output frames for input images of the given widths.
+        
+        Args:
+            widths: Tensor of shape (B,) with the (unpadded) image widths
+            
+        Returns:
+            Tensor of shape (B,) with the number of valid output frames
+        """
+        lengths = widths
+        for kernel, stride, padding, dilation in self.width_reductions:
+            lengths = torch.div(
+                lengths + 2 * padding - dilation * (kernel - 1) - 1, stride, rounding_mode='floor'
+            ) + 1
+        return lengths.clamp(min=1)
+        
+    def forward(self, x: torch.Tensor, widths: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Args:
+            x: Tensor of shape (B, C, H, W) with the (padded) images
+            widths: Optional tensor of shape (B,) with the unpadded width of
+                each image. If given, the LSTM skips the padded frames.
+            
+        Returns:
+            Tensor of shape (B, W', num_classes); see get_output_lengths for
+            the number of valid frames of each sample
+        """
         # CNN feature extraction: (B, C, H, W) -> (B, C', H', W')
         conv = self.cnn(x)
         
@@ -84,7 +127,13 @@ class CRNN(nn.Module):
         conv = conv.reshape(batch, width, channels * height)
         
         # RNN sequence modeling: (B, W, C'*H') -> (B, W, 2*H)
-        rnn, _ = self.rnn(conv)
+        if widths is None:
+            rnn, _ = self.rnn(conv)
+        else:
+            lengths = self.get_output_lengths(widths).clamp(max=width).cpu()
+            packed = pack_padded_sequence(conv, lengths, batch_first=True, enforce_sorted=False)
+            packed_rnn, _ = self.rnn(packed)
+            rnn, _ = pad_packed_sequence(packed_rnn, batch_first=True, total_length=width)
         
         # Classification: (B, W, 2*H) -> (B, W, num_classes)
         output = self.classifier(rnn)
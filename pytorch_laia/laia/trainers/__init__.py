@@ -1,3 +1,4 @@
 from .ctc_trainer import CTCTrainer
+from .callbacks import RelativeEarlyStopping
 
-__all__ = ['CTCTrainer'] 
\ No newline at end of file
+__all__ = ['CTCTrainer', 'RelativeEarlyStopping']
@@ -0,0 +1,44 @@
+import pytorch_lightning as pl
+from pytorch_lightning.callbacks import Callback
+from typing import Any, Dict, Optional
+
+class RelativeEarlyStopping(Callback):
+    def __init__(self, monitor: str = 'val_cer', patience: int = 20, threshold: float = 0.0):
+        """
+        Stop training after a number of epochs without a significant improvement.
+
+        Like the Lua trainer's --early_stop_epochs, an improvement is
+        significant if it is larger than threshold relative to the last
+        significant value (lower values are better).
+
+        Args:
+            monitor: Logged metric to monitor, computed at the end of each validation
+            patience: Number of epochs without a significant improvement before stopping
+            threshold: Minimum relative improvement (e.g. 0.01 for 1%)
+        """
+        self.monitor = monitor
+        self.patience = patience
+        self.threshold = threshold
+        self.best_value: Optional[float] = None
+        self.best_epoch = 0
+
+    def on_validation_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule):
+        if trainer.sanity_checking or self.monitor not in trainer.callback_metrics:
+            return
+        value = float(trainer.callback_metrics[self.monitor])
+        epoch = trainer.current_epoch
+        if self.best_value is None or (self.best_value - value) > self.threshold * abs(self.best_value):
+            self.best_value = value
+            self.best_epoch = epoch
+        should_stop = epoch - self.best_epoch >= self.patience
+        # All ranks must take the same decision
+        should_stop = trainer.strategy.reduce_boolean_decision(should_stop, all=False)
+        if should_stop:
+            trainer.should_stop = True
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {'best_value': self.best_value, 'best_epoch': self.best_epoch}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        self.best_value = state_dict['best_value']
+        self.best_epoch = state_dict['best_epoch']
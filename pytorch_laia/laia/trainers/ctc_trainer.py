@@ -1,3 +1,5 @@
+import contextlib
+import math
 import torch
 import pytorch_lightning as pl
 from torch import nn
@@ -6,7 +8,10 @@ from typing import Optional, Dict, Any
 import wandb
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.loggers import WandbLogger
-from ..utils.metrics import TextRecognitionMetrics
+from pytorch_lightning.utilities import rank_zero_warn
+from ..data.collate import normalize_images
+from ..utils.metrics import EditOperationCounts, TextRecognitionMetrics, WeightedMean
+from ..utils.profiling import StepProfiler
 
 class CTCTrainer(pl.LightningModule):
     def __init__(
@@ -20,74 +25,326 @@ class CTCTrainer(pl.LightningModule):
         cer_trim: Optional[int] = None,
         optimizer_class: Any = torch.optim.Adam,
         optimizer_kwargs: Optional[Dict] = None,
+        distorter: Optional[nn.Module] = None,
+        profile: bool = False,
+        profile_trace: Optional[str] = None,
+        train_metrics_every: int = 1,
+        train_metrics_fraction: float = 1.0,
+        optimizer_impl: str = 'auto',
+        lr_scheduler: str = 'none',
+        warmup_steps: int = 0,
+        min_learning_rate: float = 0.0,
+        lr_decay: float = 1.0,
+        lr_decay_after: int = 10,
+        lr_decay_period: int = 1,
+        lr_plateau_patience: int = 5,
+        lr_plateau_threshold: float = 0.0,
     ):
         super().__init__()
-        self.save_hyperparameters(ignore=['model'])
+        # The optimizer class is not saved, so that checkpoints only hold
+        # plain data (torch.load with weights_only=True)
+        self.save_hyperparameters(ignore=['model', 'distorter', 'optimizer_class'])
         self.model = model
+        # Applied to whole training batches once they are on the device
+        self.distorter = distorter
         self.ctc_loss = CTCLoss(zero_infinity=True)
         self.learning_rate = learning_rate
         self.optimizer_class = optimizer_class
         self.optimizer_kwargs = optimizer_kwargs or {}
         self.metrics = TextRecognitionMetrics(char_map, cer_trim=cer_trim)
+        # Per-step timing of the training steps (see laia.utils.profiling)
+        self.profiler = StepProfiler() if profile or profile_trace else None
+        self.profile_trace = profile_trace
+        self._last_batch_end: Optional[float] = None
+        # Number of learning rate decays applied on validation plateaus
+        self._lr_plateau = {'decays': 0, 'best': None, 'bad_epochs': 0}
+        # Corpus-level edit operation counts of the current epoch
+        self.error_counts = {
+            prefix: {'char': EditOperationCounts(), 'word': EditOperationCounts()}
+            for prefix in ('train_', 'val_')
+        }
+        self.losses = {prefix: WeightedMean() for prefix in ('train_', 'val_')}
         
-    def forward(self, x):
-        return self.model(x)
+    def forward(self, x, widths=None):
+        return self.model(x, widths)
+    
+    def _section(self, name):
+        return self.profiler.section(name) if self.profiler is not None else contextlib.nullcontext()
+    
+    def on_train_epoch_start(self):
+        if self.profiler is not None:
+            self._last_batch_end = self.profiler.now()
+        # Lightning only sets the epoch of samplers, not of custom batch
+        # samplers (e.g. WidthBucketBatchSampler), which reshuffle with it
+        batch_sampler = getattr(self.trainer.train_dataloader, 'batch_sampler', None)
+        if callable(getattr(batch_sampler, 'set_epoch', None)):
+            batch_sampler.set_epoch(self.current_epoch)
+    
+    def on_before_batch_transfer(self, batch, dataloader_idx):
+        if self.profiler is not None and self.trainer.training:
+            # The step starts when the previous one ended, to include waiting for data
+            now = self.profiler.now()
+            self.profiler.start_step(self._last_batch_end)
+            self.profiler.add('data_wait', self._last_batch_end or now, now)
+            self._transfer_start = now
+        return batch
+    
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.profiler is not None and self.trainer.training:
+            self.profiler.add('transfer', self._transfer_start, self.profiler.now())
+        # Batches may be transferred as uint8 and normalized here, on the device
+        images, texts, widths, target_lengths = batch
+        images = normalize_images(images)
+        if self.distorter is not None and self.trainer.training:
+            with self._section('distort'), torch.no_grad():
+                images = self.distorter(images, widths)
+        return images, texts, widths, target_lengths
+    
+    def on_before_backward(self, loss):
+        if self.profiler is not None:
+            self._backward_start = self.profiler.now()
+    
+    def on_after_backward(self):
+        if self.profiler is not None:
+            self.profiler.add('backward', self._backward_start, self.profiler.now())
+    
+    def optimizer_step(self, epoch, batch_idx, optimizer, optimizer_closure=None):
+        if self.profiler is None or optimizer_closure is None:
+            return super().optimizer_step(epoch, batch_idx, optimizer, optimizer_closure)
+        
+        # The closure (forward, loss and backward) runs inside optimizer.step(),
+        # so the optimizer time is the total minus the closure time
+        closure_time = 0.0
+        def closure():
+            nonlocal closure_time
+            start = self.profiler.now()
+            try:
+                return optimizer_closure()
+            finally:
+                closure_time += self.profiler.now() - start
+        
+        start = self.profiler.now()
+        super().optimizer_step(epoch, batch_idx, optimizer, closure)
+        end = self.profiler.now()
+        self.profiler.add('optimizer', start, end - closure_time)
+    
+    def on_train_batch_end(self, outputs, batch, batch_idx):
+        if self.profiler is None or not self.profiler.active:
+            return
+        stats = self.profiler.end_step()
+        self._last_batch_end = self.profiler.now()
+        for name, value in stats.items():
+            self.log(f'profile/{name}', value)
+    
+    def on_train_end(self):
+        if self.profiler is not None and self.profile_trace:
+            self.profiler.dump_chrome_trace(self.profile_trace)
     
     def configure_optimizers(self):
+        optimizer_kwargs = dict(self.optimizer_kwargs)
+        optimizer_impl = self.hparams.optimizer_impl
+        if (optimizer_impl == 'fused' and self.hparams.grad_clip > 0
+                and getattr(self.trainer.precision_plugin, 'scaler', None) is not None):
+            # Fused optimizers unscale the gradients inside their step, so
+            # with a gradient scaler (16-bit mixed precision) the gradients
+            # cannot be unscaled for clipping before it
+            rank_zero_warn("Fused optimizers cannot clip gradients with 16-bit mixed precision, using 'foreach'")
+            optimizer_impl = 'foreach'
+        if optimizer_impl in ('fused', 'foreach'):
+            optimizer_kwargs[optimizer_impl] = True
         optimizer = self.optimizer_class(
             self.parameters(),
             lr=self.learning_rate,
-            **self.optimizer_kwargs
+            **optimizer_kwargs
         )
-        return optimizer
+        if self.hparams.lr_scheduler == 'none' and self.hparams.warmup_steps == 0:
+            return optimizer
+        
+        # A single per-step schedule, so that warmup and decay do not override each other
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, self._lr_factor)
+        return {'optimizer': optimizer, 'lr_scheduler': {'scheduler': scheduler, 'interval': 'step'}}
+    
+    def _lr_factor(self, step: int) -> float:
+        """
+        Learning rate at an optimizer step, relative to learning_rate.
+        
+        Linear warmup over warmup_steps, followed by (depending on lr_scheduler):
+        - 'cosine'/'linear': decay to min_learning_rate at the last step
+        - 'exponential': multiply by lr_decay every lr_decay_period epochs after
+          lr_decay_after epochs, like the Lua trainer
+        - 'plateau': multiply by lr_decay when the validation CER has not
+          improved by lr_plateau_threshold (relative) for lr_plateau_patience epochs
+        The decayed learning rate never goes below min_learning_rate.
+        """
+        hparams = self.hparams
+        factor = min(1.0, (step + 1) / hparams.warmup_steps) if hparams.warmup_steps > 0 else 1.0
+        min_factor = min(1.0, hparams.min_learning_rate / self.learning_rate)
+        if hparams.lr_scheduler in ('cosine', 'linear'):
+            total_steps = self.trainer.estimated_stepping_batches
+            if not math.isfinite(total_steps):
+                raise ValueError(f"lr_scheduler '{hparams.lr_scheduler}' requires a maximum number of epochs or steps")
+            progress = min(1.0, max(0, step - hparams.warmup_steps) / max(1, total_steps - hparams.warmup_steps))
+            if hparams.lr_scheduler == 'cosine':
+                decay = 0.5 * (1 + math.cos(math.pi * progress))
+            else:
+                decay = 1 - progress
+            factor *= min_factor + (1 - min_factor) * decay
+        elif hparams.lr_scheduler == 'exponential':
+            # Number of (1-based) epochs in (lr_decay_after, current epoch] that are multiples of the period
+            epoch = self.current_epoch + 1
+            period = hparams.lr_decay_period
+            decays = max(0, epoch // period - hparams.lr_decay_after // period)
+            factor *= max(hparams.lr_decay ** decays, min_factor)
+        elif hparams.lr_scheduler == 'plateau':
+            factor *= max(hparams.lr_decay ** self._lr_plateau['decays'], min_factor)
+        return factor
+    
+    def _update_lr_plateau(self, cer: float):
+        plateau = self._lr_plateau
+        if plateau['best'] is None or plateau['best'] - cer > self.hparams.lr_plateau_threshold * plateau['best']:
+            plateau['best'] = cer
+            plateau['bad_epochs'] = 0
+        else:
+            plateau['bad_epochs'] += 1
+            if plateau['bad_epochs'] > self.hparams.lr_plateau_patience:
+                plateau['decays'] += 1
+                plateau['bad_epochs'] = 0
+    
+    def configure_gradient_clipping(self, optimizer, gradient_clip_val=None, gradient_clip_algorithm=None):
+        # Called by Lightning after the backward pass (and after unscaling the
+        # gradients with mixed precision), right before the optimizer step
+        if gradient_clip_val is None and self.hparams.grad_clip > 0:
+            gradient_clip_val, gradient_clip_algorithm = self.hparams.grad_clip, 'norm'
+        self.clip_gradients(optimizer, gradient_clip_val, gradient_clip_algorithm)
+    
+    def on_save_checkpoint(self, checkpoint):
+        checkpoint['lr_plateau'] = dict(self._lr_plateau)
+    
+    def on_load_checkpoint(self, checkpoint):
+        self._lr_plateau.update(checkpoint.get('lr_plateau', {}))
     
     def _compute_loss_and_metrics(self, batch, batch_idx, prefix=''):
-        images, texts, input_lengths, target_lengths = batch
+        images, texts, widths, target_lengths = batch
         
         # Forward pass
-        log_probs = self(images)  # (B, T, C)
-        log_probs = torch.nn.functional.log_softmax(log_probs, dim=2)
+        with self._section('forward'):
+            log_probs = self(images, widths)  # (B, T, C)
+            input_lengths = self.model.get_output_lengths(widths)
+            log_probs = torch.nn.functional.log_softmax(log_probs, dim=2)
         
         # CTC loss
-        loss = self.ctc_loss(
-            log_probs.transpose(0, 1),  # (T, B, C)
-            texts,
-            input_lengths,
-            target_lengths
-        )
+        with self._section('loss'):
+            loss = self.ctc_loss(
+                log_probs.transpose(0, 1),  # (T, B, C)
+                texts,
+                input_lengths,
+                target_lengths
+            )
+        
+        # The epoch loss is averaged over all samples of all ranks at the end of the epoch
+        self.losses[prefix].update(loss, images.size(0))
+        if prefix == 'train_':
+            self.log(f'{prefix}loss', loss, prog_bar=True)
         
-        # Get target texts for metrics
-        target_texts = []
-        for text, length in zip(texts, target_lengths):
-            target_texts.append(''.join([self.metrics.idx_to_char[i.item()] for i in text[:length]]))
+        if prefix == 'train_':
+            if not self._compute_train_metrics():
+                return loss
+            # Decode a random subset of the batch
+            batch_size = log_probs.size(0)
+            num_samples = max(1, round(self.hparams.train_metrics_fraction * batch_size))
+            if num_samples < batch_size:
+                subset = torch.randperm(batch_size, device=log_probs.device)[:num_samples]
+                log_probs, input_lengths = log_probs[subset], input_lengths[subset]
+                texts, target_lengths = texts[subset], target_lengths[subset]
         
-        # Compute metrics
-        metrics = self.metrics(log_probs.transpose(0, 1), target_texts)
+        # Accumulate edit operations; per-batch rates are only shown for training
+        with self._section('decode'):
+            labels, lengths = self.metrics.greedy_decode(log_probs.detach().transpose(0, 1), input_lengths)
+            predictions = self.metrics.labels_to_strings(labels, lengths)
+        with self._section('metrics'):
+            operations = self.metrics.edit_operations(
+                labels, lengths, texts, target_lengths, predictions=predictions
+            )
+            batch_counts = {
+                unit: self.error_counts[prefix][unit].update(ops, ref_lengths)
+                for unit, (ops, ref_lengths) in operations.items()
+            }
         
-        # Log everything
-        self.log(f'{prefix}loss', loss, prog_bar=True)
-        self.log(f'{prefix}cer', metrics['cer'], prog_bar=True)
-        self.log(f'{prefix}wer', metrics['wer'], prog_bar=True)
+        if prefix == 'train_':
+            self.log(f'{prefix}cer', EditOperationCounts.rates(batch_counts['char'])['rate'], prog_bar=True)
+            self.log(f'{prefix}wer', EditOperationCounts.rates(batch_counts['word'])['rate'], prog_bar=True)
         
         return loss
     
+    def _compute_train_metrics(self) -> bool:
+        """Whether to compute the error rates of the current training step."""
+        every = self.hparams.train_metrics_every
+        return every > 0 and self.global_step % every == 0
+    
     def training_step(self, batch, batch_idx):
-        loss = self._compute_loss_and_metrics(batch, batch_idx, prefix='train_')
-        
-        if self.hparams.grad_clip > 0:
-            torch.nn.utils.clip_grad_norm_(self.parameters(), self.hparams.grad_clip)
-            
-        return loss
+        return self._compute_loss_and_metrics(batch, batch_idx, prefix='train_')
     
     def validation_step(self, batch, batch_idx):
         return self._compute_loss_and_metrics(batch, batch_idx, prefix='val_')
     
+    def _log_corpus_metrics(self, prefix, name_prefix, error_rates=True):
+        """Log the loss and error rates of the whole epoch (over all ranks) and reset them."""
+        self.log(f'{name_prefix}loss', self.losses[prefix].compute(), prog_bar=prefix == 'val_')
+        self.losses[prefix].reset()
+        if not error_rates:
+            return None
+        char_rates = self.error_counts[prefix]['char'].compute()
+        word_rates = self.error_counts[prefix]['word'].compute()
+        self.log(f'{name_prefix}cer', char_rates['rate'], prog_bar=True)
+        self.log(f'{name_prefix}wer', word_rates['rate'], prog_bar=True)
+        for op in ('sub', 'del', 'ins'):
+            self.log(f'{name_prefix}cer_{op}', char_rates[op])
+        for counts in self.error_counts[prefix].values():
+            counts.reset()
+        return char_rates
+    
+    def on_train_epoch_end(self):
+        self._log_corpus_metrics('train_', 'train_epoch_', error_rates=self.hparams.train_metrics_every > 0)
+    
+    def on_validation_epoch_end(self):
+        char_rates = self._log_corpus_metrics('val_', 'val_')
+        if self.hparams.lr_scheduler == 'plateau' and not self.trainer.sanity_checking:
+            self._update_lr_plateau(char_rates['rate'])
+    
     @staticmethod
     def add_model_specific_args(parent_parser):
         parser = parent_parser.add_argument_group("CTCTrainer")
         parser.add_argument("--learning_rate", type=float, default=1e-3)
         parser.add_argument("--batch_size", type=int, default=16)
         parser.add_argument("--use_distortions", type=bool, default=False)
-        parser.add_argument("--grad_clip", type=float, default=0.0)
+        parser.add_argument("--grad_clip", type=float, default=0.0, help="Clip the gradient norm to this value (0 to disable)")
+        parser.add_argument("--optimizer", type=str, default="adam", choices=["adam", "adamw"])
+        parser.add_argument("--weight_decay", type=float, default=0.0)
+        parser.add_argument("--optimizer_impl", type=str, default="auto", choices=["auto", "fused", "foreach"],
+                            help="Optimizer implementation ('fused' is usually the fastest on GPU, but falls back to "
+                            "'foreach' with --grad_clip and 16-bit mixed precision, which it cannot clip)")
+        parser.add_argument("--lr_scheduler", type=str, default="none",
+                            choices=["none", "cosine", "linear", "exponential", "plateau"],
+                            help="Learning rate decay after warmup (see CTCTrainer._lr_factor)")
+        parser.add_argument("--warmup_steps", type=int, default=0, help="Linear learning rate warmup steps")
+        parser.add_argument("--min_learning_rate", type=float, default=0.0)
+        parser.add_argument("--lr_decay", type=float, default=1.0,
+                            help="Decay factor of the 'exponential' and 'plateau' schedulers")
+        parser.add_argument("--lr_decay_after", type=int, default=10,
+                            help="Start the 'exponential' decay after this number of epochs")
+        parser.add_argument("--lr_decay_period", type=int, default=1,
+                            help="Apply the 'exponential' decay every this number of epochs")
+        parser.add_argument("--lr_plateau_patience", type=int, default=5,
+                            help="Epochs without improvement of the validation CER before a 'plateau' decay")
+        parser.add_argument("--lr_plateau_threshold", type=float, default=0.0,
+                            help="Minimum relative improvement of the validation CER for 'plateau'")
         parser.add_argument("--cer_trim", type=int, default=None)
+        parser.add_argument("--train_metrics_every", type=int, default=1,
+                            help="Compute training CER/WER every this many steps (0 to disable)")
+        parser.add_argument("--train_metrics_fraction", type=float, default=1.0,
+                            help="Fraction of each batch decoded for the training CER/WER")
+        parser.add_argument("--profile", action="store_true",
+                            help="Log the time of each stage of the training steps and memory peaks")
+        parser.add_argument("--profile_trace", type=str, default=None,
+                            help="Write a Chrome trace of the last profiled steps to this file (implies --profile)")
         return parent_parser 
\ No newline at end of file
@@ -0,0 +1,69 @@
+import torch
+
+def batched_edit_operations(
+    hyps: torch.Tensor,
+    hyp_lengths: torch.Tensor,
+    refs: torch.Tensor,
+    ref_lengths: torch.Tensor
+) -> torch.Tensor:
+    """
+    Levenshtein alignment of a batch of label sequences, computed with
+    tensor ops on the device of the inputs.
+
+    The DP matrix is computed one reference position at a time, for all
+    samples and hypothesis positions at once: substitutions and deletions
+    only depend on the previous row, and the chain of insertions along the
+    current row is resolved with a cumulative minimum. Ties are broken as in
+    egs/iam/utils/compute-errors.py (substitution, then deletion, then
+    insertion), so the operation counts match it.
+
+    Args:
+        hyps: Tensor of shape (B, N) with the padded hypothesis labels
+        hyp_lengths: Tensor of shape (B,) with the hypothesis lengths
+        refs: Tensor of shape (B, M) with the padded reference labels
+        ref_lengths: Tensor of shape (B,) with the reference lengths
+
+    Returns:
+        Tensor of shape (B, 3) with the number of substitutions, deletions
+        and insertions of each sample (the edit distance is their sum)
+    """
+    device = hyps.device
+    batch_size, max_hyp_length = hyps.shape
+    refs = refs.to(device)
+    hyp_lengths = hyp_lengths.to(device=device, dtype=torch.long)
+    ref_lengths = ref_lengths.to(device=device, dtype=torch.long)
+
+    columns = torch.arange(max_hyp_length + 1, device=device)
+    # Operations (substitutions, deletions, insertions) of the best path to each cell
+    ops = torch.zeros(batch_size, max_hyp_length + 1, 3, dtype=torch.long, device=device)
+    ops[:, :, 2] = columns
+    dist = columns.expand(batch_size, -1)
+
+    final_index = hyp_lengths.view(batch_size, 1, 1).expand(-1, 1, 3)
+    result = ops.gather(1, final_index).squeeze(1)
+    for i in range(1, refs.size(1) + 1):
+        cost = (hyps != refs[:, i - 1:i]).long()  # (B, N)
+
+        # Best of substitution (or match) and deletion, preferring substitution
+        del_dist = dist + 1
+        sub_dist = dist[:, :-1] + cost
+        take_sub = sub_dist <= del_dist[:, 1:]
+        step_dist = del_dist.clone()
+        step_dist[:, 1:] = torch.where(take_sub, sub_dist, del_dist[:, 1:])
+        step_ops = ops.clone()
+        step_ops[:, :, 1] += 1
+        sub_ops = ops[:, :-1].clone()
+        sub_ops[:, :, 0] += cost
+        step_ops[:, 1:] = torch.where(take_sub.unsqueeze(2), sub_ops, step_ops[:, 1:])
+
+        # dist[j] = min_{k <= j} step_dist[k] + (j - k) insertions. On ties,
+        # cummin returns the last index, i.e. the fewest insertions.
+        values, sources = torch.cummin(step_dist - columns, dim=1)
+        dist = values + columns
+        ops = step_ops.gather(1, sources.unsqueeze(2).expand(-1, -1, 3))
+        ops[:, :, 2] += columns - sources
+
+        result = torch.where(
+            (ref_lengths == i).unsqueeze(1), ops.gather(1, final_index).squeeze(1), result
+        )
+    return result
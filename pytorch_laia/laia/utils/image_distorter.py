@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import random
 from typing import Tuple, Optional
 import math
 
@@ -16,6 +15,27 @@ class ImageDistorter(nn.Module):
         elastic_sigma: float = 6.0,
         elastic_alpha: float = 40.0,
     ):
+        """
+        Batched random affine and elastic distortion of line images.
+
+        Meant to be applied to an already collated batch on the training
+        device: one (2, 3) affine matrix is sampled per image and composed
+        with a smooth elastic displacement field, and the whole batch is
+        resampled with a single grid_sample. Each image is transformed around
+        its own center and never reads from (or writes into) the padding.
+
+        Args:
+            max_rotation: Maximum rotation, in degrees
+            max_scale: Scale is sampled from [1 - max_scale, 1 + max_scale]
+            max_shear: Maximum horizontal and vertical shear factor
+            max_translation: Maximum translation, as a fraction of the height
+            random_elastic: Apply elastic distortion
+            elastic_sigma: Smoothness of the elastic field, in pixels (the
+                field is sampled on a grid with this spacing and upsampled)
+            elastic_alpha: Strength of the elastic field; the displacement
+                magnitude matches a Gaussian-filtered uniform field with
+                these sigma and alpha (Simard et al., 2003)
+        """
         super().__init__()
         self.max_rotation = max_rotation
         self.max_scale = max_scale
@@ -26,77 +46,89 @@ class ImageDistorter(nn.Module):
         self.elastic_alpha = elastic_alpha
 
     def get_random_affine_params(
-        self, batch_size: int, height: int, width: int
+        self, batch_size: int, height: int, device: torch.device
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        # Random rotation
-        angle = torch.empty(batch_size).uniform_(-self.max_rotation, self.max_rotation)
-        
-        # Random scale
-        scale = torch.empty(batch_size).uniform_(
-            1 - self.max_scale, 1 + self.max_scale
-        )
-        
-        # Random shear
-        shear = torch.empty(batch_size, 2).uniform_(-self.max_shear, self.max_shear)
-        
-        # Random translation
-        translate = torch.empty(batch_size, 2).uniform_(
-            -self.max_translation, self.max_translation
-        )
-        translate *= torch.tensor([width, height])
-        
-        return angle, scale, shear, translate
-
-    def elastic_deformation_grid(
-        self, batch_size: int, height: int, width: int, device: torch.device
-    ) -> torch.Tensor:
-        if not self.random_elastic:
-            return None
+        """
+        Returns:
+            Tensor of shape (B, 2, 2) with the linear part of each transform
+            and tensor of shape (B, 2) with its translation, in pixels
+        """
+        def uniform(*shape, bound):
+            return torch.empty(*shape, device=device).uniform_(-bound, bound)
 
-        # Create random displacement fields
-        dx = torch.randn(batch_size, height, width, device=device) * self.elastic_alpha
-        dy = torch.randn(batch_size, height, width, device=device) * self.elastic_alpha
+        angle = uniform(batch_size, bound=math.radians(self.max_rotation))
+        scale = 1 + uniform(batch_size, bound=self.max_scale)
+        shear = uniform(batch_size, 2, bound=self.max_shear)
+        translate = uniform(batch_size, 2, bound=self.max_translation) * height
 
-        # Apply Gaussian filter
-        dx = F.gaussian_blur(dx.unsqueeze(1), kernel_size=3, sigma=self.elastic_sigma).squeeze(1)
-        dy = F.gaussian_blur(dy.unsqueeze(1), kernel_size=3, sigma=self.elastic_sigma).squeeze(1)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        rotation = torch.stack([cos, -sin, sin, cos], dim=1).view(batch_size, 2, 2)
+        ones = torch.ones(batch_size, device=device)
+        shearing = torch.stack([ones, shear[:, 0], shear[:, 1], ones], dim=1).view(batch_size, 2, 2)
+        linear = rotation @ shearing * scale.view(batch_size, 1, 1)
+        return linear, translate
 
-        # Create sampling grid
-        x = torch.arange(width, device=device).view(1, 1, -1).repeat(batch_size, height, 1)
-        y = torch.arange(height, device=device).view(1, -1, 1).repeat(batch_size, 1, width)
-
-        x = x + dx
-        y = y + dy
-
-        # Normalize coordinates to [-1, 1]
-        x = 2 * x / (width - 1) - 1
-        y = 2 * y / (height - 1) - 1
+    def elastic_displacement(
+        self, batch_size: int, height: int, width: int, device: torch.device
+    ) -> torch.Tensor:
+        """
+        Returns:
+            Tensor of shape (B, H, W, 2) with smooth random (x, y) displacements, in pixels
+        """
+        grid_h = max(2, math.ceil(height / self.elastic_sigma) + 1)
+        grid_w = max(2, math.ceil(width / self.elastic_sigma) + 1)
+        # Standard deviation of a uniform [-1, 1] field after a Gaussian filter
+        std = self.elastic_alpha / (math.sqrt(12 * math.pi) * self.elastic_sigma)
+        field = torch.randn(batch_size, 2, grid_h, grid_w, device=device) * std
+        field = F.interpolate(field, size=(height, width), mode='bicubic', align_corners=True)
+        return field.permute(0, 2, 3, 1)
 
-        return torch.stack([x, y], dim=3)
+    def forward(self, x: torch.Tensor, widths: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Args:
+            x: Tensor of shape (B, C, H, W) with the (padded) images
+            widths: Optional tensor of shape (B,) with the unpadded width of each image
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        Returns:
+            Distorted images, with the same shape and padding as x
+        """
         batch_size, channels, height, width = x.shape
         device = x.device
+        if widths is None:
+            widths = torch.full((batch_size,), width, device=device)
+        widths = widths.to(device=device, dtype=torch.float32)
 
-        # Get affine parameters
-        angle, scale, shear, translate = self.get_random_affine_params(batch_size, height, width)
-        
-        # Apply affine transformation
-        x = F.affine(
-            x,
-            angle=angle,
-            translate=translate,
-            scale=scale,
-            shear=shear,
-            interpolation=F.InterpolationMode.BILINEAR
+        # Output pixel coordinates relative to the center of each image
+        ys, xs = torch.meshgrid(
+            torch.arange(height, device=device, dtype=torch.float32),
+            torch.arange(width, device=device, dtype=torch.float32),
+            indexing='ij'
         )
+        centers = torch.stack([(widths - 1) / 2, torch.full_like(widths, (height - 1) / 2)], dim=1)  # (B, 2)
+        coords = torch.stack([xs, ys], dim=-1).unsqueeze(0) - centers.view(batch_size, 1, 1, 2)
 
-        # Apply elastic deformation if enabled
+        # Source pixel of each output pixel: c + A (p - c) + t [+ elastic]
+        linear, translate = self.get_random_affine_params(batch_size, height, device)
+        source = torch.einsum('bij,bhwj->bhwi', linear, coords)
+        source = source + (centers + translate).view(batch_size, 1, 1, 2)
         if self.random_elastic:
-            grid = self.elastic_deformation_grid(batch_size, height, width, device)
-            x = F.grid_sample(x, grid, mode='bilinear', padding_mode='border')
+            source = source + self.elastic_displacement(batch_size, height, width, device)
+
+        # Replicate the border of each image instead of reading its padding
+        max_x = (widths - 1).view(batch_size, 1, 1)
+        source_x = torch.minimum(source[..., 0].clamp(min=0), max_x)
+        source_y = source[..., 1].clamp(0, height - 1)
+
+        # Normalize coordinates to [-1, 1] (align_corners=True)
+        grid = torch.stack([
+            2 * source_x / max(width - 1, 1) - 1,
+            2 * source_y / max(height - 1, 1) - 1,
+        ], dim=-1)
+        distorted = F.grid_sample(x, grid.to(x.dtype), mode='bilinear', padding_mode='border', align_corners=True)
 
-        return x
+        # Keep the padding of each image untouched
+        in_image = (xs.unsqueeze(0) < widths.view(batch_size, 1, 1)).unsqueeze(1)
+        return torch.where(in_image, distorted, x)
 
     @staticmethod
     def add_model_specific_args(parent_parser):
@@ -108,4 +140,4 @@ class ImageDistorter(nn.Module):
         parser.add_argument("--random_elastic", type=bool, default=True)
         parser.add_argument("--elastic_sigma", type=float, default=6.0)
         parser.add_argument("--elastic_alpha", type=float, default=40.0)
-        return parent_parser 
\ No newline at end of file
+        return parent_parser
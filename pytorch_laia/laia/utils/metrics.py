@@ -1,6 +1,96 @@
 import torch
+import numpy as np
 import editdistance
-from typing import List, Dict, Optional
+import torch.distributed as dist
+from typing import List, Dict, Optional, Tuple
+
+from .edit_distance import batched_edit_operations
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+    """Sum of a tensor over all ranks, if running distributed (a copy; the input is not modified)."""
+    if not (dist.is_available() and dist.is_initialized()):
+        return tensor
+    tensor = tensor.clone()
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+class EditOperationCounts:
+    def __init__(self):
+        """
+        Corpus-level error rate, accumulated over batches.
+        
+        Keeps the total number of substitutions, deletions, insertions and
+        reference tokens, on the device of the updates, so that updating
+        does not synchronize with the host. The rate is computed from the
+        totals (not as a mean of per-batch rates), and the totals can be
+        summed over distributed ranks.
+        """
+        self.counts: Optional[torch.Tensor] = None
+        
+    def reset(self):
+        self.counts = None
+        
+    def update(self, ops: torch.Tensor, ref_lengths: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            ops: Tensor of shape (B, 3) with the substitutions, deletions
+                and insertions of each sample (see batched_edit_operations)
+            ref_lengths: Tensor of shape (B,) with the reference lengths
+            
+        Returns:
+            Tensor of shape (4,) with the counts of this batch
+        """
+        counts = torch.cat([ops.sum(dim=0), ref_lengths.to(ops.device).sum().view(1)])
+        self.counts = counts if self.counts is None else self.counts + counts
+        return counts
+        
+    def total(self, sync: bool = True) -> torch.Tensor:
+        """Accumulated counts, summed over all ranks if sync and running distributed."""
+        counts = self.counts if self.counts is not None else torch.zeros(4, dtype=torch.long)
+        return all_reduce_sum(counts) if sync else counts
+        
+    @staticmethod
+    def rates(counts: torch.Tensor) -> Dict[str, float]:
+        """Error rate and substitution/deletion/insertion rates of some counts."""
+        sub, dels, ins, ref_length = counts.tolist()
+        if ref_length == 0:
+            return {'rate': 1.0, 'sub': 0.0, 'del': 0.0, 'ins': 0.0}
+        return {
+            'rate': (sub + dels + ins) / ref_length,
+            'sub': sub / ref_length,
+            'del': dels / ref_length,
+            'ins': ins / ref_length
+        }
+        
+    def compute(self, sync: bool = True) -> Dict[str, float]:
+        return self.rates(self.total(sync))
+
+class WeightedMean:
+    def __init__(self):
+        """
+        Mean of a per-sample value (e.g. the loss) accumulated over batches.
+        
+        Like EditOperationCounts, the sum and the number of samples are kept
+        on the device and summed over all ranks when computing the mean, so
+        that ranks with different numbers of samples are weighted correctly.
+        """
+        self.totals: Optional[torch.Tensor] = None
+        
+    def reset(self):
+        self.totals = None
+        
+    def update(self, value: torch.Tensor, weight: int):
+        """Add a batch whose mean value is value, with weight samples."""
+        value = value.detach().double()
+        totals = torch.stack([value * weight, torch.ones_like(value) * weight])
+        self.totals = totals if self.totals is None else self.totals + totals
+        
+    def compute(self, sync: bool = True) -> float:
+        totals = self.totals if self.totals is not None else torch.zeros(2, dtype=torch.float64)
+        value, weight = (all_reduce_sum(totals) if sync else totals).tolist()
+        return value / weight if weight > 0 else float('nan')
 
 class TextRecognitionMetrics:
     def __init__(self, char_map: Dict[str, int], cer_trim: Optional[int] = None):
@@ -14,40 +104,167 @@ class TextRecognitionMetrics:
         """
         self.char_map = char_map
         self.idx_to_char = {v: k for k, v in char_map.items()}
+        # Lookup array for vectorized index-to-character conversion
+        self.idx_to_char_array = np.array(
+            [self.idx_to_char.get(i, '') for i in range(max(self.idx_to_char) + 1)], dtype=object
+        )
         self.cer_trim = cer_trim
         
-    def decode_predictions(self, log_probs: torch.Tensor) -> List[str]:
+    def greedy_decode(
+        self, log_probs: torch.Tensor, input_lengths: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        Decode model predictions using greedy decoding.
+        Batched greedy CTC decoding, done entirely with tensor ops on the
+        device of log_probs.
         
         Args:
             log_probs: Tensor of shape (T, B, C) containing log probabilities
+            input_lengths: Optional tensor of shape (B,) with the number of
+                valid frames of each sample; frames beyond it are ignored
             
         Returns:
-            List of decoded strings
+            Tensor of shape (B, T) with the decoded label indices of each
+            sample left-aligned and padded with blanks (0), and a tensor of
+            shape (B,) with the number of decoded labels
+        """
+        predictions = log_probs.argmax(dim=-1).transpose(0, 1)  # (B, T)
+        
+        # Keep frames that are not blank and differ from the previous frame
+        keep = predictions != 0
+        keep[:, 1:] &= predictions[:, 1:] != predictions[:, :-1]
+        if input_lengths is not None:
+            frames = torch.arange(predictions.size(1), device=predictions.device)
+            keep &= frames.unsqueeze(0) < input_lengths.to(predictions.device).unsqueeze(1)
+        
+        return self._compact(predictions, keep)
+        
+    @staticmethod
+    def _compact(labels: torch.Tensor, keep: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Move the kept labels to the front of each row, preserving their order."""
+        order = torch.sort((~keep).to(torch.uint8), dim=1, stable=True).indices
+        labels = labels.gather(1, order)
+        lengths = keep.sum(dim=1)
+        positions = torch.arange(labels.size(1), device=labels.device)
+        labels = labels.masked_fill(positions.unsqueeze(0) >= lengths.unsqueeze(1), 0)
+        return labels, lengths
+        
+    def labels_to_strings(self, labels: torch.Tensor, lengths: torch.Tensor) -> List[str]:
         """
-        # Get most likely character at each timestep
-        predictions = log_probs.argmax(dim=-1)  # (T, B)
-        predictions = predictions.transpose(0, 1)  # (B, T)
-        
-        decoded = []
-        for pred in predictions:
-            # Remove repeated characters
-            collapsed = []
-            prev_char = None
-            for p in pred:
-                if p != prev_char:  # Skip repeats
-                    collapsed.append(p.item())
-                    prev_char = p
-                    
-            # Remove blanks (index 0)
-            collapsed = [p for p in collapsed if p != 0]
+        Convert padded label sequences to strings, with a single transfer to host.
+        
+        Args:
+            labels: Tensor of shape (B, L) with padded label indices
+            lengths: Tensor of shape (B,) with the number of labels of each row
+        """
+        max_length = int(lengths.max()) if lengths.numel() > 0 else 0
+        labels = labels[:, :max_length].cpu().numpy()
+        lengths = lengths.cpu().numpy()
+        return [''.join(self.idx_to_char_array[row[:n]]) for row, n in zip(labels, lengths)]
+        
+    def encode_strings(self, texts: List[str], device=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Convert strings to padded label sequences (unknown characters are mapped to -1).
+        
+        Returns:
+            Tensor of shape (B, L) with the labels and tensor of shape (B,) with their lengths
+        """
+        lengths = torch.tensor([len(text) for text in texts], dtype=torch.long)
+        labels = torch.zeros(len(texts), max(1, int(lengths.max()) if texts else 1), dtype=torch.long)
+        for i, text in enumerate(texts):
+            labels[i, :len(text)] = torch.tensor([self.char_map.get(c, -1) for c in text], dtype=torch.long)
+        return labels.to(device), lengths.to(device)
+        
+    def trim_labels(self, labels: torch.Tensor, lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Remove leading, trailing and repeated occurrences of the cer_trim label.
+        """
+        positions = torch.arange(labels.size(1), device=labels.device)
+        valid = positions.unsqueeze(0) < lengths.unsqueeze(1)
+        is_trim = (labels == self.cer_trim) & valid
+        content = valid & ~is_trim
+        # Number of non-trim labels up to each position, and after it
+        before = content.cumsum(dim=1)
+        after = before[:, -1:] - before
+        repeated = torch.zeros_like(is_trim)
+        repeated[:, 1:] = is_trim[:, 1:] & is_trim[:, :-1]
+        keep = content | (is_trim & (before > 0) & (after > 0) & ~repeated)
+        return self._compact(labels, keep)
+        
+    def edit_operations(
+        self,
+        labels: torch.Tensor,
+        lengths: torch.Tensor,
+        targets: torch.Tensor,
+        target_lengths: torch.Tensor,
+        predictions: Optional[List[str]] = None,
+        target_texts: Optional[List[str]] = None
+    ) -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Character and word edit operations of a batch of hypotheses.
+        
+        Character operations are computed on the device of labels. Words are
+        mapped to integer ids on the host and aligned with the same batched
+        edit distance.
+        
+        Args:
+            labels: Tensor of shape (B, L) with the padded hypothesis labels
+            lengths: Tensor of shape (B,) with the hypothesis lengths
+            targets: Tensor of shape (B, S) with the padded target labels
+            target_lengths: Tensor of shape (B,) with the target lengths
+            predictions: Optional hypothesis strings (decoded from labels otherwise)
+            target_texts: Optional target strings (decoded from targets otherwise)
             
-            # Convert to string
-            text = ''.join([self.idx_to_char[p] for p in collapsed])
-            decoded.append(text)
+        Returns:
+            Dictionary with the (ops, reference lengths) of 'char' and 'word',
+            where ops is a tensor of shape (B, 3), see EditOperationCounts.update
+        """
+        if predictions is None:
+            predictions = self.labels_to_strings(labels, lengths)
+        if target_texts is None:
+            target_texts = self.labels_to_strings(targets, target_lengths)
+        
+        targets = targets.to(labels.device)
+        target_lengths = target_lengths.to(labels.device)
+        if self.cer_trim is not None:
+            labels, lengths = self.trim_labels(labels, lengths)
+            targets, target_lengths = self.trim_labels(targets, target_lengths)
+        char_ops = batched_edit_operations(labels, lengths, targets, target_lengths)
+        
+        vocab: Dict[str, int] = {}
+        hyp_words = [[vocab.setdefault(w, len(vocab)) for w in text.split()] for text in predictions]
+        ref_words = [[vocab.setdefault(w, len(vocab)) for w in text.split()] for text in target_texts]
+        
+        def pad(sequences):
+            lengths = torch.tensor([len(seq) for seq in sequences], dtype=torch.long)
+            padded = torch.full((len(sequences), max(1, max(map(len, sequences), default=1))), -1, dtype=torch.long)
+            for i, seq in enumerate(sequences):
+                padded[i, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+            return padded, lengths
+        
+        hyp_words, hyp_word_lengths = pad(hyp_words)
+        ref_words, ref_word_lengths = pad(ref_words)
+        word_ops = batched_edit_operations(hyp_words, hyp_word_lengths, ref_words, ref_word_lengths)
+        return {
+            'char': (char_ops, target_lengths),
+            'word': (word_ops.to(char_ops.device), ref_word_lengths.to(char_ops.device))
+        }
+        
+    def decode_predictions(
+        self, log_probs: torch.Tensor, input_lengths: Optional[torch.Tensor] = None
+    ) -> List[str]:
+        """
+        Decode model predictions using greedy decoding.
+        
+        Args:
+            log_probs: Tensor of shape (T, B, C) containing log probabilities
+            input_lengths: Optional tensor of shape (B,) with the number of
+                valid frames of each sample
             
-        return decoded
+        Returns:
+            List of decoded strings
+        """
+        labels, lengths = self.greedy_decode(log_probs, input_lengths)
+        return self.labels_to_strings(labels, lengths)
         
     def compute_cer(self, predictions: List[str], targets: List[str]) -> float:
         """Compute Character Error Rate."""
@@ -82,18 +299,25 @@ class TextRecognitionMetrics:
             
         return total_dist / total_words if total_words > 0 else 1.0
         
-    def __call__(self, log_probs: torch.Tensor, targets: List[str]) -> Dict[str, float]:
+    def __call__(
+        self,
+        log_probs: torch.Tensor,
+        targets: List[str],
+        input_lengths: Optional[torch.Tensor] = None
+    ) -> Dict[str, float]:
         """
         Compute all metrics.
         
         Args:
             log_probs: Tensor of shape (T, B, C) containing log probabilities
             targets: List of target strings
+            input_lengths: Optional tensor of shape (B,) with the number of
+                valid frames of each sample
             
         Returns:
             Dictionary containing CER and WER
         """
-        predictions = self.decode_predictions(log_probs)
+        predictions = self.decode_predictions(log_probs, input_lengths)
         return {
             'cer': self.compute_cer(predictions, targets),
             'wer': self.compute_wer(predictions, targets)
@@ -0,0 +1,134 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import torch
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS of this process (Linux only). Returns whether it was reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def max_rss_mb() -> float:
+    """Peak resident set size of this process since it started, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process since the last reset, in MB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return max_rss_mb()
+
+class StepProfiler:
+    def __init__(self, sync_cuda: bool = True, max_trace_steps: int = 500):
+        """
+        Wall time of the sections of each training step, and memory high-water marks.
+
+        Sections are timed with section() or add(), between start_step() and
+        end_step(), and are also recorded as Chrome trace events (viewable in
+        chrome://tracing or Perfetto) for the last max_trace_steps steps.
+
+        Args:
+            sync_cuda: Synchronize CUDA before and after each section, so that
+                asynchronous kernels are attributed to the right section (at
+                the cost of some overlap between host and device)
+            max_trace_steps: Number of most recent steps kept in the trace
+        """
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.durations: Dict[str, float] = {}
+        self.trace: deque = deque(maxlen=max_trace_steps)
+        self._events: List[Dict] = []
+        self._origin = time.perf_counter()
+        self._step_start: Optional[float] = None
+        self.step = 0
+
+    @property
+    def active(self) -> bool:
+        return self._step_start is not None
+
+    def now(self) -> float:
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def add(self, name: str, start: float, end: float):
+        """Record a section of the current step that ran from start to end (see now())."""
+        if not self.active:
+            return
+        self.durations[name] = self.durations.get(name, 0.0) + end - start
+        self._events.append({
+            'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+            'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6,
+            'args': {'step': self.step}
+        })
+
+    @contextlib.contextmanager
+    def section(self, name: str) -> Iterator[None]:
+        """Time the enclosed code as a section of the current step."""
+        if not self.active:
+            yield
+            return
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, start, self.now())
+
+    def start_step(self, start: Optional[float] = None):
+        """Start a step, optionally at an earlier time (e.g. to include waiting for data)."""
+        self.durations = {}
+        self._events = []
+        reset_peak_rss()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._step_start = start if start is not None else self.now()
+
+    def end_step(self) -> Dict[str, float]:
+        """
+        End the current step.
+
+        Returns:
+            Duration of each section and of the whole step in milliseconds
+            ('<section>_ms' and 'step_ms'), and the peak RSS and peak CUDA
+            memory allocated during the step in MB ('rss_peak_mb' and
+            'cuda_peak_mb')
+        """
+        if not self.active:
+            return {}
+        end = self.now()
+        self._events.append({
+            'name': 'step', 'ph': 'X', 'pid': os.getpid(), 'tid': 1,
+            'ts': (self._step_start - self._origin) * 1e6, 'dur': (end - self._step_start) * 1e6,
+            'args': {'step': self.step}
+        })
+        self.trace.append(self._events)
+
+        stats = {f'{name}_ms': duration * 1000 for name, duration in self.durations.items()}
+        stats['step_ms'] = (end - self._step_start) * 1000
+        stats['rss_peak_mb'] = peak_rss_mb()
+        if torch.cuda.is_available():
+            stats['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / 2**20
+        self._step_start = None
+        self.step += 1
+        return stats
+
+    def dump_chrome_trace(self, path: str):
+        """Write the recorded steps in the Chrome trace event format."""
+        events = [event for step in self.trace for event in step]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
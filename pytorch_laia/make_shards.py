@@ -0,0 +1,47 @@
+import argparse
+import os
+import random
+from tqdm import tqdm
+
+from laia.data.manifest import read_samples
+from laia.data.shards import write_shards
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a ground truth file into tar shards for streaming")
+    parser.add_argument("--data_dir", type=str, required=True, help="Directory containing images")
+    parser.add_argument("--gt_file", type=str, required=True, help="Ground truth file to convert")
+    parser.add_argument("--output", type=str, required=True,
+                      help="Output path prefix (writes <output>-00000.tar, ... and the index <output>.json)")
+    parser.add_argument("--shard_size", type=int, default=5000, help="Number of lines per shard")
+    parser.add_argument("--img_height", type=int, default=None,
+                      help="Store the lines resized to this height (as PNG) instead of the original image files")
+    parser.add_argument("--max_width", type=int, default=None, help="Max width of the resized lines")
+    parser.add_argument("--fast_decode", action="store_true",
+                      help="Downscale images while decoding (JPEG DCT scaling, JPEG 2000 resolution levels)")
+    parser.add_argument("--keep_order", action="store_true",
+                      help="Keep the order of the ground truth file (by default, lines are shuffled across shards)")
+    parser.add_argument("--random_seed", type=int, default=42, help="Random seed for shuffling the lines")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                      help="Number of processes reading the images")
+
+    args = parser.parse_args()
+
+    samples = read_samples(args.gt_file)
+    if not args.keep_order:
+        random.Random(args.random_seed).shuffle(samples)
+
+    index = write_shards(
+        args.data_dir,
+        tqdm(samples, desc="Converting"),
+        args.output,
+        shard_size=args.shard_size,
+        img_height=args.img_height,
+        max_width=args.max_width,
+        fast_decode=args.fast_decode,
+        jobs=args.jobs
+    )
+
+    print(f"Wrote {sum(index['num_samples'])} lines into {len(index['shards'])} shards ({args.output}.json)")
+
+if __name__ == "__main__":
+    main()
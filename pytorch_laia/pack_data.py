@@ -0,0 +1,34 @@
+import argparse
+from tqdm import tqdm
+
+from laia.data.manifest import read_samples
+from laia.data.packed_store import pack_lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack pre-resized line images into a single memory-mappable store")
+    parser.add_argument("--data_dir", type=str, required=True, help="Directory containing images")
+    parser.add_argument("--gt_file", type=str, required=True, help="Ground truth file to pack")
+    parser.add_argument("--output", type=str, required=True,
+                      help="Output path prefix (writes <output>.bin and <output>.index.npz)")
+    parser.add_argument("--img_height", type=int, default=64, help="Input image height")
+    parser.add_argument("--max_width", type=int, default=None, help="Max input image width")
+    parser.add_argument("--fast_decode", action="store_true",
+                      help="Downscale images while decoding (JPEG DCT scaling, JPEG 2000 resolution levels)")
+    
+    args = parser.parse_args()
+    
+    samples = read_samples(args.gt_file)
+    
+    store = pack_lines(
+        args.data_dir,
+        tqdm((sample["image"] for sample in samples), total=len(samples), desc="Packing"),
+        args.output,
+        img_height=args.img_height,
+        max_width=args.max_width,
+        fast_decode=args.fast_decode
+    )
+    
+    print(f"Packed {len(store)} lines ({store.data.nbytes / 2**20:.1f} MiB) into {store.data_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import sys
+import torch
+import json
+from pathlib import Path
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from laia.models.crnn import CRNN
+from laia.inference.export import load_model
+from laia.data.image_list_dataset import ImageListDataset, ImagePathBatches, iter_image_paths
+from laia.utils.metrics import TextRecognitionMetrics
+from laia.decoding import CTCBeamSearchDecoder, NGramLM
+from laia.inference import InferencePool
+
+def write_prediction(output, output_format: str, image: str, text: str):
+    if output_format == "jsonl":
+        output.write(json.dumps({'id': Path(image).stem, 'image': image, 'text': text}, ensure_ascii=False) + '\n')
+    else:
+        output.write(f"{Path(image).stem} {text}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe handwritten text images without ground truth")
+    
+    parser.add_argument("--input", type=str, required=True,
+                        help="Directory of images, file with one image path per line, or '-' for stdin")
+    parser.add_argument("--data_dir", type=str, default=None, help="Directory relative image paths are resolved against")
+    parser.add_argument("--char_map", type=str, required=True, help="Character map JSON file")
+    parser.add_argument("--checkpoint", type=str, required=True, help="Model checkpoint")
+    parser.add_argument("--output", type=str, default="-", help="Output file ('-' for stdout)")
+    parser.add_argument("--output_format", type=str, default="kaldi", choices=["kaldi", "jsonl"],
+                        help="'kaldi' writes 'id text' lines, 'jsonl' one JSON object per line")
+    parser.add_argument("--img_height", type=int, default=64, help="Input image height")
+    parser.add_argument("--max_width", type=int, default=None, help="Max input image width")
+    parser.add_argument("--fast_decode", action="store_true",
+                        help="Downscale images while decoding (JPEG DCT scaling, JPEG 2000 resolution levels)")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of data loading workers")
+    parser.add_argument("--chunk_size", type=int, default=10000,
+                        help="Number of predictions written between flushes of the output")
+    parser.add_argument("--gpu", action="store_true", help="Use GPU for inference")
+    parser.add_argument("--num_procs", type=int, default=1,
+                        help="If > 1, run CPU inference in this many processes, each pinned to its own cores")
+    parser.add_argument("--threads_per_proc", type=int, default=None,
+                        help="Intra-op threads of each inference process (default: its number of cores)")
+    parser.add_argument("--decoder", type=str, default="greedy", choices=["greedy", "beam"],
+                        help="Decoding method")
+    
+    parser = CRNN.add_model_specific_args(parser)
+    parser = CTCBeamSearchDecoder.add_model_specific_args(parser)
+    args = parser.parse_args()
+    
+    with open(args.char_map, 'r', encoding='utf-8') as f:
+        char_map = json.load(f)
+    
+    model = load_model(
+        args.checkpoint,
+        num_classes=len(char_map),
+        cnn_output_size=args.cnn_output_size,
+        lstm_hidden_size=args.lstm_hidden_size,
+        lstm_layers=args.lstm_layers
+    )
+    
+    device = torch.device('cuda' if args.gpu and torch.cuda.is_available() else 'cpu')
+    model = model.to(device)
+    
+    if args.decoder == "beam":
+        decoder = CTCBeamSearchDecoder(
+            char_map,
+            beam_width=args.beam_width,
+            top_k=args.beam_top_k,
+            prune_threshold=args.beam_prune_threshold,
+            lm=NGramLM.from_arpa(args.lm) if args.lm else None,
+            lm_unit=args.lm_unit,
+            lm_weight=args.lm_weight,
+            insertion_bonus=args.insertion_bonus,
+            space_token=args.lm_space_token,
+            num_workers=args.decoder_workers
+        )
+    else:
+        decoder = TextRecognitionMetrics(char_map)
+    
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    progress = tqdm(desc="Predicting", unit="img", file=sys.stderr)
+    
+    if args.num_procs > 1:
+        if device.type != 'cpu':
+            parser.error("--num_procs is only supported for CPU inference")
+        if args.decoder == "beam":
+            # Inference processes cannot start their own decoding workers
+            decoder.num_workers = 0
+        with InferencePool(
+            model,
+            decoder,
+            args.num_procs,
+            threads_per_proc=args.threads_per_proc,
+            data_dir=args.data_dir,
+            img_height=args.img_height,
+            max_width=args.max_width,
+            fast_decode=args.fast_decode
+        ) as pool:
+            for image, text in pool.map(iter_image_paths(args.input), batch_size=args.batch_size):
+                if text is None:
+                    # The worker already warned about the unreadable image
+                    continue
+                write_prediction(output, args.output_format, image, text)
+                progress.update(1)
+    else:
+        predict_in_process(args, model, decoder, device, output, progress)
+    
+    progress.close()
+    if args.decoder == "beam":
+        decoder.close()
+    if output is not sys.stdout:
+        output.close()
+
+def predict_in_process(args, model, decoder, device, output, progress):
+    # The dataset is indexed by image path and the paths are read lazily as batches
+    # are requested, so a single loader serves the whole input without holding it in memory
+    dataset = ImageListDataset(
+        data_dir=args.data_dir,
+        img_height=args.img_height,
+        max_width=args.max_width,
+        fast_decode=args.fast_decode
+    )
+    loader = DataLoader(
+        dataset,
+        batch_sampler=ImagePathBatches(args.input, args.batch_size),
+        num_workers=args.num_workers,
+        collate_fn=ImageListDataset.collate_fn,
+        pin_memory=device.type == 'cuda'
+    )
+    
+    unflushed = 0
+    with torch.no_grad():
+        for batch in loader:
+            if batch is None:
+                continue
+            images, widths, image_paths = batch
+            progress.update(len(image_paths))
+            
+            widths = widths.to(device)
+            outputs = model(images.to(device, non_blocking=True), widths)
+            input_lengths = model.get_output_lengths(widths)
+            outputs = torch.nn.functional.log_softmax(outputs, dim=2).transpose(0, 1)  # (T, B, C)
+            predictions = decoder.decode_predictions(outputs, input_lengths)
+            
+            for image, text in zip(image_paths, predictions):
+                write_prediction(output, args.output_format, image, text)
+            unflushed += len(image_paths)
+            if unflushed >= args.chunk_size:
+                output.flush()
+                unflushed = 0
+    output.flush()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 import argparse
+import hashlib
 import json
+import os
+from multiprocessing import Pool
 from pathlib import Path
-import random
 from PIL import Image
-from typing import Dict, List, Set
-import os
+from tqdm import tqdm
+from typing import Dict, List, Optional, Set, Tuple
+
+from laia.data.manifest import SampleManifest, read_samples, write_samples
+
+SPLITS = ('train', 'val', 'test')
 
 def collect_characters(transcriptions: List[str]) -> Set[str]:
     """Collect all unique characters from transcriptions."""
@@ -13,30 +19,92 @@ def collect_characters(transcriptions: List[str]) -> Set[str]:
         chars.update(set(text))
     return chars
 
-def create_char_map(chars: Set[str], output_file: str):
-    """Create character map file."""
-    # Start with blank token
-    char_map = {"<blank>": 0}
-    
-    # Add space first (if present)
-    if " " in chars:
-        char_map[" "] = len(char_map)
-        chars.remove(" ")
-    
+def create_char_map(chars: Set[str], output_file: str, existing: Optional[Dict[str, int]] = None):
+    """
+    Create character map file.
+
+    If an existing character map is given, its indices are kept and new
+    characters are appended, so that models trained with it remain valid.
+    """
+    if existing:
+        char_map = dict(existing)
+        chars = chars - set(char_map)
+    else:
+        # Start with blank token
+        char_map = {"<blank>": 0}
+
+        # Add space first (if present)
+        if " " in chars:
+            char_map[" "] = len(char_map)
+            chars = chars - {" "}
+
     # Add remaining characters
     for c in sorted(chars):
         char_map[c] = len(char_map)
-    
+
     # Save to file
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(char_map, f, indent=4, ensure_ascii=False)
-    
+
     return char_map
 
-def create_gt_file(data: List[Dict], output_file: str):
-    """Create ground truth JSON file."""
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+def read_transcriptions(transcription_file: str) -> List[Tuple[str, str]]:
+    """Read (image path, text) pairs from a tab-separated file."""
+    data = []
+    with open(transcription_file, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            if '\t' not in line:
+                print(f"Warning: Skipping line {line_number} without a tab: {line!r}")
+                continue
+            img_path, text = line.split('\t', 1)
+            data.append((img_path, text))
+    return data
+
+def probe_image(task: Tuple[str, str, bool]) -> Tuple[str, Optional[Tuple[int, int]], Optional[str]]:
+    """
+    Check that an image can be opened and get its size (run in worker processes).
+
+    Args:
+        task: Image path relative to the images directory, images directory,
+            and whether to decode the whole image (detects truncated files)
+            instead of only reading its header
+
+    Returns:
+        The relative image path, its (width, height) or None, and the error
+        message if the image could not be opened
+    """
+    img_path, images_dir, verify = task
+    try:
+        with Image.open(os.path.join(images_dir, img_path)) as img:
+            if verify:
+                img.load()
+            return img_path, img.size, None
+    except Exception as e:
+        return img_path, None, str(e)
+
+def load_stats(stats_file: Path) -> Dict[str, Dict]:
+    """Image stats of a previous run, by relative image path."""
+    if not stats_file.exists():
+        return {}
+    return {entry["image"]: entry for entry in read_samples(stats_file)}
+
+def split_of(img_path: str, seed: int, val_split: float, test_split: float) -> str:
+    """
+    Split of a sample, from a hash of its image path.
+
+    Unlike shuffling, this keeps the split of every sample when samples are
+    added or removed in later runs.
+    """
+    digest = hashlib.sha1(f"{seed}:{img_path}".encode('utf-8')).digest()
+    u = int.from_bytes(digest[:8], 'big') / 2**64
+    if u < val_split:
+        return 'val'
+    if u < val_split + test_split:
+        return 'test'
+    return 'train'
 
 def main():
     parser = argparse.ArgumentParser(description="Prepare data for PyTorch Laia")
@@ -52,64 +120,108 @@ def main():
                       help="Fraction of data to use for testing")
     parser.add_argument("--random_seed", type=int, default=42,
                       help="Random seed for splitting data")
-    
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                      help="Number of processes used to check the images")
+    parser.add_argument("--verify", action="store_true",
+                      help="Decode every image, instead of only reading its header, to detect truncated files "
+                      "(with --full to also check the images of previous runs)")
+    parser.add_argument("--full", action="store_true",
+                      help="Check all images again, ignoring the stats of previous runs (the character map is kept)")
+    parser.add_argument("--reset_char_map", action="store_true",
+                      help="Build a new character map instead of keeping the indices of the existing char_map.json")
+    parser.add_argument("--binary_index", action="store_true",
+                      help="Also write a binary index of each split (<split>.npz), which loads faster than JSONL")
+
     args = parser.parse_args()
-    
+
     # Create output directory
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    
+
     # Read transcription file
     print("Reading transcription file...")
+    transcriptions = read_transcriptions(args.transcription_file)
+
+    # Images that are new or changed since the last run (by size and
+    # modification time) are checked again, the others keep their stats
+    stats_file = output_dir / "image_stats.jsonl"
+    previous_stats = {} if args.full else load_stats(stats_file)
+    stats: Dict[str, Dict] = {}
+    errors: Dict[str, str] = {}
+    pending = []
+    for img_path in dict.fromkeys(img_path for img_path, _ in transcriptions):
+        try:
+            st = os.stat(os.path.join(args.images_dir, img_path))
+        except OSError as e:
+            errors[img_path] = str(e)
+            continue
+        entry = previous_stats.get(img_path)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            stats[img_path] = entry
+        else:
+            stats[img_path] = {"image": img_path, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+            pending.append(img_path)
+    print(f"Checking {len(pending)} new or changed images ({len(stats) - len(pending)} unchanged)...")
+
+    tasks = ((img_path, args.images_dir, args.verify) for img_path in pending)
+    with Pool(max(1, args.jobs)) as pool:
+        for img_path, size, error in tqdm(
+            pool.imap_unordered(probe_image, tasks, chunksize=64), total=len(pending), desc="Checking"
+        ):
+            if error is not None:
+                errors[img_path] = error
+                del stats[img_path]
+            else:
+                stats[img_path]["width"], stats[img_path]["height"] = size
+
+    for img_path, error in errors.items():
+        print(f"Warning: Could not open image {Path(args.images_dir) / img_path}: {error}")
+    # Images that failed are not recorded, so that they are checked again in the next run
+    write_samples(stats_file, stats.values())
+
     data = []
-    chars = set()
-    with open(args.transcription_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.strip():
-                img_path, text = line.strip().split('\t')
-                # Verify image exists and can be opened
-                img_file = Path(args.images_dir) / img_path
-                try:
-                    img = Image.open(img_file)
-                    img.close()
-                    data.append({
-                        "image": img_path,
-                        "text": text
-                    })
-                    chars.update(set(text))
-                except Exception as e:
-                    print(f"Warning: Could not open image {img_file}: {e}")
-    
+    for img_path, text in transcriptions:
+        if img_path not in stats:
+            continue
+        width, height = stats[img_path]["width"], stats[img_path]["height"]
+        data.append({
+            "image": img_path,
+            "text": text,
+            "width": width,
+            "height": height,
+            "aspect": round(width / height, 4)
+        })
+    chars = collect_characters(sample["text"] for sample in data)
+
     print(f"Found {len(data)} valid image-text pairs")
     print(f"Found {len(chars)} unique characters")
-    
-    # Create character map
+
+    # Create character map, keeping the indices of a previous run
     print("\nCreating character map...")
-    char_map = create_char_map(chars, output_dir / "char_map.json")
-    print(f"Character map saved to {output_dir / 'char_map.json'}")
-    
+    char_map_file = output_dir / "char_map.json"
+    existing = None
+    if char_map_file.exists() and not args.reset_char_map:
+        with open(char_map_file, 'r', encoding='utf-8') as f:
+            existing = json.load(f)
+    char_map = create_char_map(chars, char_map_file, existing)
+    print(f"Character map saved to {char_map_file}")
+
     # Split data
-    random.seed(args.random_seed)
-    random.shuffle(data)
-    
-    val_size = int(len(data) * args.val_split)
-    test_size = int(len(data) * args.test_split)
-    train_size = len(data) - val_size - test_size
-    
-    train_data = data[:train_size]
-    val_data = data[train_size:train_size + val_size]
-    test_data = data[train_size + val_size:]
-    
+    splits = {split: [] for split in SPLITS}
+    for sample in data:
+        splits[split_of(sample["image"], args.random_seed, args.val_split, args.test_split)].append(sample)
+
     # Save splits
     print("\nSaving data splits...")
-    create_gt_file(train_data, output_dir / "train.json")
-    create_gt_file(val_data, output_dir / "val.json")
-    create_gt_file(test_data, output_dir / "test.json")
-    
-    print(f"Training samples: {len(train_data)}")
-    print(f"Validation samples: {len(val_data)}")
-    print(f"Test samples: {len(test_data)}")
+    for split in SPLITS:
+        write_samples(output_dir / f"{split}.jsonl", splits[split])
+        if args.binary_index:
+            SampleManifest.from_samples(splits[split], char_map).save(output_dir / f"{split}.npz")
+
+    print(f"Training samples: {len(splits['train'])}")
+    print(f"Validation samples: {len(splits['val'])}")
+    print(f"Test samples: {len(splits['test'])}")
     print(f"\nData preparation complete. Files saved in {output_dir}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
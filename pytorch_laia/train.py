@@ -1,8 +1,9 @@
 import os
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 import argparse
+import inspect
 import pytorch_lightning as pl
-from pytorch_lightning.callbacks import ModelCheckpoint
+from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 from pytorch_lightning.loggers import WandbLogger
 import torch
 from torch.utils.data import DataLoader
@@ -11,7 +12,13 @@ from pathlib import Path
 
 from laia.models.crnn import CRNN
 from laia.trainers.ctc_trainer import CTCTrainer
+from laia.trainers.callbacks import RelativeEarlyStopping
+from laia.data.collate import PaddedBatchCollator
 from laia.data.handwriting_dataset import HandwritingDataset
+from laia.data.page_dataset import PageLineDataset
+from laia.data.samplers import DistributedWidthBucketBatchSampler, PageGroupedBatchSampler, WidthBucketBatchSampler
+from laia.data.shards import ShardedLineDataset, ShardedLineLoader
+from laia.data.image_cache import ImageCache, SharedImageCache
 from laia.utils.image_distorter import ImageDistorter
 
 def main():
@@ -24,9 +31,54 @@ def main():
     parser.add_argument("--char_map", type=str, required=True, help="Character map JSON file")
     parser.add_argument("--img_height", type=int, default=64, help="Input image height")
     parser.add_argument("--max_width", type=int, default=None, help="Max input image width")
+    parser.add_argument("--fast_decode", action="store_true",
+                        help="Downscale images while decoding (JPEG DCT scaling, JPEG 2000 resolution levels)")
+    parser.add_argument("--train_packed", type=str, default=None, help="Packed store prefix for the training set (see pack_data.py)")
+    parser.add_argument("--val_packed", type=str, default=None, help="Packed store prefix for the validation set (see pack_data.py)")
+    parser.add_argument("--cache_max_size", type=int, default=0,
+                        help="If > 0, cache decoded and resized images, up to this size (MB)")
+    parser.add_argument("--cache_shared", action="store_true",
+                        help="Share the image cache among data loading workers (stored in --cache_dir)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Directory of the shared image cache (default: under /dev/shm)")
+    parser.add_argument("--page_regions", action="store_true",
+                        help="The ground truth files are page line regions (PAGE-XML files or directories, or JSON/JSONL "
+                        "with page, text and bbox or polygon), cropped on the fly from the page images in --data_dir")
+    parser.add_argument("--page_cache_size", type=int, default=256,
+                        help="Size of the cache of decoded page images of each data loading worker (MB), with --page_regions")
+    parser.add_argument("--shards", action="store_true",
+                        help="The ground truth files are indexes of tar shards (see make_shards.py), streamed sequentially")
+    parser.add_argument("--shuffle_buffer", type=int, default=2000,
+                        help="Number of lines in the shuffle buffer of each data loading worker, with --shards")
     parser.add_argument("--num_workers", type=int, default=4, help="Number of data loading workers")
+    parser.add_argument("--bucket_by_width", action="store_true", help="Batch together images of similar width")
+    parser.add_argument("--num_buckets", type=int, default=10, help="Number of width buckets")
+    parser.add_argument("--max_batch_pixels", type=int, default=None,
+                        help="Fill width-bucketed batches up to this number of padded pixels instead of batch_size")
+    parser.add_argument("--curriculum_lambda", type=float, default=0.0,
+                        help="If > 0, sample shorter transcripts more often (requires --bucket_by_width, "
+                        "without --shards or --page_regions)")
+    parser.add_argument("--curriculum_min_length", type=float, default=1.0,
+                        help="Minimum transcript length considered by curriculum sampling")
     parser.add_argument("--max_epochs", type=int, default=100, help="Maximum number of epochs")
+    parser.add_argument("--resume_from", type=str, default=None,
+                        help="Checkpoint to resume training from (with --shards, mid-epoch checkpoints resume the data stream too)")
+    parser.add_argument("--accumulate_grad_batches", type=int, default=1,
+                        help="Accumulate the gradients of this number of batches before each optimizer step")
+    parser.add_argument("--early_stop_epochs", type=int, default=0,
+                        help="If > 0, stop after this number of epochs without a significant improvement of the validation CER")
+    parser.add_argument("--early_stop_threshold", type=float, default=0.0,
+                        help="Minimum relative improvement of the validation CER considered significant")
     parser.add_argument("--gpus", type=int, default=1, help="Number of GPUs to use")
+    parser.add_argument("--accelerator", type=str, default=None, choices=["cpu", "gpu", "mps", "auto"],
+                        help="Accelerator (default: gpu if --gpus > 0, otherwise cpu)")
+    parser.add_argument("--devices", type=int, default=None,
+                        help="Number of devices (processes) per node (default: --gpus, or 1 on the CPU)")
+    parser.add_argument("--num_nodes", type=int, default=1, help="Number of nodes for distributed training")
+    parser.add_argument("--strategy", type=str, default=None,
+                        help="Lightning strategy (default: ddp when training on more than one device)")
+    parser.add_argument("--sync_batchnorm", action="store_true",
+                        help="Synchronize batch normalization statistics across processes")
     parser.add_argument("--wandb_project", type=str, default="laia", help="Weights & Biases project name")
     
     # Add model specific args from each component
@@ -42,9 +94,22 @@ def main():
     parser = ImageDistorter.add_model_specific_args(parser)
     
     args = parser.parse_args()
+    if args.curriculum_lambda > 0 and (not args.bucket_by_width or args.shards or args.page_regions):
+        # Only the width-bucketed sampler draws samples by transcript length
+        parser.error("--curriculum_lambda requires --bucket_by_width (and neither --shards nor --page_regions)")
     
-    # Create datasets
-    train_transform = ImageDistorter(
+    # Create image cache. Without --cache_shared, each data loading worker
+    # has its own cache of --cache_max_size MB.
+    cache = None
+    if args.cache_max_size > 0:
+        if args.cache_shared:
+            cache = SharedImageCache(args.cache_max_size * 2**20, cache_dir=args.cache_dir)
+        else:
+            cache = ImageCache(args.cache_max_size * 2**20)
+    
+    # Create datasets. Images are loaded as uint8, and normalized and
+    # distorted by the trainer on whole batches, on the training device.
+    distorter = ImageDistorter(
         max_rotation=args.max_rotation,
         max_scale=args.max_scale,
         max_shear=args.max_shear,
@@ -54,41 +119,188 @@ def main():
         elastic_alpha=args.elastic_alpha
     ) if args.use_distortions else None
     
-    train_dataset = HandwritingDataset(
-        args.data_dir,
-        args.train_gt,
-        char_map,
-        transform=train_transform,
-        img_height=args.img_height,
-        max_width=args.max_width
-    )
+    if args.shards:
+        # Shards are read sequentially, each data loading worker (of each
+        # rank) reading its own range of lines
+        train_dataset = ShardedLineDataset(
+            args.train_gt,
+            char_map,
+            img_height=args.img_height,
+            max_width=args.max_width,
+            shuffle=True,
+            shuffle_buffer=args.shuffle_buffer,
+            normalize=False,
+            fast_decode=args.fast_decode
+        )
+        
+        val_dataset = ShardedLineDataset(
+            args.val_gt,
+            char_map,
+            img_height=args.img_height,
+            max_width=args.max_width,
+            shuffle=False,
+            # Each validation line is evaluated exactly once
+            even_batches=False,
+            normalize=False,
+            fast_decode=args.fast_decode
+        )
+    elif args.page_regions:
+        # Lines are cropped from the page images, each decoded once per
+        # epoch by the worker that gets its lines (see PageGroupedBatchSampler)
+        train_dataset = PageLineDataset(
+            args.data_dir,
+            args.train_gt,
+            char_map,
+            img_height=args.img_height,
+            max_width=args.max_width,
+            page_cache=ImageCache(args.page_cache_size * 2**20),
+            normalize=False
+        )
+        
+        val_dataset = PageLineDataset(
+            args.data_dir,
+            args.val_gt,
+            char_map,
+            img_height=args.img_height,
+            max_width=args.max_width,
+            page_cache=ImageCache(args.page_cache_size * 2**20),
+            normalize=False
+        )
+    else:
+        train_dataset = HandwritingDataset(
+            args.data_dir,
+            args.train_gt,
+            char_map,
+            img_height=args.img_height,
+            max_width=args.max_width,
+            packed_store=args.train_packed,
+            cache=cache,
+            normalize=False,
+            fast_decode=args.fast_decode
+        )
+        
+        val_dataset = HandwritingDataset(
+            args.data_dir,
+            args.val_gt,
+            char_map,
+            img_height=args.img_height,
+            max_width=args.max_width,
+            packed_store=args.val_packed,
+            cache=cache,
+            normalize=False,
+            fast_decode=args.fast_decode
+        )
     
-    val_dataset = HandwritingDataset(
-        args.data_dir,
-        args.val_gt,
-        char_map,
-        img_height=args.img_height,
-        max_width=args.max_width
-    )
+    accelerator = args.accelerator or ('gpu' if args.gpus > 0 else 'cpu')
+    devices = args.devices or (args.gpus if accelerator == 'gpu' and args.gpus > 0 else 1)
+    world_size = devices * args.num_nodes
     
-    # Create data loaders
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=args.num_workers,
-        collate_fn=HandwritingDataset.collate_fn,
-        pin_memory=True
-    )
-    
-    val_loader = DataLoader(
-        val_dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        num_workers=args.num_workers,
-        collate_fn=HandwritingDataset.collate_fn,
-        pin_memory=True
-    )
+    # Create data loaders. With several processes, width-bucketed batches are
+    # split among them so that all ranks process batches of similar padded
+    # size at each step (otherwise Lightning adds a DistributedSampler).
+    bucket_sampler_class = DistributedWidthBucketBatchSampler if world_size > 1 else WidthBucketBatchSampler
+    # Workers are kept alive across epochs when caching,
+    # otherwise their in-process caches would be lost.
+    persistent_workers = cache is not None and args.num_workers > 0
+    if args.shards:
+        # The loaders keep track of their position, saved in the checkpoints
+        train_loader = ShardedLineLoader(
+            train_dataset,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=True
+        )
+        
+        val_loader = ShardedLineLoader(
+            val_dataset,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=True
+        )
+    elif args.page_regions:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=PageGroupedBatchSampler(
+                train_dataset.page_ids,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                shuffle=True
+            ),
+            num_workers=args.num_workers,
+            collate_fn=PaddedBatchCollator(pin_memory=True),
+            pin_memory=True
+        )
+        
+        val_loader = DataLoader(
+            val_dataset,
+            batch_sampler=PageGroupedBatchSampler(
+                val_dataset.page_ids,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                shuffle=False,
+                even_batches=False
+            ),
+            num_workers=args.num_workers,
+            collate_fn=PaddedBatchCollator(pin_memory=True),
+            pin_memory=True
+        )
+    elif args.bucket_by_width:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=bucket_sampler_class(
+                train_dataset.get_widths(),
+                batch_size=args.batch_size,
+                num_buckets=args.num_buckets,
+                max_pixels=args.max_batch_pixels,
+                img_height=args.img_height,
+                shuffle=True,
+                text_lengths=train_dataset.get_text_lengths(),
+                curriculum_lambda=args.curriculum_lambda,
+                curriculum_min_length=args.curriculum_min_length
+            ),
+            num_workers=args.num_workers,
+            collate_fn=PaddedBatchCollator(pin_memory=True),
+            pin_memory=True,
+            persistent_workers=persistent_workers
+        )
+        
+        val_loader = DataLoader(
+            val_dataset,
+            batch_sampler=bucket_sampler_class(
+                val_dataset.get_widths(),
+                batch_size=args.batch_size,
+                num_buckets=args.num_buckets,
+                max_pixels=args.max_batch_pixels,
+                img_height=args.img_height,
+                shuffle=False,
+                # Each validation line is evaluated exactly once
+                **({'even_batches': False} if world_size > 1 else {})
+            ),
+            num_workers=args.num_workers,
+            collate_fn=PaddedBatchCollator(pin_memory=True),
+            pin_memory=True,
+            persistent_workers=persistent_workers
+        )
+    else:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_size=args.batch_size,
+            shuffle=True,
+            num_workers=args.num_workers,
+            collate_fn=PaddedBatchCollator(pin_memory=True),
+            pin_memory=True,
+            persistent_workers=persistent_workers
+        )
+        
+        val_loader = DataLoader(
+            val_dataset,
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_workers=args.num_workers,
+            collate_fn=PaddedBatchCollator(pin_memory=True),
+            pin_memory=True,
+            persistent_workers=persistent_workers
+        )
     
     # Create model
     model = CRNN(
@@ -107,7 +319,23 @@ def main():
         batch_size=args.batch_size,
         use_distortions=args.use_distortions,
         grad_clip=args.grad_clip,
-        cer_trim=args.cer_trim
+        cer_trim=args.cer_trim,
+        optimizer_class=torch.optim.AdamW if args.optimizer == 'adamw' else torch.optim.Adam,
+        optimizer_kwargs={'weight_decay': args.weight_decay},
+        optimizer_impl=args.optimizer_impl,
+        lr_scheduler=args.lr_scheduler,
+        warmup_steps=args.warmup_steps,
+        min_learning_rate=args.min_learning_rate,
+        lr_decay=args.lr_decay,
+        lr_decay_after=args.lr_decay_after,
+        lr_decay_period=args.lr_decay_period,
+        lr_plateau_patience=args.lr_plateau_patience,
+        lr_plateau_threshold=args.lr_plateau_threshold,
+        distorter=distorter,
+        train_metrics_every=args.train_metrics_every,
+        train_metrics_fraction=args.train_metrics_fraction,
+        profile=args.profile,
+        profile_trace=args.profile_trace
     )
     
     # Setup training
@@ -119,20 +347,40 @@ def main():
         mode='min'
     )
     
+    callbacks = [checkpoint_callback]
+    if args.lr_scheduler != 'none' or args.warmup_steps > 0:
+        callbacks.append(LearningRateMonitor(logging_interval='step'))
+    if args.early_stop_epochs > 0:
+        callbacks.append(RelativeEarlyStopping(
+            monitor='val_cer',
+            patience=args.early_stop_epochs,
+            threshold=args.early_stop_threshold
+        ))
+    
     wandb_logger = WandbLogger(project=args.wandb_project)
     
     # Create PyTorch Lightning trainer
     pl_trainer = pl.Trainer(
         max_epochs=args.max_epochs,
-        accelerator='gpu' if args.gpus > 0 else 'cpu',
-        devices=args.gpus,
+        accelerator=accelerator,
+        devices=devices,
+        num_nodes=args.num_nodes,
+        strategy=args.strategy or ('ddp' if world_size > 1 else 'auto'),
+        sync_batchnorm=args.sync_batchnorm,
+        use_distributed_sampler=not (args.bucket_by_width or args.page_regions),
         logger=wandb_logger,
-        callbacks=[checkpoint_callback],
-        precision=16  # Use mixed precision for faster training
+        callbacks=callbacks,
+        accumulate_grad_batches=args.accumulate_grad_batches,
+        precision='16-mixed' if accelerator == 'gpu' else '32-true'  # Use mixed precision for faster training
     )
     
     # Train
-    pl_trainer.fit(trainer, train_loader, val_loader)
+    fit_kwargs = {}
+    if args.resume_from and 'weights_only' in inspect.signature(pl.Trainer.fit).parameters:
+        # Older checkpoints hold the optimizer class in their hyperparameters,
+        # which torch.load only unpickles with weights_only=False
+        fit_kwargs['weights_only'] = False
+    pl_trainer.fit(trainer, train_loader, val_loader, ckpt_path=args.resume_from, **fit_kwargs)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file